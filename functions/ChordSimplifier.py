@@ -1,17 +1,44 @@
 import re
 
+# all patterns are compiled once at import, not on every call
+PLAYSTYLE_ROOT = re.compile(r'^[A-G](' + '|'.join(map(re.escape, ["-", "#", "^"])) + ')?$')
+# Enhanced regex patterns to handle extended chords, altered chords, and slash chords
+# (1) Basic chords with possible alterations and extensions - matches chords like C7, F#9, and Ab13.
+BASIC_CHORDS = re.compile(r'[A-G]#?-?\d{1,2}')
+# Chords with specific extensions -  matches chords like Cadd9, D#sus4, Faug, Gdim, A#11, Eb13b9, etc.
+EXTENDED_CHORDS = re.compile(r'[A-G]#?(add|sus|aug|dim|\d{0,2}(#5|b5|#9|b9))')
+#  matches chords like D/F#, G/B, Cm/Eb, etc.
+SLASH_CHORDS = re.compile(r'[A-G](#|-)?(/[A-G](#|-)?)?')
+
+
 class ChordSimplifier:
-    def __init__(self):
+    def __init__(self, use_cache:bool=True):
         self.JAZZ5_KINDS = ["maj", "min", "maj7", "min7", "dom", "hdim7", "dim"]
         self.JAZZ5_MIREX_KINDS = [":maj", ":min", ":maj7", ":min7", ":7", ":hdim7", ":dim7"]
         self.playstyle_symbols = ["^", "*", ";", "+"]
-        self.not_found = []
+        self.not_found = set()
         # h end glissando
         # o harmonic
         # ^ accent mark
         # ; pause sign
         # + undefined, user assignable
 
+        self.quality_list = [
+            ("maj7", self.JAZZ5_MIREX_KINDS[2]),
+            ("min7", self.JAZZ5_MIREX_KINDS[3]),
+            ("h", self.JAZZ5_MIREX_KINDS[5]), # h-dim and h-dim 7th to hdim7
+            ("o", self.JAZZ5_MIREX_KINDS[6]), # dimished and dimished seventh seventh to dim7
+            ("7", self.JAZZ5_MIREX_KINDS[4]),
+            ("maj", self.JAZZ5_MIREX_KINDS[0]),
+            ("min", self.JAZZ5_MIREX_KINDS[1]),
+        ]
+
+        # the corpus only has ~1000 distinct raw chords, so every chord is simplified once and then looked up
+        self.use_cache = use_cache
+        self.cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
     def _get_root(self, chord):
         if chord[1] == '-':
             return chord[:2]
@@ -19,13 +46,12 @@ class ChordSimplifier:
             return chord[:2]
         else:
             return chord[0]
-    
+
     def _is_chord(self, chord):
-        playstyle_symbols = ["-", "#", "^"]
         if "r" in chord[:2]:
             return False
-        chord = re.sub(r'C-', 'B', chord)
-        if len(chord) <= 2 and re.match(r'^[A-G](' + '|'.join(map(re.escape, playstyle_symbols)) + ')?$', chord):
+        chord = chord.replace('C-', 'B')
+        if len(chord) <= 2 and PLAYSTYLE_ROOT.match(chord):
             return False
         return True
 
@@ -35,55 +61,55 @@ class ChordSimplifier:
         return chord
 
     def extract_chord_quality(self, chord):
-        quality_list = [
-            ("maj7", self.JAZZ5_MIREX_KINDS[2]),
-            ("min7", self.JAZZ5_MIREX_KINDS[3]),
-            ("h", self.JAZZ5_MIREX_KINDS[5]), # h-dim and h-dim 7th to hdim7
-            ("o", self.JAZZ5_MIREX_KINDS[6]), # dimished and dimished seventh seventh to dim7
-            ("7", self.JAZZ5_MIREX_KINDS[4]),
-            ("maj", self.JAZZ5_MIREX_KINDS[0]),
-            ("min", self.JAZZ5_MIREX_KINDS[1]),
-        ]
-        for quality, chord_type in quality_list:
+        for quality, chord_type in self.quality_list:
             if quality in chord:
                 return chord_type
         return None
 
-    def simplify_chord(self, chord: str = None):
-        if not self._is_chord(chord): 
+    def _simplify_chord(self, chord: str = None):
+        if not self._is_chord(chord):
             return "Invalid/No Chord"
         root_note = self._get_root(chord)
         chord = self._chop_chord(chord)
-        if not self._is_chord(chord): 
+        if not self._is_chord(chord):
             return "Invalid/No Chord"
 
         chord_type = self.extract_chord_quality(chord)
         if chord_type is not None:
             return root_note + chord_type
 
-        # Enhanced regex patterns to handle extended chords, altered chords, and slash chords
-        # (1) Basic chords with possible alterations and extensions - matches chords like C7, F#9, and Ab13.
-        basic_chords = r'[A-G]#?-?\d{1,2}'
-        # Chords with specific extensions -  matches chords like Cadd9, D#sus4, Faug, Gdim, A#11, Eb13b9, etc.
-        extended_chords = r'[A-G]#?(add|sus|aug|dim|\d{0,2}(#5|b5|#9|b9))'
-        #  matches chords like D/F#, G/B, Cm/Eb, etc.
-        slash_chords = r'[A-G](#|-)?(/[A-G](#|-)?)?'
-        
-        if re.search(basic_chords, chord) or \
-           re.search(extended_chords, chord) or \
-           re.search(slash_chords, chord):
+        if BASIC_CHORDS.search(chord) or \
+           EXTENDED_CHORDS.search(chord) or \
+           SLASH_CHORDS.search(chord):
             return root_note + self.JAZZ5_MIREX_KINDS[0]  # Consider them as major type
 
-
-        if chord not in self.not_found:
-            self.not_found.append(chord)
+        self.not_found.add(chord)
         return root_note + self.JAZZ5_MIREX_KINDS[0]  # Default to major type
 
+    def simplify_chord(self, chord: str = None):
+        if not self.use_cache:
+            return self._simplify_chord(chord)
+
+        simplified = self.cache.get(chord)
+        if simplified is not None:
+            self.cache_hits += 1
+            return simplified
+
+        self.cache_misses += 1
+        simplified = self._simplify_chord(chord)
+        self.cache[chord] = simplified
+        return simplified
+
+    def cache_info(self):
+        return {"hits": self.cache_hits, "misses": self.cache_misses, "size": len(self.cache)}
+
     def batch_simplify_chord(self, chords:list=None):
+        # simplify every distinct chord only once and map the results back
+        simplified = {chord: self.simplify_chord(chord) for chord in dict.fromkeys(chords)}
         simple_chords = []
         for chord in chords:
-            s_chord = self.simplify_chord(chord)
-            if s_chord: 
+            s_chord = simplified[chord]
+            if s_chord:
                 simple_chords.append(s_chord)
         return simple_chords
 
@@ -91,6 +117,6 @@ class ChordSimplifier:
         simple_chords = []
         for chord in chords:
             s_chord = self._chop_chord(chord)
-            if s_chord: 
+            if s_chord:
                 simple_chords.append(s_chord)
         return simple_chords
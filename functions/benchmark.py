@@ -0,0 +1,409 @@
+"""
+Benchmarks for the JazzNet pipeline.
+
+    python -m functions.benchmark tokens         # quarter note tokens vs run length (duration, chord) tokens
+    python -m functions.benchmark constrained    # valid songs/s with and without the BarConstraint
+    python -m functions.benchmark transpose      # overhead of the key transposition per epoch
+
+    python -m functions.benchmark suite --output outputs/benchmarks/after.json    # every pipeline stage, JSON
+    python -m functions.benchmark compare outputs/benchmarks/before.json outputs/benchmarks/after.json
+
+The suite times every stage of the pipeline on the real corpus in data/ and on corpora scaled up by copying it (--scales
+1 10 100, the copies are transposed to the other keys), such that the scaling of every stage can be seen. Training and
+generation only run on the real corpus (--model-scales). compare prints the ratio of every stage and exits with 1 if a
+stage got slower by more than --threshold or is missing in the new results.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import subprocess
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from functions.utils import encode_chords, add_start_end_tokens, extract_chords, flatten_chords, merge_chords
+from functions.corpus import get_jazz_files
+from functions.labels import translate_chords, note_to_number
+from functions.ChordSimplifier import ChordSimplifier
+from functions.data import ChordDataset, bucket_loader, transposition_table, TransposeCollate
+from functions.models import ChordLSTM, baselineRNN, build_model, load_models
+from functions.generation import generate_sequence, generate_sequences, BarConstraint
+from functions.metrics import to_arrays, merge_arrays, fits_in_time_signature, evaluate_sets
+from functions.midi import export_midi, parse_chord, chord_pattern
+from functions.training import train_epoch
+
+CHORDS_PATH = "data/processed/chords.json"
+# the roots of the transposed copies, with flats like most of the corpus
+SPELLINGS = ["C", "D-", "D", "E-", "E", "F", "G-", "G", "A-", "A", "B-", "B"]
+# "2A-7" (.jazz file) or "A-:7" (chords.json): rhythm, root, rest
+CHORD = re.compile(r"([0-9.]*)([A-G][-#]*)(.*)$")
+
+
+def load_songs(path=CHORDS_PATH):
+    with open(path, "r") as fh:
+        return json.load(fh)
+
+
+def _train_epoch(model, loader, lr=0.01):
+    criterion = nn.CrossEntropyLoss(ignore_index=0)
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    train_epoch(model, loader, optimizer, criterion, "cpu").result()
+
+
+def compare_token_modes(songs=None, batch_size=64, num_songs=100, max_length=2000, seed=1):
+    """Compares the quarter note representation against the run length tokens: sequence length, vocab size, the time of
+    one training epoch (ChordLSTM and baselineRNN) and the time to generate num_songs songs."""
+    if songs is None:
+        songs = load_songs()
+    songs = add_start_end_tokens(songs)
+
+    results = {}
+    for mode, runlength in [("quarter", False), ("runlength", True)]:
+        _, _, _, sequences, vocab_size = encode_chords(songs, pad=False, runlength=runlength)
+        lengths = [len(sequence) for sequence in sequences]
+        loader = bucket_loader(ChordDataset(sequences), batch_size)
+        result = {"vocab_size": vocab_size, "mean_length": sum(lengths) / len(lengths), "max_length": max(lengths),
+                  "tokens": sum(lengths)}
+
+        for name, model_class, rnn in [("lstm", ChordLSTM, False), ("rnn", baselineRNN, True)]:
+            torch.manual_seed(seed)
+            model = build_model(model_class, vocab_size)
+
+            start = time.perf_counter()
+            _train_epoch(model, loader)
+            result[f"{name}_epoch_seconds"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            generate_sequences(model, num_songs, max_length, "cpu", rnn=rnn)
+            result[f"{name}_generation_seconds"] = time.perf_counter() - start
+
+        results[mode] = result
+
+    return results
+
+
+def valid_songs(sequences, min_bars=1, max_bars=None, special_tokens=(0, 1, 2)):
+    """Bool array: the song (generate_sequences output, quarter note tokens) fits in 4/4 with a full last bar
+    (fits_in_time_signature of the notebook), has min_bars to max_bars bars and no special tokens after <BOS>."""
+    tokens, offsets = to_arrays([sequence[1:] for sequence in sequences])
+    merged_tokens, durations, merged_offsets = merge_arrays(tokens, offsets)
+    valid = fits_in_time_signature(durations, merged_offsets)
+
+    lengths = np.diff(offsets)
+    valid &= lengths >= min_bars * 4
+    if max_bars is not None:
+        valid &= lengths <= max_bars * 4
+    has_special = np.bincount(np.repeat(np.arange(len(lengths)), lengths)[np.isin(tokens, special_tokens)],
+                              minlength=len(lengths)) > 0
+    return valid & ~has_special
+
+
+def compare_constrained(num_songs=500, max_length=2000, min_bars=8, max_bars=64, epoch=35, seed=1):
+    """Generates num_songs songs with the trained models (load_models) with and without a BarConstraint and reports
+    how many of them are valid (valid_songs) and the valid songs per second."""
+    songs = add_start_end_tokens(load_songs())
+    _, _, idx_to_chord, _, vocab_size = encode_chords(songs, pad=False)
+    rnn_model, lstm_model = build_model(baselineRNN, vocab_size), build_model(ChordLSTM, vocab_size)
+    load_models(epoch, rnn_model, lstm_model)
+    constraint = BarConstraint.from_vocab(idx_to_chord, min_bars=min_bars, max_bars=max_bars)
+
+    results = {}
+    for mode, mode_constraint in [("free", None), ("constrained", constraint)]:
+        result = {}
+        for name, model, rnn in [("lstm", lstm_model, False), ("rnn", rnn_model, True)]:
+            torch.manual_seed(seed)
+            start = time.perf_counter()
+            sequences = generate_sequences(model, num_songs, max_length, "cpu", rnn=rnn, constraint=mode_constraint)
+            seconds = time.perf_counter() - start
+            valid = valid_songs(sequences, min_bars, max_bars)
+            result[f"{name}_valid_fraction"] = float(valid.mean())
+            result[f"{name}_songs_per_second"] = num_songs / seconds
+            result[f"{name}_valid_songs_per_second"] = int(valid.sum()) / seconds
+            result[f"{name}_mean_length"] = float(np.mean([len(sequence) - 1 for sequence in sequences]))
+        results[mode] = result
+    return results
+
+
+def transpose_overhead(songs=None, batch_size=64, repeats=5, seed=1):
+    """Time of one pass over the training loader with and without TransposeCollate (quarter note and run length tokens),
+    against the time of one training epoch of ChordLSTM. Also reports how many (shift, chord) pairs of the vocab and
+    how many corpus tokens have no transposition in the vocab."""
+    if songs is None:
+        songs = load_songs()
+    songs = add_start_end_tokens(songs)
+
+    results = {}
+    for mode, runlength in [("quarter", False), ("runlength", True)]:
+        _, _, idx_to_chord, sequences, vocab_size = encode_chords(songs, pad=False, runlength=runlength)
+        tokens = torch.cat(sequences)
+        table, valid = transposition_table(idx_to_chord, torch.bincount(tokens, minlength=vocab_size))
+        dataset = ChordDataset(sequences)
+        result = {"missing_pairs": int((~valid).sum()),
+                  "missing_token_fraction": float((~valid[1:, tokens]).float().mean())}
+
+        for name, transpose in [("plain", None), ("transposed", TransposeCollate(table, valid))]:
+            torch.manual_seed(seed)
+            loader = bucket_loader(dataset, batch_size, transpose=transpose)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                for _ in loader:
+                    pass
+            result[f"{name}_loader_seconds"] = (time.perf_counter() - start) / repeats
+
+        torch.manual_seed(seed)
+        start = time.perf_counter()
+        _train_epoch(build_model(ChordLSTM, vocab_size), bucket_loader(dataset, batch_size, transpose=transpose))
+        result["lstm_epoch_seconds"] = time.perf_counter() - start
+        result["overhead_percent_of_epoch"] = 100 * (result["transposed_loader_seconds"] -
+                                                     result["plain_loader_seconds"]) / result["lstm_epoch_seconds"]
+        results[mode] = result
+    return results
+
+
+def _timed(function, repeats=1):
+    """Runs function repeats times, returns (best time in seconds, result of the last run)."""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _stage(results, name, function, items, repeats=1, cached=False):
+    seconds, result = _timed(function, repeats)
+    results[name] = {"seconds": seconds, "items": items, "items_per_second": items / seconds if seconds > 0 else None,
+                     "cached": cached}
+    return result
+
+
+def transpose_chord(chord, shift):
+    """"2A-7" or "A-:7" moved up by shift semitones. Everything else (rests, bar lines, the other lines of a .jazz
+    file) stays as it is."""
+    match = CHORD.match(chord)
+    if match is None or shift % 12 == 0:
+        return chord
+    rhythm, root, rest = match.groups()
+    return rhythm + SPELLINGS[(note_to_number(root) + shift) % 12] + rest
+
+
+def scale_texts(texts, scale):
+    """The .jazz texts copied scale times, copy k transposed by k semitones. With literal copies the caches (the
+    ChordSimplifier, the MIDI chord patterns) would only see the chords of the first copy."""
+    return [text if k % 12 == 0 else "\n".join(transpose_chord(line, k) for line in text.split("\n"))
+            for k in range(scale) for text in texts]
+
+
+def scale_songs(songs, scale):
+    """scale_texts for the songs of chords.json."""
+    return [song if k % 12 == 0 else [transpose_chord(chord, k) for chord in song]
+            for k in range(scale) for song in songs]
+
+
+def environment():
+    """Where the results come from, stored with them."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit or None, "python": platform.python_version(), "torch": torch.__version__,
+            "numpy": np.__version__, "platform": platform.platform(), "cpus": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(), "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+
+def run_stages(texts, scale, train=True, num_songs=100, max_length=2000, batch_size=64, epoch=35, repeats=3, seed=1):
+    """Times every stage of the pipeline on the .jazz texts copied scale times (scale_texts). Returns {stage:
+    {seconds, items, items_per_second, cached}}, items are files, songs, chords or tokens (see the stage names). The copies are
+    in all 12 keys, but from 12 copies on the chords repeat: the stages with cached=True (memoized per chord) then
+    mostly measure cache hits, their time per item goes down with the scale."""
+    texts = scale_texts(texts, scale)
+    results = {}
+
+    extracted = _stage(results, "extract_chords_files", lambda: [extract_chords(text) for text in texts], len(texts),
+                       repeats)
+    flattened = _stage(results, "flatten_chords_songs", lambda: [flatten_chords(chords) for chords in extracted],
+                       len(extracted), repeats)
+    # a new simplifier for every run, otherwise the cache of the last run is measured
+    simplified = _stage(results, "batch_simplify_chord_chords",
+                        lambda: [simplifier.batch_simplify_chord(chords) for simplifier in [ChordSimplifier()]
+                                 for chords in flattened], sum(len(chords) for chords in flattened), repeats,
+                        cached=True)
+
+    # the rest runs on the final corpus (chords.json) copied scale times, like the training data would be
+    songs = scale_songs(load_songs(), scale)
+    n_chords = sum(len(song) for song in songs)
+    _stage(results, "translate_chords_chords", lambda: [translate_chords(song) for song in songs], n_chords, repeats,
+           cached=True)
+    _, _, idx_to_chord, sequences, vocab_size = _stage(
+        results, "encode_chords_chords", lambda: encode_chords(add_start_end_tokens(songs), pad=False), n_chords, repeats)
+    _stage(results, "merge_chords_songs", lambda: [merge_chords(song) for song in songs], len(songs), repeats)
+    _stage(results, "metrics_songs", lambda: evaluate_sets({"original": songs}, idx_to_chord), len(songs), repeats)
+
+    output_dir = tempfile.mkdtemp()
+    try:
+        # the chord patterns of the last scale would still be cached
+        parse_chord.cache_clear()
+        chord_pattern.cache_clear()
+        _stage(results, "midi_export_files", lambda: export_midi(songs, output_dir, workers=1), 2 * len(songs),
+               cached=True)
+    finally:
+        shutil.rmtree(output_dir)
+
+    if train:
+        loader = bucket_loader(ChordDataset(sequences), batch_size)
+        n_tokens = sum(len(sequence) - 1 for sequence in sequences)
+        for name, model_class in [("lstm", ChordLSTM), ("rnn", baselineRNN)]:
+            torch.manual_seed(seed)
+            model = build_model(model_class, vocab_size)
+            _stage(results, f"{name}_train_epoch_tokens", lambda: _train_epoch(model, loader), n_tokens)
+
+        # generation with the trained checkpoints if there are any (the length of the songs depends on the model)
+        rnn_model, lstm_model = build_model(baselineRNN, vocab_size), build_model(ChordLSTM, vocab_size)
+        try:
+            load_models(epoch, rnn_model, lstm_model)
+        except (FileNotFoundError, RuntimeError):
+            pass
+        for name, model, rnn in [("lstm", lstm_model, False), ("rnn", rnn_model, True)]:
+            torch.manual_seed(seed)
+            _stage(results, f"{name}_generate_sequence_songs",
+                   lambda: [generate_sequence(model, 1, max_length, "cpu", rnn=rnn) for _ in range(num_songs)], num_songs)
+            torch.manual_seed(seed)
+            _stage(results, f"{name}_generate_sequences_songs",
+                   lambda: generate_sequences(model, num_songs, max_length, "cpu", rnn=rnn), num_songs)
+    return results
+
+
+def run_suite(scales=(1, 10, 100), model_scales=(1,), directory="data", repeats=3, verbose=True):
+    """run_stages for every scale, returns {"environment": ..., "results": {scale: {stage: ...}}}."""
+    texts = []
+    for path in get_jazz_files(directory):
+        with open(path, "r") as fh:
+            texts.append(fh.read())
+
+    suite = {"environment": environment(), "results": {}}
+    for scale in scales:
+        start = time.perf_counter()
+        # the big corpora are only timed once
+        suite["results"][str(scale)] = run_stages(texts, scale, train=scale in model_scales,
+                                                  repeats=repeats if scale == 1 else 1)
+        if verbose:
+            print(f"scale {scale}x done in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    return suite
+
+
+def compare_suites(old, new, threshold=0.1, min_seconds=0.005):
+    """Compares two results of run_suite. Returns rows (scale, stage, old seconds, new seconds, ratio, status), status
+    is "slower" if new takes more than (1 + threshold) times as long, "faster" if less than 1 / (1 + threshold) times.
+    Stages that take less than min_seconds in both are too noisy and only marked "ok". Stages of old that are not in
+    new are "missing" (new seconds and ratio None), stages only in new are "new" (old seconds and ratio None)."""
+    rows = []
+    for scale, stages in old["results"].items():
+        for stage, result in stages.items():
+            if stage not in new["results"].get(scale, {}):
+                rows.append((scale, stage, result["seconds"], None, None, "missing"))
+                continue
+            old_seconds, new_seconds = result["seconds"], new["results"][scale][stage]["seconds"]
+            if old_seconds > 0:
+                ratio = new_seconds / old_seconds
+            else:
+                ratio = 1.0 if new_seconds <= 0 else float("inf")
+            status = "ok"
+            if max(old_seconds, new_seconds) >= min_seconds:
+                if ratio > 1 + threshold:
+                    status = "slower"
+                elif ratio < 1 / (1 + threshold):
+                    status = "faster"
+            rows.append((scale, stage, old_seconds, new_seconds, ratio, status))
+    for scale, stages in new["results"].items():
+        for stage, result in stages.items():
+            if stage not in old["results"].get(scale, {}):
+                rows.append((scale, stage, None, result["seconds"], None, "new"))
+    return rows
+
+
+def print_table(results):
+    modes = list(results)
+    print(f"{'':28}" + "".join(f"{mode:>14}" for mode in modes))
+    for key in results[modes[0]]:
+        print(f"{key:28}" + "".join(f"{results[mode][key]:>14.2f}" for mode in modes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JazzNet benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    tokens = subparsers.add_parser("tokens", help="quarter note vs run length tokens")
+    tokens.add_argument("--batch-size", type=int, default=64)
+    tokens.add_argument("--num-songs", type=int, default=100, help="songs to generate per model")
+    tokens.add_argument("--json", action="store_true", help="print the results as JSON")
+
+    constrained = subparsers.add_parser("constrained", help="valid songs/s with and without the BarConstraint")
+    constrained.add_argument("--num-songs", type=int, default=500, help="songs to generate per model")
+    constrained.add_argument("--min-bars", type=int, default=8)
+    constrained.add_argument("--max-bars", type=int, default=64)
+    constrained.add_argument("--json", action="store_true", help="print the results as JSON")
+
+    transpose = subparsers.add_parser("transpose", help="overhead of the key transposition per epoch")
+    transpose.add_argument("--batch-size", type=int, default=64)
+    transpose.add_argument("--json", action="store_true", help="print the results as JSON")
+
+    suite = subparsers.add_parser("suite", help="times every pipeline stage, also on scaled up corpora")
+    suite.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100], help="copies of the corpus")
+    suite.add_argument("--model-scales", type=int, nargs="*", default=[1],
+                       help="scales with training and generation")
+    suite.add_argument("--repeats", type=int, default=3, help="runs of the fast stages on the real corpus (best counts)")
+    suite.add_argument("--output", default=None, help="JSON file, default: print it")
+
+    compare = subparsers.add_parser("compare", help="compares two suite results and flags regressions")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=0.1, help="relative slowdown that counts as regression")
+
+    args = parser.parse_args()
+    if args.command == "suite":
+        results = run_suite(args.scales, args.model_scales, repeats=args.repeats)
+        if args.output:
+            os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+            with open(args.output, "w") as fh:
+                json.dump(results, fh, indent=4)
+        else:
+            print(json.dumps(results, indent=4))
+        return
+    if args.command == "compare":
+        with open(args.old, "r") as fh:
+            old = json.load(fh)
+        with open(args.new, "r") as fh:
+            new = json.load(fh)
+        rows = compare_suites(old, new, args.threshold)
+        print(f"{'scale':>6}  {'stage':36}{'old s':>12}{'new s':>12}{'ratio':>8}  status")
+        for scale, stage, old_seconds, new_seconds, ratio, status in rows:
+            old_seconds, new_seconds, ratio = ["-" if value is None else f"{value:.{digits}f}"
+                                               for value, digits in [(old_seconds, 4), (new_seconds, 4), (ratio, 2)]]
+            print(f"{scale:>6}  {stage:36}{old_seconds:>12}{new_seconds:>12}{ratio:>8}  {status}")
+        regressions = [row for row in rows if row[-1] == "slower"]
+        missing = [row for row in rows if row[-1] == "missing"]
+        print(f"{len(regressions)} regressions (threshold {args.threshold:.0%}), {len(missing)} stages missing")
+        sys.exit(1 if regressions or missing else 0)
+
+    if args.command == "tokens":
+        results = compare_token_modes(batch_size=args.batch_size, num_songs=args.num_songs)
+    elif args.command == "transpose":
+        results = transpose_overhead(batch_size=args.batch_size)
+    else:
+        results = compare_constrained(num_songs=args.num_songs, min_bars=args.min_bars, max_bars=args.max_bars)
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Corpus index for the .jazz (**kern) files.
+
+Every file is read and parsed once: title, year, time signature, section order, the raw chords (like extract_chords) and
+the duration histogram are extracted together. The results are stored in a cache file, keyed on the size, mtime and hash
+of every file. When the index is built again, only new or changed files are parsed.
+"""
+
+import io
+import os
+import glob
+import json
+import tarfile
+import hashlib
+import zipfile
+
+from functions.utils import read_kern
+
+# increase this if parse_kern changes, such that old caches are not used anymore
+CACHE_VERSION = 2
+DEFAULT_CACHE = os.path.join("data", "processed", "corpus_index.json")
+
+
+def get_jazz_files(directory="data"):
+    """Returns all .jazz files in directory, sorted by name so the order does not depend on the file system."""
+    return sorted(glob.glob(os.path.join(directory, "*.jazz")))
+
+
+def chord_duration(chord):
+    """Returns the duration prefix of a raw chord, e.g. "2." for "2.D:min" or "4" for "4G7"."""
+    if chord[1] == ".":
+        return chord[:2]
+    return chord[0]
+
+
+def parse_kern(lines):
+    """Extracts everything we need from one kern file in a single pass. lines is any iterator of lines (see
+    functions.utils.iter_kern), e.g. an open file or text.split("\n")."""
+    info = read_kern(lines)
+
+    # duration histogram, chords with a length of one are skipped (like in PreProcessing.ipynb)
+    durations = {}
+    for chord in info["chords"]:
+        if len(chord) == 1:
+            continue
+        duration = chord_duration(chord)
+        durations[duration] = durations.get(duration, 0) + 1
+
+    return {
+        "title": info["title"],
+        "year": info["year"],
+        "signature": info["signature"],
+        "sections": info["sequence"],
+        "chords": info["chords"],
+        "durations": durations,
+    }
+
+
+def iter_archive(path):
+    """Yields (name, lines) for every .jazz file in a .zip or .tar(.gz) archive, without extracting it. lines can be
+    passed to parse_kern or functions.utils.read_kern directly."""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for name in sorted(archive.namelist()):
+                if name.endswith(".jazz"):
+                    with archive.open(name) as fh:
+                        yield os.path.basename(name), io.TextIOWrapper(fh, encoding="utf-8")
+    else:
+        with tarfile.open(path) as archive:
+            for member in sorted(archive.getmembers(), key=lambda m: m.name):
+                if member.isfile() and member.name.endswith(".jazz"):
+                    yield os.path.basename(member.name), io.TextIOWrapper(archive.extractfile(member), encoding="utf-8")
+
+
+def _file_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _load_cache(cache_path):
+    if cache_path is None or not os.path.exists(cache_path):
+        return {}
+    with open(cache_path, "r") as fh:
+        cache = json.load(fh)
+    if cache.get("version") != CACHE_VERSION:
+        return {}
+    return cache["files"]
+
+
+def _save_cache(cache_path, files):
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    # write to a temporary file first, such that a crash never leaves a broken cache behind
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w") as fh:
+        json.dump({"version": CACHE_VERSION, "files": files}, fh, separators=(",", ":"))
+    os.replace(tmp_path, cache_path)
+
+
+def build_index(directory="data", cache_path=DEFAULT_CACHE, verbose=False):
+    """Builds the corpus index and returns it as a list of dicts (one per file, sorted by file name). Each dict has the
+    keys file, title, year, signature, sections, chords and durations.
+
+    A file is taken from the cache if its size and mtime did not change. If they did, the file is hashed and only parsed
+    again if the content changed as well. Set cache_path to None to parse everything without a cache.
+    """
+    cached = _load_cache(cache_path)
+    files = {}
+    index = []
+    parsed = 0
+
+    for path in get_jazz_files(directory):
+        name = os.path.basename(path)
+        stat = os.stat(path)
+        entry = cached.get(name)
+
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            with open(path, "rb") as fh:
+                data = fh.read()
+            digest = _file_hash(data)
+
+            # the content is the same (e.g. the file was only touched), no need to parse it again
+            if entry is not None and entry["sha1"] == digest:
+                entry = dict(entry, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            else:
+                entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": digest,
+                         "entry": parse_kern(data.decode("utf-8").strip().split("\n"))}
+                parsed += 1
+
+        files[name] = entry
+        index.append(dict(entry["entry"], file=name))
+
+    if cache_path is not None and files != cached:
+        _save_cache(cache_path, files)
+
+    if verbose:
+        print(f"Indexed {len(index)} files, parsed {parsed}, {len(index) - parsed} from cache.")
+
+    return index
@@ -0,0 +1,195 @@
+"""
+Dataset, bucketing sampler and collate function for the encoded chord sequences.
+
+Instead of padding every song to the longest one in the corpus, songs of similar length are grouped into the same batch
+and only padded to the longest song of that batch. The lengths are computed once when the dataset is created.
+"""
+
+import torch
+from torch.utils.data import Dataset, DataLoader, Sampler, Subset
+from torch.nn.utils.rnn import pad_sequence
+
+from functions.labels import note_to_number
+
+TRANSPOSE_POLICIES = ["keep", "skip"]
+
+
+class ChordDataset(Dataset):
+    def __init__(self, sequences):
+        """sequences is either the padded (songs, max_length) tensor from encode_chords, the list of unpadded 1d
+        tensors from encode_chords(..., pad=False) or the memory mapped songs of functions/tokens.py."""
+        self.data = sequences
+
+        # Compute the original length of every sequence (without padding) once, not on every access.
+        # We subtract 1 from the length because the input is sequence[:-1], which has one token less
+        if torch.is_tensor(sequences):
+            self.lengths = ((sequences != 0).sum(dim=1) - 1).tolist()
+        elif hasattr(sequences, "lengths"):
+            # TokenSequences know their lengths from the offsets
+            self.lengths = [length - 1 for length in sequences.lengths]
+        else:
+            self.lengths = [len(sequence) - 1 for sequence in sequences]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        sequence = self.data[idx]
+
+        # Using the current token to predict the next token
+        return sequence[:-1], sequence[1:], self.lengths[idx]
+
+
+def collate_chords(batch):
+    """Pads a batch only to its longest sequence. Returns (input_seq, target_seq, lengths) like the old DataLoader did.
+    Rows that are already padded (ChordDataset on the padded tensor) are cut to the longest sequence as well. The token
+    file stores uint8/uint16 tokens, they are converted to long here (this is the first copy)."""
+    inputs, targets, lengths = zip(*batch)
+    max_length = max(lengths)
+    # cutting the columns gives a non contiguous view, .view(-1) in the training loop needs contiguous tensors
+    input_seq = pad_sequence(inputs, batch_first=True)[:, :max_length].contiguous().long()
+    target_seq = pad_sequence(targets, batch_first=True)[:, :max_length].contiguous().long()
+    return input_seq, target_seq, torch.tensor(lengths)
+
+
+def transposition_table(idx_to_chord, counts=None):
+    """Returns (table, valid), both (12, vocab_size): table[k, token] is the token transposed up by k semitones,
+    valid[k, token] is False if that chord is not in the vocab (then table[k, token] = token). The root is parsed with
+    labels.note_to_number, so enharmonic spellings (E-/D#) are the same pitch. If the vocab has several spellings of the
+    transposed chord, the one with the highest count (e.g. the token counts of the corpus) is used, without counts the
+    one with the lowest id. Special tokens and run length prefixes ("2.C:maj7") are kept."""
+    vocab_size = len(idx_to_chord)
+    parsed = {}
+    for idx in range(vocab_size):
+        token = idx_to_chord[idx]
+        if ':' not in token:
+            continue  # <BOS>, <EOS>, pad
+        rhythm = ""
+        if token[0].isdigit():
+            rhythm = token[:2] if token[1] == '.' else token[0]
+        root, kind = token[len(rhythm):].split(':', 1)
+        parsed[idx] = (rhythm, note_to_number(root) % 12, kind)
+
+    # (rhythm, pitch, kind) -> token, the preferred spelling
+    spelling = {}
+    for idx, key in parsed.items():
+        best = spelling.get(key)
+        if best is None or (counts is not None and counts[idx] > counts[best]):
+            spelling[key] = idx
+
+    table = torch.arange(vocab_size).repeat(12, 1)
+    valid = torch.ones(12, vocab_size, dtype=torch.bool)
+    for shift in range(1, 12):
+        for idx, (rhythm, pitch, kind) in parsed.items():
+            target = spelling.get((rhythm, (pitch + shift) % 12, kind))
+            if target is None:
+                valid[shift, idx] = False
+            else:
+                table[shift, idx] = target
+    return table, valid
+
+
+class TransposeCollate:
+    """collate_chords plus a random transposition of every song (the same for input and target). The shifts are drawn
+    per song (0-11 semitones) and the whole batch is remapped with one gather on the table of transposition_table.
+
+    Chords whose transposition is not in the vocab follow policy: "keep" leaves these chords as they are (the rest of
+    the song is transposed), "skip" leaves the whole song in its original key."""
+
+    def __init__(self, table, valid, policy="keep", generator=None):
+        if policy not in TRANSPOSE_POLICIES:
+            raise ValueError(f"policy must be one of {TRANSPOSE_POLICIES}")
+        self.table = table
+        self.valid = valid
+        self.policy = policy
+        self.generator = generator
+
+    def __call__(self, batch):
+        input_seq, target_seq, lengths = collate_chords(batch)
+        shifts = torch.randint(0, 12, (input_seq.size(0), 1), generator=self.generator)
+        if self.policy == "skip":
+            # pad is valid, so only the real chords of the song count
+            shifts = shifts * self.valid[shifts, target_seq].all(dim=1, keepdim=True)
+        return self.table[shifts, input_seq], self.table[shifts, target_seq], lengths
+
+
+def dataset_lengths(dataset):
+    """Returns the precomputed lengths of a ChordDataset, also if it is wrapped in a Subset (e.g. from random_split)."""
+    if isinstance(dataset, Subset):
+        parent_lengths = dataset_lengths(dataset.dataset)
+        return [parent_lengths[i] for i in dataset.indices]
+    return dataset.lengths
+
+
+class BucketBatchSampler(Sampler):
+    """Yields batches of indices where each batch holds songs of similar length.
+
+    The indices are shuffled and cut into buckets of batch_size * bucket_multiplier songs. Inside a bucket, the songs are
+    sorted by length and cut into batches, then the order of all batches is shuffled. A smaller bucket_multiplier gives
+    more random batches, but more padding. The bucket has to stay well below the size of the training set: if it holds
+    all songs, every epoch has the same batches (only their order changes).
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_multiplier=4, drop_last=False, generator=None):
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_multiplier = bucket_multiplier
+        self.drop_last = drop_last
+        self.generator = generator
+
+    def _batches(self):
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=self.generator).tolist()
+        else:
+            indices = list(range(len(self.lengths)))
+
+        bucket_size = self.batch_size * self.bucket_multiplier
+        batches = []
+        for start in range(0, len(indices), bucket_size):
+            bucket = sorted(indices[start:start + bucket_size], key=lambda i: self.lengths[i])
+            for batch_start in range(0, len(bucket), self.batch_size):
+                batch = bucket[batch_start:batch_start + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch)
+
+        if self.shuffle:
+            order = torch.randperm(len(batches), generator=self.generator).tolist()
+            batches = [batches[i] for i in order]
+        return batches
+
+    def __iter__(self):
+        return iter(self._batches())
+
+    def __len__(self):
+        # the bucket sizes only depend on the number of songs, so this is exact
+        bucket_size = self.batch_size * self.bucket_multiplier
+        n_batches = 0
+        for start in range(0, len(self.lengths), bucket_size):
+            size = min(bucket_size, len(self.lengths) - start)
+            if self.drop_last:
+                n_batches += size // self.batch_size
+            else:
+                n_batches += (size + self.batch_size - 1) // self.batch_size
+        return n_batches
+
+
+def bucket_loader(dataset, batch_size, shuffle=True, bucket_multiplier=4, transpose=None, **kwargs):
+    """Creates a DataLoader with the BucketBatchSampler and the per batch padding. transpose is a TransposeCollate for
+    the key augmentation (training loader only). kwargs are passed to the DataLoader (e.g. worker_init_fn)."""
+    sampler = BucketBatchSampler(dataset_lengths(dataset), batch_size, shuffle=shuffle, bucket_multiplier=bucket_multiplier)
+    return DataLoader(dataset, batch_sampler=sampler, collate_fn=transpose or collate_chords, **kwargs)
+
+
+def padding_stats(loader):
+    """Runs over the loader once (one epoch) and counts the real tokens and the padding tokens the model processes.
+    Useful to compare the bucketing against the padding to the longest song."""
+    tokens = 0
+    padding = 0
+    for input_seq, _, lengths in loader:
+        batch_tokens = int(lengths.sum())
+        tokens += batch_tokens
+        padding += input_seq.numel() - batch_tokens
+
+    return {"tokens": tokens, "padding": padding, "padding_ratio": padding / max(tokens + padding, 1)}
@@ -0,0 +1,245 @@
+"""
+Inference artifact for generating on CPU.
+
+A trained ChordLSTM / baselineRNN is exported as one TorchScript file: the nn.LSTM and nn.Linear layers are dynamically
+quantized to int8 and the decoding step is scripted and frozen. The vocab and the shape of the hidden state are stored
+in the same file, so loading it needs neither the notebook nor functions/models.py:
+
+    python -m functions.export --model lstm --epoch 35
+    model = load_inference_model("models/lstm/ChordLSTM-int8.pt")
+    generate_sequences(model, 100, 2000, "cpu")
+
+PyTorch has no dynamic quantization for nn.RNN, so for baselineRNN only the linear layer is int8, the RNN itself stays
+float32 (it is still scripted).
+
+    python -m functions.export --model lstm --check    # quality check and decoding benchmark, float vs exported
+"""
+
+import os
+import copy
+import json
+import time
+import argparse
+from typing import Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+from scipy.spatial.distance import jensenshannon
+
+from functions.models import ChordLSTM, baselineRNN, build_model, load_models
+from functions.training import evaluate
+from functions.generation import generate_sequences
+
+META_FILE = "meta.json"
+
+
+class LSTMStep(nn.Module):
+    """embedding -> lstm -> fc with the (h, c) state passed explicitly, such that it can be scripted."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.embedding = model.embedding
+        self.lstm = model.lstm
+        self.fc = model.fc
+
+    def forward(self, x: torch.Tensor, h: torch.Tensor, c: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        output, (h, c) = self.lstm(self.embedding(x), (h, c))
+        return self.fc(output), h, c
+
+
+class RNNStep(nn.Module):
+    """Same as LSTMStep for baselineRNN. c is not used, it is only there such that both have the same signature."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.embedding = model.embedding
+        self.rnn = model.rnn
+        self.fc = model.fc
+
+    def forward(self, x: torch.Tensor, h: torch.Tensor, c: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        output, h = self.rnn(self.embedding(x), h)
+        return self.fc(output), h, c
+
+
+def quantize_model(model):
+    """Returns an int8 copy of model (nn.LSTM and nn.Linear weights, activations are quantized on the fly)."""
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).eval(), {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+
+def export_model(model, path, idx_to_chord=None, quantize=True):
+    """Quantizes (optional), scripts and saves model to path. idx_to_chord is stored with it, if given."""
+    model = model.cpu().eval()
+    rnn = model.rnn if isinstance(model, baselineRNN) else model.lstm
+    meta = {
+        "model": model.__class__.__name__,
+        "lstm": isinstance(model, ChordLSTM),
+        "n_layers": rnn.num_layers,
+        "hidden_dim": rnn.hidden_size,
+        "vocab_size": model.fc.out_features,
+        "quantized": quantize,
+        "vocab": [idx_to_chord[i] for i in range(len(idx_to_chord))] if idx_to_chord is not None else None,
+    }
+
+    if quantize:
+        model = quantize_model(model)
+    step = LSTMStep(model) if meta["lstm"] else RNNStep(model)
+    scripted = torch.jit.freeze(torch.jit.script(step.eval()))
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    torch.jit.save(scripted, tmp_path, _extra_files={META_FILE: json.dumps(meta)})
+    os.replace(tmp_path, path)
+
+
+class InferenceModel:
+    """An exported model. step() works like ChordLSTM.step / baselineRNN.step, so it can be passed to
+    generate_sequences, and calling it on a (batch, length) batch works like forward (e.g. for evaluate)."""
+
+    packed = False
+
+    def __init__(self, module, meta):
+        self.module = module
+        self.meta = meta
+        self.lstm = meta["lstm"]
+        self.vocab = meta["vocab"]
+        self._empty = torch.zeros(0)
+
+    def init_hidden(self, batch_size):
+        h = torch.zeros(self.meta["n_layers"], batch_size, self.meta["hidden_dim"])
+        return (h, torch.zeros_like(h)) if self.lstm else h
+
+    def __call__(self, x, hidden=None):
+        if hidden is None:
+            hidden = self.init_hidden(x.size(0))
+        h, c = hidden if self.lstm else (hidden, self._empty)
+        output, h, c = self.module(x, h, c)
+        return output, ((h, c) if self.lstm else h)
+
+    def step(self, x, hidden=None):
+        output, hidden = self(x, hidden)
+        return output[:, -1], hidden
+
+    # the scripted module is always in eval mode, these are here for functions/training.py and generation.py
+    def eval(self):
+        return self
+
+    def train(self, mode=True):
+        return self
+
+
+def load_inference_model(path):
+    """Loads a file of export_model, no model classes are needed."""
+    extra_files = {META_FILE: ""}
+    module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+    return InferenceModel(module, json.loads(extra_files[META_FILE]))
+
+
+def js_similarity(sequences_a, sequences_b, vocab_size, skip_tokens=(0, 1, 2)):
+    """1 - Jensen-Shannon distance of the token distributions of two sets of songs (lists of token ids), like
+    chord_distribution_similarity in Models.ipynb. pad, <BOS> and <EOS> are not counted."""
+    counts = []
+    for sequences in [sequences_a, sequences_b]:
+        count = np.bincount(np.concatenate([np.asarray(s, dtype=np.int64) for s in sequences]), minlength=vocab_size)
+        count[list(skip_tokens)] = 0
+        counts.append(count / count.sum())
+    return 1 - jensenshannon(counts[0], counts[1])
+
+
+def check_quality(float_model, inference_model, test_loader, num_songs=500, max_length=2000, seed=1):
+    """Compares the exported model against the float model: loss and next token accuracy on test_loader, and the
+    similarity of the chord distributions of num_songs generated songs (to each other and to the test songs). The
+    similarity of two float samples is the reference for float vs exported."""
+    criterion = nn.CrossEntropyLoss(ignore_index=0)
+    results = {}
+    for name, model in [("float", float_model), ("exported", inference_model)]:
+        results[f"{name}_test_loss"], results[f"{name}_test_acc"] = evaluate(model, test_loader, criterion, "cpu")
+
+    test_songs = [target[:length].tolist() for _, targets, lengths in test_loader
+                  for target, length in zip(targets, lengths.tolist())]
+    vocab_size = inference_model.meta["vocab_size"]
+    generated = {}
+    for name, model in [("float", float_model), ("exported", inference_model)]:
+        torch.manual_seed(seed)
+        generated[name] = generate_sequences(model, num_songs, max_length, "cpu")
+        results[f"{name}_js_similarity_to_test"] = js_similarity(generated[name], test_songs, vocab_size)
+    results["js_similarity_float_vs_exported"] = js_similarity(generated["float"], generated["exported"], vocab_size)
+    # two float runs with another seed, this is how similar two samples of the same model are anyway
+    torch.manual_seed(seed + 1)
+    results["js_similarity_float_vs_float"] = js_similarity(
+        generated["float"], generate_sequences(float_model, num_songs, max_length, "cpu"), vocab_size)
+    return results
+
+
+@torch.inference_mode()
+def benchmark_decoding(model, batch_sizes=(1, 256), steps=200, warmup=10):
+    """Time per decoding step (one token for every song of the batch) and tokens/s."""
+    results = {}
+    for batch_size in batch_sizes:
+        x = torch.ones(batch_size, 1, dtype=torch.long)
+        hidden = None
+        for _ in range(warmup):
+            _, hidden = model.step(x, hidden)
+        start = time.perf_counter()
+        for _ in range(steps):
+            _, hidden = model.step(x, hidden)
+        seconds = (time.perf_counter() - start) / steps
+        results[f"batch{batch_size}_ms_per_step"] = seconds * 1000
+        results[f"batch{batch_size}_tokens_per_second"] = batch_size / seconds
+    return results
+
+
+def main():
+    from functions.utils import encode_chords, add_start_end_tokens
+    from functions.data import ChordDataset, bucket_loader
+    from functions.training import split_dataset, load_checkpoint
+
+    parser = argparse.ArgumentParser(description="Exports a trained model as an int8 TorchScript file")
+    parser.add_argument("--model", choices=["lstm", "rnn"], default="lstm")
+    parser.add_argument("--epoch", type=int, default=35, help="checkpoint of load_models")
+    parser.add_argument("--checkpoint", default=None, help="a checkpoint of functions/training.py instead of --epoch")
+    parser.add_argument("--output", default=None, help="default: models/<model>/<class>-int8.pt")
+    parser.add_argument("--no-quantize", action="store_true", help="only script the model")
+    parser.add_argument("--check", action="store_true", help="compare against the float model and benchmark it")
+    parser.add_argument("--num-songs", type=int, default=500, help="songs generated for the quality check")
+    args = parser.parse_args()
+
+    with open(os.path.join("data", "processed", "chords.json"), "r") as fh:
+        songs = add_start_end_tokens(json.load(fh))
+    _, _, idx_to_chord, sequences, vocab_size = encode_chords(songs, pad=False)
+
+    model_class = ChordLSTM if args.model == "lstm" else baselineRNN
+    model = build_model(model_class, vocab_size)
+    if args.checkpoint:
+        load_checkpoint(args.checkpoint, model)
+    else:
+        # load_models only prints a message if the file is missing, that would export an untrained model
+        path = os.path.join("models", args.model, f"{model_class.__name__}-epoch{args.epoch}.pt")
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} does not exist, check --epoch or pass --checkpoint")
+        if args.model == "lstm":
+            load_models(args.epoch, build_model(baselineRNN, vocab_size), model)
+        else:
+            load_models(args.epoch, model, build_model(ChordLSTM, vocab_size))
+    model.eval()
+
+    output = args.output or os.path.join("models", args.model,
+                                         f"{model_class.__name__}-{'float' if args.no_quantize else 'int8'}.pt")
+    export_model(model, output, idx_to_chord, quantize=not args.no_quantize)
+    print(f"Saved {output} ({os.path.getsize(output)} bytes)")
+
+    if args.check:
+        exported = load_inference_model(output)
+        _, _, test_dataset = split_dataset(ChordDataset(sequences))
+        test_loader = bucket_loader(test_dataset, 64, shuffle=False)
+
+        results = check_quality(model, exported, test_loader, num_songs=args.num_songs)
+        for name, bench_model in [("float", model), ("exported", exported)]:
+            for key, value in benchmark_decoding(bench_model).items():
+                results[f"{name}_{key}"] = value
+        for key, value in results.items():
+            print(f"{key:45}{value:>14.4f}")
+
+
+if __name__ == "__main__":
+    main()
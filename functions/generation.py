@@ -0,0 +1,278 @@
+"""
+Decoding of new chord sequences from a trained ChordLSTM / baselineRNN.
+
+Instead of feeding the whole prefix through the network at every step (O(n^2) for a song of length n), only the newest
+token is fed and the hidden state ((h, c) for the LSTM, h for the RNN) is carried forward.
+
+generate_sequences can sample under a BarConstraint: the position in the bar is tracked for every song and tokens that
+would break the 4/4 bars are masked before sampling, so every song ends with a full bar and has min_bars to max_bars bars:
+
+    constraint = BarConstraint.from_vocab(idx_to_chord, min_bars=8, max_bars=64)
+    generate_sequences(model, 100, 2000, device, constraint=constraint)
+"""
+
+import torch
+import torch.nn as nn
+
+from functions.profiling import NULL_PROFILER
+
+SPECIAL_TOKENS = ["<BOS>", "<EOS>", "pad"]
+RHYTHM_TO_DURATION = {'1': 4, '2.': 3, '2': 2, '4': 1}
+
+
+def _step(model, x, hidden, rnn=False):
+    """Runs one decoding step and returns the logits of the last position (batch_size, vocab_size) and the new hidden state.
+    Models from functions/models.py have a step method, for everything else we fall back to forward with the hidden state."""
+    if hasattr(model, "step"):
+        return model.step(x, hidden)
+
+    if not rnn:
+        output, hidden = model(x, torch.ones(x.size(0), dtype=torch.long), hidden)
+    else:
+        output, hidden = model(x, hidden)
+    return output[:, -1], hidden
+
+
+def generate_sequence(model, start_token, max_length, device, argmax:bool=False, rnn:bool=False, profiler=NULL_PROFILER):
+    """Generates one sequence starting with start_token (usually <BOS> = 1) until <EOS> (2) is sampled or max_length is reached.
+    For a given seed, the sampled sequence is the same as the one of the old full-prefix version, since the random
+    number generator is called in the same order (one multinomial draw per step, also if argmax is used).
+    profiler (functions/profiling.py) counts the songs and generated tokens, rate("tokens", "generate") is tokens/s."""
+    model.eval()
+
+    generated_sequence = [start_token]
+    input_seq = torch.LongTensor([start_token]).unsqueeze(0).to(device)
+    hidden = None
+
+    with torch.no_grad(), profiler.timer("generate"):
+        for _ in range(max_length):
+
+            # only the newest token goes into the model, the rest is in the hidden state
+            logits, hidden = _step(model, input_seq, hidden, rnn)
+
+            # Take the last token's probabilities
+            probabilities = nn.functional.softmax(logits[0], dim=0)
+
+            # Sample a token from the distribution
+            next_token = torch.multinomial(probabilities, 1).item()
+
+            # or use argmax
+            if argmax:
+                next_token = torch.argmax(probabilities).item()
+
+            if next_token == 2:  # Check for <EOS>
+                break
+
+            generated_sequence.append(next_token)
+            input_seq = torch.LongTensor([next_token]).unsqueeze(0).to(device)
+
+    if profiler.enabled:
+        profiler.count("songs")
+        profiler.count("tokens", len(generated_sequence) - 1)
+    return generated_sequence
+
+
+def _filter_logits(logits, temperature=1.0, top_k=None, top_p=None):
+    """Applies temperature, top-k and top-p (nucleus) filtering to a (batch_size, vocab_size) logits tensor. Filtered tokens
+    get -inf, so they have a probability of 0 after the softmax."""
+    if temperature != 1.0:
+        logits = logits / temperature
+
+    if top_k is not None and top_k < logits.size(-1):
+        kth_value = torch.topk(logits, top_k, dim=-1).values[:, -1:]
+        logits = logits.masked_fill(logits < kth_value, float("-inf"))
+
+    if top_p is not None and top_p < 1.0:
+        sorted_logits, sorted_idx = torch.sort(logits, descending=True, dim=-1)
+        cumulative = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+        # remove tokens once the cumulative probability is above top_p, but always keep the most probable one
+        remove = cumulative > top_p
+        remove[:, 1:] = remove[:, :-1].clone()
+        remove[:, 0] = False
+        logits = logits.masked_fill(remove.scatter(1, sorted_idx, remove), float("-inf"))
+
+    return logits
+
+
+def _select_hidden(hidden, idx):
+    """Keeps only the batch rows idx of the hidden state, (h, c) for LSTMs and h for RNNs. The batch is on dim 1."""
+    if isinstance(hidden, tuple):
+        return tuple(h.index_select(1, idx) for h in hidden)
+    return hidden.index_select(1, idx)
+
+
+class BarConstraint:
+    """Masks the tokens that would break the bars of a song. Every token has a duration in beats (1 for the quarter note
+    chords, 1-4 for the run length tokens like "2.C:maj7", 0 for the special tokens). A chord may not go over the next bar
+    line, <EOS> is only allowed at a bar line after min_bars bars and once max_bars bars are full, <EOS> is the only
+    choice. <BOS> and pad are never sampled."""
+
+    def __init__(self, durations, eos_token=2, banned_tokens=(0, 1), beats_per_bar=4, min_bars=1, max_bars=None):
+        if max_bars is not None and max_bars < min_bars:
+            raise ValueError(f"max_bars ({max_bars}) is smaller than min_bars ({min_bars})")
+        self.durations = torch.as_tensor(durations, dtype=torch.long)
+        self.eos_token = eos_token
+        self.banned_tokens = list(banned_tokens)
+        self.beats_per_bar = beats_per_bar
+        self.min_beats = min_bars * beats_per_bar
+        self.max_beats = max_bars * beats_per_bar if max_bars is not None else None
+
+    @classmethod
+    def from_vocab(cls, idx_to_chord, **kwargs):
+        """The durations are read from the tokens, works for both encode_chords modes (runlength or not)."""
+        durations = []
+        for idx in range(len(idx_to_chord)):
+            token = idx_to_chord[idx]
+            if token in SPECIAL_TOKENS:
+                durations.append(0)
+            elif token[0].isdigit():
+                durations.append(RHYTHM_TO_DURATION[token[:2] if token[1] == '.' else token[0]])
+            else:
+                durations.append(1)
+        kwargs.setdefault("eos_token", [idx for idx, token in idx_to_chord.items() if token == "<EOS>"][0])
+        kwargs.setdefault("banned_tokens", [idx for idx, token in idx_to_chord.items() if token in ["<BOS>", "pad"]])
+        return cls(durations, **kwargs)
+
+    def to(self, device):
+        self.durations = self.durations.to(device)
+        return self
+
+    def allowed(self, positions):
+        """(batch_size, vocab_size) bool mask of the tokens that may follow, positions are the beats since the start of
+        every song."""
+        in_bar = (positions % self.beats_per_bar).unsqueeze(1)
+        allowed = in_bar + self.durations.unsqueeze(0) <= self.beats_per_bar
+        if self.max_beats is not None:
+            allowed &= positions.unsqueeze(1) + self.durations.unsqueeze(0) <= self.max_beats
+        allowed[:, self.banned_tokens] = False
+        allowed[:, self.eos_token] = (in_bar.squeeze(1) == 0) & (positions >= self.min_beats)
+        return allowed
+
+    def update(self, positions, tokens):
+        return positions + self.durations[tokens]
+
+
+def generate_sequences(model, num_sequences, max_length, device, batch_size:int=256, temperature:float=1.0, top_k:int=None,
+                       top_p:float=None, start_token:int=1, eos_token:int=2, rnn:bool=False, constraint=None,
+                       generator=None, profiler=NULL_PROFILER):
+    """Generates num_sequences sequences in batches of batch_size. All rows of a batch are decoded in lockstep with one
+    (N, vocab_size) multinomial draw per step. Rows that emit <EOS> are removed from the batch (together with their hidden
+    state), so finished songs cost nothing.
+
+    Returns the same ragged 2D list as calling generate_sequence num_sequences times: every list starts with start_token,
+    <EOS> is not added. This can be passed to map_sequence as before.
+
+    With a BarConstraint, the forbidden tokens are masked before temperature/top-k/top-p. max_length should leave room for
+    max_bars bars, a song that reaches max_length is cut off like without the constraint.
+
+    generator (a torch.Generator on device) is used for the sampling instead of the global random number generator, the
+    songs then only depend on its seed (functions/streaming.py seeds one per chunk of songs).
+
+    profiler times the whole call ("generate") and counts songs and tokens like generate_sequence.
+    """
+    model.eval()
+    sequences = []
+    if constraint is not None:
+        constraint.to(device)
+
+    with torch.no_grad(), profiler.timer("generate"):
+        for batch_start in range(0, num_sequences, batch_size):
+            n = min(batch_size, num_sequences - batch_start)
+            generated = [[start_token] for _ in range(n)]
+
+            # rows[i] is the index (in generated) of the i-th row that is still decoded
+            rows = torch.arange(n, device=device)
+            input_seq = torch.full((n, 1), start_token, dtype=torch.long, device=device)
+            hidden = None
+            # beats since the start of every song, only used with a constraint
+            positions = torch.zeros(n, dtype=torch.long, device=device)
+
+            for _ in range(max_length):
+                logits, hidden = _step(model, input_seq, hidden, rnn)
+                if constraint is not None:
+                    logits = logits.masked_fill(~constraint.allowed(positions), float("-inf"))
+                logits = _filter_logits(logits, temperature, top_k, top_p)
+                next_tokens = torch.multinomial(torch.softmax(logits, dim=-1), 1, generator=generator)
+                if constraint is not None:
+                    positions = constraint.update(positions, next_tokens.squeeze(1))
+
+                # one transfer per step instead of one .item() per song
+                for row, token in zip(rows.tolist(), next_tokens.squeeze(1).tolist()):
+                    if token != eos_token:
+                        generated[row].append(token)
+
+                # mask out and compact the finished rows
+                alive = next_tokens.squeeze(1) != eos_token
+                if not alive.all():
+                    keep = alive.nonzero().squeeze(1)
+                    if keep.numel() == 0:
+                        break
+                    rows = rows.index_select(0, keep)
+                    next_tokens = next_tokens.index_select(0, keep)
+                    positions = positions.index_select(0, keep)
+                    hidden = _select_hidden(hidden, keep)
+
+                input_seq = next_tokens
+
+            sequences.extend(generated)
+
+    if profiler.enabled:
+        profiler.count("songs", len(sequences))
+        profiler.count("tokens", sum(len(sequence) - 1 for sequence in sequences))
+    return sequences
+
+
+def generate_batch(model, prefixes, max_lengths, temperatures, device, eos_token:int=2, banned_tokens=(0, 1)):
+    """Decodes songs that each have their own prefix, max_length and temperature in one batch (used by
+    functions/service.py to serve several requests together). banned_tokens (pad and <BOS>) are never sampled.
+
+    prefixes are lists of token ids that start with <BOS>. The prefix tokens are fed in lockstep like sampled ones, a row
+    only starts sampling after its prefix (the multinomial draw of the earlier steps is ignored). A row ends at <EOS> or
+    once it has max_length tokens after <BOS> (the prefix counts). Returns the songs like generate_sequences (with the prefix, without <EOS>).
+    """
+    model.eval()
+    n = len(prefixes)
+    # the prefix tokens after <BOS> are appended when they are fed
+    generated = [prefix[:1] for prefix in prefixes]
+    if n == 0:
+        return generated
+
+    # prefix tokens still to force per row and step, -1 where the row samples
+    forced = torch.full((n, max(len(prefix) for prefix in prefixes)), -1, dtype=torch.long)
+    for row, prefix in enumerate(prefixes):
+        forced[row, :len(prefix)] = torch.tensor(prefix)
+    forced = forced.to(device)
+    limits = torch.tensor(max_lengths, device=device)
+    temperatures = torch.tensor(temperatures, dtype=torch.float, device=device).unsqueeze(1)
+
+    with torch.no_grad():
+        rows = torch.arange(n, device=device)
+        input_seq = forced[:, :1]
+        hidden = None
+
+        for t in range(1, int(limits.max()) + 1):
+            logits, hidden = _step(model, input_seq, hidden)
+            logits[:, list(banned_tokens)] = float("-inf")
+            sampled = torch.multinomial(torch.softmax(logits / temperatures, dim=-1), 1).squeeze(1)
+            forced_t = forced[:, t] if t < forced.size(1) else torch.full_like(sampled, -1)
+            next_tokens = torch.where(forced_t >= 0, forced_t, sampled)
+
+            # a row is done if it sampled <EOS> or reached its length
+            eos = (forced_t < 0) & (next_tokens == eos_token)
+            for row, token, is_eos in zip(rows.tolist(), next_tokens.tolist(), eos.tolist()):
+                if not is_eos:
+                    generated[row].append(token)
+
+            alive = ~eos & (limits > t)
+            if not alive.all():
+                keep = alive.nonzero().squeeze(1)
+                if keep.numel() == 0:
+                    break
+                rows, next_tokens, hidden = rows.index_select(0, keep), next_tokens.index_select(0, keep), \
+                    _select_hidden(hidden, keep)
+                forced, limits, temperatures = forced.index_select(0, keep), limits.index_select(0, keep), \
+                    temperatures.index_select(0, keep)
+
+            input_seq = next_tokens.unsqueeze(1)
+
+    return generated
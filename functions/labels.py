@@ -13,13 +13,17 @@ PITCH_CLASS_NAMES = ["C", "Db", "D", "Eb", "E", "F", "F#", "G", "Ab", "A", "Bb",
 N_PITCH_CLASSES = len(PITCH_CLASS_NAMES)
 DEGREES = ['I', 'IIb', 'II', 'IIIb', 'III', 'IV', 'Vb', 'V', 'VIb', 'VI', 'VIIb', 'VII']
 PITCHES = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
-ALT = {'b': -1, '#': 1}
+# '-' is the flat in the kern notation (E- = Eb), which is what ChordSimplifier produces
+ALT = {'b': -1, '#': 1, '-': -1}
 SHORTCUTS = {'maj': '(3,5)', 'min': '(b3,5)', 'dim': '(b3,b5)', 'aug': '(3,#5)', 'maj7': '(3,5,7)',
              'min7': '(b3,5,b7)', '7': '(3,5,b7)', 'dim7': '(b3,b5,bb7)', 'hdim7': '(b3,b5,b7)',
              'minmaj7': '(b3,5,7)', 'maj6': '(3,5,6)', 'min6': '(b3,5,6)', '9': '(3,5,b7,9)',
              'maj9': '(3,5,7,9)', 'min9': '(b3,5,b7,9)', 'sus4': '(4,5)'}
 UNCLASSIFIED = 'unclassified'
 NO_CHORD = 'N'
+BRACKETS = re.compile(r"[\(\)]")
+# SHORTCUTS parsed to degree sets once, instead of on every call
+SHORTCUT_DEGREES = {kind: frozenset(BRACKETS.sub("", degrees).split(',')) for kind, degrees in SHORTCUTS.items()}
 
 
 class LabelTranslator:
@@ -50,6 +54,40 @@ def note_to_number(note):
     return pitch
 
 
+def label_to_pitch_and_degrees(label):
+    """Parses a label into its pitch and degree set. Returns None as degrees for no chord (N)."""
+    parts_and_bass = label.split('/')
+    parts = parts_and_bass[0].split(':')
+    note = parts[0]
+    if note[0] == 'N':
+        return 9, None
+    pitch = note_to_number(note)
+    if len(parts) == 1:
+        kind = 'maj'
+    else:
+        kind = parts[1].split('/')[0]
+    if kind in SHORTCUT_DEGREES:
+        degrees = set(SHORTCUT_DEGREES[kind])
+    else:
+        degrees = set(BRACKETS.sub("", kind).split(','))
+    # TODO after the dataset is fixed (bass -> pitch class set).
+    if len(parts_and_bass) > 1:
+        degrees.add(parts_and_bass[1])
+    return pitch, degrees
+
+
+def build_label_table(translator):
+    """Precomputes label -> (pitch, kind) for every root (natural, b, #, -) and every kind in SHORTCUTS (and no kind).
+    Labels that are not in the table (e.g. slash chords) are computed and added on first use."""
+    table = {}
+    for letter in PITCHES:
+        for alt in ['', 'b', '#', '-']:
+            for kind in [None] + list(SHORTCUTS):
+                label = letter + alt + ('' if kind is None else ':' + kind)
+                table[label] = translator.parse_label(label)
+    return table
+
+
 JAZZ5_KINDS = ["maj", "min", "dom", "hdim7", "dim"]
 JAZZ5_MIREX_KINDS = ["", ":min", ":7", ":hdim7", ":dim"]
 JAZZ5_NAMES = np.empty(60, dtype='object')
@@ -75,23 +113,20 @@ class Jazz5LabelTranslator(LabelTranslator):
     def chord_kinds(self):
         return JAZZ5_KINDS
 
+    # filled after the class definition, label -> (pitch, kind)
+    LABEL_TABLE = {}
+
     def label_to_pitch_and_kind(self, label):
-        parts_and_bass = label.split('/')
-        parts = parts_and_bass[0].split(':')
-        note = parts[0]
-        if note[0] == 'N':
+        result = self.LABEL_TABLE.get(label)
+        if result is None:
+            result = self.parse_label(label)
+            self.LABEL_TABLE[label] = result
+        return result
+
+    def parse_label(self, label):
+        pitch, degrees = label_to_pitch_and_degrees(label)
+        if degrees is None:
             return 9, UNCLASSIFIED
-        pitch = note_to_number(note)
-        if len(parts) == 1:
-            kind = 'maj'
-        else:
-            kind = parts[1].split('/')[0]
-        if kind in SHORTCUTS:
-            kind = SHORTCUTS[kind]
-        degrees = set(re.sub("[\(\)]", "", kind).split(','))
-        # TODO after the dataset is fixed (bass -> pitch class set).
-        if len(parts_and_bass) > 1:
-            degrees.add(parts_and_bass[1])
         if '3' in degrees:
             if 'b7' in degrees:
                 kind = 'dom'
@@ -110,6 +145,9 @@ class Jazz5LabelTranslator(LabelTranslator):
         return pitch, kind
 
 
+Jazz5LabelTranslator.LABEL_TABLE = build_label_table(Jazz5LabelTranslator())
+
+
 MAJ_MIN_KINDS = ['maj', 'min']
 MAJ_MIN_MIREX_KINDS = ['', ':min']
 MAJ_MIN_NAMES = np.empty(24, dtype='object')
@@ -137,25 +175,20 @@ class MajMinLabelTranslator(LabelTranslator):
     def chords_number(self):
         return len(MAJ_MIN_NAMES)
 
+    # filled after the class definition, label -> (pitch, kind)
+    LABEL_TABLE = {}
+
     def label_to_pitch_and_kind(self, label):
-        parts_and_bass = label.split('/')
-        parts = parts_and_bass[0].split(':')
-        note = parts[0]
-        if note[0] == 'N':
+        result = self.LABEL_TABLE.get(label)
+        if result is None:
+            result = self.parse_label(label)
+            self.LABEL_TABLE[label] = result
+        return result
+
+    def parse_label(self, label):
+        pitch, degrees = label_to_pitch_and_degrees(label)
+        if degrees is None:
             return 9, 'unclassified'
-        pitch = note_to_number(note)
-        if len(parts) == 1:
-            kind = 'maj'
-        else:
-            kind = parts[1].split('/')[0]
-        if kind in SHORTCUTS:
-            kind = SHORTCUTS[kind]
-        degrees = set(re.sub("[\(\)]", "", kind).split(','))
-        # TODO after the dataset is fixed (bass -> pitch class set).
-        if len(parts_and_bass) > 1:
-            degrees.add(parts_and_bass[1])
-        if len(parts_and_bass) > 1:
-            degrees.add(parts_and_bass[1])
         if degrees == self.MAJ_DEGREES:
             kind = 'maj'
         elif degrees == self.MIN_DEGREES:
@@ -165,6 +198,9 @@ class MajMinLabelTranslator(LabelTranslator):
         return pitch, kind
 
 
+MajMinLabelTranslator.LABEL_TABLE = build_label_table(MajMinLabelTranslator())
+
+
 class PitchedPattern:
     def __init__(self, kind, pitch_class=None, pitch_class_index=0):
         self.kind = kind
@@ -187,28 +223,76 @@ def degree_indices(degree_name_list):
     return [DEGREES.index(e) for e in degree_name_list]
 
 
+MINOR_SUFFIX = re.compile('m$')
+ENHARMONICS = {'Gb': 'F#', 'A#': 'Bb', 'C#': 'Db', 'D#': 'Eb', 'G#': 'Ab'}
+ENHARMONIC_PATTERN = re.compile('|'.join(ENHARMONICS))
+
+
 def convert_chord_labels(syms):
     # "minor" to Harte syntax, resolve enharmonicity in "jazz" style.
-    res = [re.sub('m$', ':min', s) for s in syms]
-    res = [re.sub('Gb', 'F#', s) for s in res]
-    res = [re.sub('A#', 'Bb', s) for s in res]
-    res = [re.sub('C#', 'Db', s) for s in res]
-    res = [re.sub('D#', 'Eb', s) for s in res]
-    res = [re.sub('G#', 'Ab', s) for s in res]
+    # None of the replacements can create a match for another one, so one pass over all of them is enough
+    res = [MINOR_SUFFIX.sub(':min', s) for s in syms]
+    res = [ENHARMONIC_PATTERN.sub(lambda m: ENHARMONICS[m.group(0)], s) for s in res]
     return res
 
 
 # addition by me
+def _translate_label(translator, label):
+    pitch, kind = translator.label_to_pitch_and_kind(label)
+    if kind in translator.chord_kinds():
+        idx = translator.chord_kinds().index(kind)
+        return PITCH_CLASS_NAMES[pitch] + translator.chord_mirex_kinds()[idx]
+    return "unclassified"
+
+
+def _build_translation_table(translator):
+    table = {}
+    for label in translator.LABEL_TABLE:
+        try:
+            table[label] = _translate_label(translator, label)
+        except IndexError:
+            # e.g. B# has the pitch 12, this still raises like before when it is translated
+            pass
+    return table
+
+
+JAZZ5_TRANSLATOR = Jazz5LabelTranslator()
+JAZZ5_TRANSLATIONS = _build_translation_table(JAZZ5_TRANSLATOR)
+
+
 def translate_chords(chords):
-    translator = Jazz5LabelTranslator()
-    
     translated_chords = []
     for chord in chords:
-        pitch, kind = translator.label_to_pitch_and_kind(chord)
-        if kind in translator.chord_kinds():
-            idx = translator.chord_kinds().index(kind)
-            translated_chords.append(PITCH_CLASS_NAMES[pitch] + JAZZ5_MIREX_KINDS[idx])
-        else:
-            translated_chords.append("unclassified")
-    
+        translated = JAZZ5_TRANSLATIONS.get(chord)
+        if translated is None:
+            translated = _translate_label(JAZZ5_TRANSLATOR, chord)
+            JAZZ5_TRANSLATIONS[chord] = translated
+        translated_chords.append(translated)
+
     return translated_chords
+
+
+def chords_to_pitch_and_kind(chords, translator=JAZZ5_TRANSLATOR):
+    """Translates a list of chord labels into two integer arrays: the pitch class index (0-11, into PITCH_CLASS_NAMES)
+    and the kind index (into translator.chord_kinds(), -1 for unclassified). Every distinct label is only looked up once."""
+    kind_index = {kind: i for i, kind in enumerate(translator.chord_kinds())}
+    unique = {}
+    ids = np.fromiter((unique.setdefault(chord, len(unique)) for chord in chords), dtype=np.int64, count=len(chords))
+
+    pitch_table = np.empty(len(unique), dtype=np.int8)
+    kind_table = np.empty(len(unique), dtype=np.int8)
+    for chord, i in unique.items():
+        pitch, kind = translator.label_to_pitch_and_kind(chord)
+        pitch_table[i] = pitch % N_PITCH_CLASSES
+        kind_table[i] = kind_index.get(kind, -1)
+
+    return pitch_table[ids], kind_table[ids]
+
+
+def corpus_to_pitch_and_kind(songs, translator=JAZZ5_TRANSLATOR):
+    """Same as chords_to_pitch_and_kind for a whole corpus (2d list). Returns the flat pitch and kind arrays of all songs
+    and the offsets, song i is pitches[offsets[i]:offsets[i + 1]]."""
+    offsets = np.zeros(len(songs) + 1, dtype=np.int64)
+    np.cumsum([len(song) for song in songs], out=offsets[1:])
+    pitches, kinds = chords_to_pitch_and_kind([chord for song in songs for chord in song], translator)
+    return pitches, kinds, offsets
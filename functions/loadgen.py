@@ -0,0 +1,81 @@
+"""
+Load generator for functions/service.py. Sends requests from concurrency parallel clients and reports the latency and
+songs/s seen by the clients, followed by the /metrics of the service.
+
+    python -m functions.loadgen --concurrency 32 --requests 500 --num-songs 1 --max-length 200
+"""
+
+import json
+import time
+import asyncio
+import argparse
+
+import numpy as np
+
+
+async def request(host, port, method, path, payload=None):
+    """Sends one HTTP request and returns (status, JSON body)."""
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+
+    head, _, data = response.partition(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    return status, json.loads(data)
+
+
+async def run(host, port, concurrency, num_requests, payload):
+    latencies = []
+    errors = 0
+    remaining = iter(range(num_requests))
+
+    async def client():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            status, _ = await request(host, port, "POST", "/generate", payload)
+            latencies.append(time.perf_counter() - start)
+            errors += status != 200
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    _, server_metrics = await request(host, port, "GET", "/metrics")
+    return {
+        "requests": num_requests,
+        "errors": errors,
+        "seconds": seconds,
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p99_ms": float(np.percentile(latencies, 99)),
+        "requests_per_second": num_requests / seconds,
+        "songs_per_second": num_requests * payload["num_songs"] / seconds,
+        "server": server_metrics,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the generation service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--num-songs", type=int, default=1, help="songs per request")
+    parser.add_argument("--max-length", type=int, default=200)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--format", default="chords")
+    args = parser.parse_args()
+
+    payload = {"num_songs": args.num_songs, "max_length": args.max_length, "temperature": args.temperature,
+               "format": args.format}
+    results = asyncio.run(run(args.host, args.port, args.concurrency, args.requests, payload))
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
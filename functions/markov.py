@@ -0,0 +1,260 @@
+"""
+Training free baseline: an order k Markov chain over the tokens of encode_chords.
+
+The next token only depends on the last k - 1 tokens (the context). The model is a table of counts per context order
+(0 to k - 1 tokens), built from the encoded corpus in one pass with np.unique / np.bincount. The counts of orders 1 and 2
+are dense arrays ((vocab_size,) and (vocab_size, vocab_size)), from order 3 on only the contexts that occur are stored,
+as a scipy sparse matrix (one row per context).
+
+Unseen continuations get a probability by interpolated absolute discounting: discount is taken from every count of a
+context and given to the distribution of the next shorter context, down to a uniform distribution over all tokens that
+may be sampled (not pad and <BOS>). A context that never occurred backs off to the shorter one completely.
+
+    model = MarkovModel(order=3).fit(sequences)        # sequences of encode_chords(..., pad=False), with <BOS>/<EOS>
+    songs = model.generate(933, 2000, seed=1)          # like generate_sequences: [<BOS>, ...] without <EOS>
+    LSTM_like = [map_sequence(seq, ignore_tokens=False)[1:] for seq in songs]
+
+All songs are sampled in lockstep: one (batch, vocab_size) distribution per step (one sparse row lookup per order), one
+inverse CDF draw, finished songs are removed from the batch. evaluate returns the (loss, accuracy) per token of
+functions/training.py, so the baseline can be compared with the test loss of the networks:
+
+    python -m functions.markov --order 3 --num-songs 933 --output outputs/sequences/markov3.json
+"""
+
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+from scipy import sparse
+
+from functions.metrics import to_arrays, song_ids
+
+# orders up to this are stored as dense arrays
+DENSE_ORDERS = 2
+
+
+def _to_arrays(sequences, pad_token=0):
+    """(tokens, offsets) of token id sequences (lists, numpy arrays or tensors, padded ones as well)."""
+    if isinstance(sequences, tuple):
+        return sequences
+    sequences = [np.asarray(sequence) for sequence in sequences]
+    return to_arrays([sequence[sequence != pad_token] for sequence in sequences])
+
+
+class _Counts:
+    """Counts of the next token for every context of one order."""
+
+    def __init__(self, context_codes, targets, vocab_size, n_contexts):
+        if n_contexts is not None:
+            # dense, the context code is the row
+            counts = np.bincount(context_codes * vocab_size + targets, minlength=n_contexts * vocab_size)
+            self.counts = counts.reshape(n_contexts, vocab_size).astype(np.float64)
+            self.contexts = None
+            self.totals = self.counts.sum(axis=1)
+            self.distinct = (self.counts > 0).sum(axis=1)
+        else:
+            pairs, counts = np.unique(context_codes * vocab_size + targets, return_counts=True)
+            self.contexts, rows = np.unique(pairs // vocab_size, return_inverse=True)
+            self.counts = sparse.csr_matrix((counts.astype(np.float64), (rows, pairs % vocab_size)),
+                                            shape=(len(self.contexts), vocab_size))
+            self.totals = np.asarray(self.counts.sum(axis=1)).ravel()
+            self.distinct = np.diff(self.counts.indptr)
+
+    def lookup(self, codes):
+        """(found, row index, dense counts of the found rows) for the context codes of a batch."""
+        if self.contexts is None:
+            rows = codes
+            found = self.totals[rows] > 0
+            return found, rows[found], self.counts[rows[found]]
+        rows = np.minimum(np.searchsorted(self.contexts, codes), len(self.contexts) - 1)
+        found = self.contexts[rows] == codes
+        return found, rows[found], self.counts[rows[found]].toarray()
+
+    @property
+    def n_contexts(self):
+        return len(self.totals)
+
+
+class MarkovModel:
+    """Order k Markov chain (k - 1 tokens of context) with interpolated absolute discounting.
+
+    - order: k, 1 samples every token from the corpus distribution.
+    - discount: subtracted from every count (0 - 1), the higher, the more probability goes to the shorter contexts.
+    - banned_tokens: never sampled (pad and <BOS>).
+    """
+
+    def __init__(self, order=3, discount=0.75, bos_token=1, eos_token=2, banned_tokens=(0, 1)):
+        if order < 1:
+            raise ValueError(f"order has to be at least 1, got {order}")
+        if not 0 < discount < 1:
+            raise ValueError(f"discount has to be between 0 and 1, got {discount}")
+        self.order = order
+        self.discount = discount
+        self.bos_token = bos_token
+        self.eos_token = eos_token
+        self.banned_tokens = list(banned_tokens)
+        self.tables = None
+
+    def _codes(self, history, length):
+        """Context codes of the last length tokens of every row of history (the oldest token first)."""
+        codes = np.zeros(len(history), dtype=np.int64)
+        for column in range(history.shape[1] - length, history.shape[1]):
+            codes = codes * self.vocab_size + history[:, column]
+        return codes
+
+    def _histories(self, tokens, offsets):
+        """For every token except the first (<BOS>) of a song: the order - 1 tokens before it, filled up with <BOS> at
+        the start of the song. Returns (histories, targets)."""
+        starts = offsets[:-1][song_ids(offsets)]
+        positions = np.flatnonzero(np.arange(len(tokens)) > starts)
+        history = np.full((len(positions), self.order - 1), self.bos_token, dtype=np.int64)
+        for lag in range(1, self.order):
+            previous = positions - lag
+            valid = previous >= starts[positions]
+            history[valid, self.order - 1 - lag] = tokens[previous[valid]]
+        return history, tokens[positions]
+
+    def fit(self, sequences, vocab_size=None):
+        """Counts the transitions of sequences (token ids with <BOS> and <EOS>, e.g. the sequences of encode_chords,
+        padded or not, or a (tokens, offsets) tuple). Returns self."""
+        tokens, offsets = _to_arrays(sequences)
+        self.vocab_size = vocab_size or int(tokens.max()) + 1
+        if self.vocab_size ** self.order >= 2 ** 63:
+            raise ValueError(f"order {self.order} is too large for a vocab of {self.vocab_size} tokens")
+
+        history, targets = self._histories(tokens, offsets)
+        self.tables = []
+        for length in range(self.order):
+            n_contexts = self.vocab_size ** length if length < DENSE_ORDERS else None
+            self.tables.append(_Counts(self._codes(history, length), targets, self.vocab_size, n_contexts))
+
+        self.uniform = np.ones(self.vocab_size)
+        self.uniform[self.banned_tokens] = 0
+        self.uniform /= self.uniform.sum()
+        return self
+
+    def probabilities(self, history):
+        """(N, vocab_size) distributions of the next token for N rows of the last order - 1 tokens (oldest first)."""
+        p = np.tile(self.uniform, (len(history), 1))
+        for length, table in enumerate(self.tables):
+            found, rows, counts = table.lookup(self._codes(history, length))
+            totals = table.totals[rows][:, None]
+            backoff = self.discount * table.distinct[rows][:, None] / totals
+            p[found] = np.maximum(counts - self.discount, 0) / totals + backoff * p[found]
+        return p
+
+    def generate(self, num_sequences, max_length, temperature=1.0, seed=None, batch_size=4096):
+        """Samples num_sequences songs like generate_sequences: every list starts with <BOS>, <EOS> is not added, at most
+        max_length tokens are sampled."""
+        rng = np.random.default_rng(seed)
+        sequences = []
+        for batch_start in range(0, num_sequences, batch_size):
+            n = min(batch_size, num_sequences - batch_start)
+            # the sampled tokens are written into one array, every song ends at its length
+            generated = np.full((n, max_length + 1), self.bos_token, dtype=np.int32)
+            lengths = np.full(n, max_length + 1)
+            rows = np.arange(n)
+            history = np.full((n, self.order - 1), self.bos_token, dtype=np.int64)
+
+            for step in range(1, max_length + 1):
+                p = self.probabilities(history)
+                if temperature != 1.0:
+                    p = p ** (1 / temperature)
+                cdf = p.cumsum(axis=1)
+                draws = rng.random(len(rows)) * cdf[:, -1]
+                next_tokens = np.minimum((cdf <= draws[:, None]).sum(axis=1), self.vocab_size - 1)
+                generated[rows, step] = next_tokens
+
+                alive = next_tokens != self.eos_token
+                if not alive.all():
+                    lengths[rows[~alive]] = step
+                    if not alive.any():
+                        break
+                    rows, history, next_tokens = rows[alive], history[alive], next_tokens[alive]
+                history = np.concatenate([history[:, 1:], next_tokens[:, None]], axis=1)
+
+            sequences.extend(song[:length].tolist() for song, length in zip(generated, lengths))
+        return sequences
+
+    def evaluate(self, sequences, batch_size=65536):
+        """(loss, accuracy) per token like evaluate of functions/training.py: mean negative log likelihood and share of
+        tokens that are the most probable one, over every token after <BOS> (including <EOS>)."""
+        tokens, offsets = _to_arrays(sequences)
+        history, targets = self._histories(tokens, offsets)
+        loss, correct = 0.0, 0
+        for start in range(0, len(targets), batch_size):
+            p = self.probabilities(history[start:start + batch_size])
+            target = targets[start:start + batch_size]
+            loss -= np.log(p[np.arange(len(target)), target]).sum()
+            correct += int((p.argmax(axis=1) == target).sum())
+        return float(loss / len(targets)), correct / len(targets)
+
+    def summary(self):
+        """Number of contexts and stored counts per context length."""
+        return [{"context": length, "contexts": table.n_contexts,
+                 "counts": int(table.counts.nnz if table.contexts is not None else (table.counts > 0).sum())}
+                for length, table in enumerate(self.tables)]
+
+
+def main():
+    from functions.utils import encode_chords, add_start_end_tokens, expand_runlength
+    from functions.data import ChordDataset
+    from functions.training import split_dataset
+    from functions.metrics import evaluate_sets
+
+    parser = argparse.ArgumentParser(description="Order k Markov chain baseline, fitted and sampled in seconds")
+    parser.add_argument("--data", default=os.path.join("data", "processed", "chords.json"))
+    parser.add_argument("--orders", type=int, nargs="+", default=[1, 2, 3, 4, 5], help="orders that are evaluated")
+    parser.add_argument("--order", type=int, default=3, help="order of the generated songs")
+    parser.add_argument("--discount", type=float, default=0.75)
+    parser.add_argument("--runlength", action="store_true", help="use (duration, chord) tokens")
+    parser.add_argument("--num-songs", type=int, default=933)
+    parser.add_argument("--max-length", type=int, default=2000)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="JSON file of the generated songs (like save_sequences_to_json)")
+    args = parser.parse_args()
+
+    with open(args.data, "r") as fh:
+        songs = json.load(fh)
+    _, _, idx_to_chord, sequences, vocab_size = encode_chords(add_start_end_tokens(songs), pad=False,
+                                                              runlength=args.runlength)
+    # the split of the networks, the test loss is comparable with evaluate of functions/training.py
+    train, val, test = split_dataset(ChordDataset(sequences))
+    train_sequences = [sequences[i] for i in train.indices]
+    print(f"{'order':>5}{'fit s':>10}{'contexts':>12}{'val loss':>10}{'test loss':>11}{'test acc':>10}")
+    for order in sorted(set(args.orders) | {args.order}):
+        start = time.perf_counter()
+        model = MarkovModel(order, args.discount).fit(train_sequences, vocab_size)
+        seconds = time.perf_counter() - start
+        val_loss, _ = model.evaluate([sequences[i] for i in val.indices])
+        test_loss, test_accuracy = model.evaluate([sequences[i] for i in test.indices])
+        contexts = sum(table.n_contexts for table in model.tables)
+        print(f"{order:>5}{seconds:>10.3f}{contexts:>12}{val_loss:>10.4f}{test_loss:>11.4f}{test_accuracy:>10.4f}")
+
+    model = MarkovModel(args.order, args.discount).fit(train_sequences, vocab_size)
+    start = time.perf_counter()
+    generated = model.generate(args.num_songs, args.max_length, args.temperature, seed=args.seed)
+    seconds = time.perf_counter() - start
+    print(f"Sampled {len(generated)} songs in {seconds:.2f}s ({len(generated) / seconds:.0f} songs/s)")
+
+    # like map_sequence without <BOS>, back to one chord per quarter note for the metrics and the MIDI export
+    chords = [[idx_to_chord[token] for token in sequence[1:]] for sequence in generated]
+    if args.runlength:
+        chords = [expand_runlength(song) for song in chords]
+        _, _, idx_to_chord, _, _ = encode_chords(add_start_end_tokens(songs), pad=False)
+    metrics = evaluate_sets({"original": songs, "markov": chords}, idx_to_chord)["markov"]
+    print(f"similarity {metrics['similarity']:.4f}, avg length {metrics['avg_length']:.1f}, "
+          f"fits time signature {metrics['fits_time_signature']:.3f}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as fh:
+            json.dump(chords, fh)
+        print(f"Saved sequences to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+Evaluation metrics of Models.ipynb / Statistics.ipynb on integer token arrays.
+
+All songs of a set are kept as one flat token array plus the song offsets (like functions/tokens.py). Every metric is then
+a bincount, a lookup table or a vectorized comparison instead of a Python loop over nested string lists:
+
+    lengths                      np.diff(offsets)
+    chord distribution / pads    np.bincount(tokens)
+    chord classes                class_table[tokens] (token -> class, built once from the vocab)
+    merge_chords                 a table over the equality pattern of the 4 chords of a bar
+    progressions / transitions   n-grams encoded as one integer, np.unique / np.bincount
+    fits_in_time_signature       cumulative durations per song
+
+evaluate_sets computes everything for several sets (original, LSTM, RNN) at once:
+
+    results = evaluate_sets({"original": all_chords_notoken, "lstm": lstm_ids, "rnn": rnn_ids}, idx_to_chord)
+
+The songs can be lists of chord strings or lists of token ids (e.g. directly from generate_sequences, without <BOS>).
+"""
+
+import array
+import itertools
+
+import numpy as np
+from scipy.spatial.distance import jensenshannon
+
+CHORD_CLASSES = {
+    ':7': "Dominant 7",
+    ':maj7': "Major 7",
+    ':min7': "Minor 7",
+    'min': "Minor Triad",
+    'maj': "Major Triad",
+    'hdim7': "Half-Diminished 7",
+    'dim7': "Diminished 7",
+}
+SPECIAL_TOKENS = ["pad", "<BOS>", "<EOS>"]
+# merge_chords notation, duration in quarter notes
+RHYTHM_TO_DURATION = {'1': 4, '2.': 3, '2': 2, '4': 1}
+DURATION_TO_RHYTHM = {duration: rhythm for rhythm, duration in RHYTHM_TO_DURATION.items()}
+
+
+def to_arrays(songs, chord_to_idx=None):
+    """Returns (tokens, offsets) for a list of songs. Songs of chord strings are encoded with chord_to_idx. A
+    (tokens, offsets) tuple is returned as it is. songs can also be an iterator (e.g. iter_songs of
+    functions/streaming.py), it is read once and every song is encoded right away."""
+    if isinstance(songs, tuple):
+        return songs
+    lengths = []
+    flat = array.array("q")
+    for song in songs:
+        lengths.append(len(song))
+        if len(song) and isinstance(song[0], str):
+            song = [chord_to_idx[chord] for chord in song]
+        flat.extend(song)
+
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return np.frombuffer(flat, dtype=np.int64).copy(), offsets
+
+
+def song_ids(offsets):
+    """The song index of every token."""
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def length_stats(offsets):
+    """The values of analyze_chord_progressions (total_songs, avg_length, min_length, max_length, median_length,
+    mode_length) as a dict, plus the number of short songs (< 4 chords)."""
+    lengths = np.diff(offsets)
+    # like the old code: the median is an int for an odd number of songs, the modes are in the order they first occur
+    sorted_lengths = np.sort(lengths)
+    middle = len(lengths) // 2
+    if len(lengths) % 2 == 0:
+        median_length = (int(sorted_lengths[middle - 1]) + int(sorted_lengths[middle])) / 2
+    else:
+        median_length = int(sorted_lengths[middle])
+    values, first, counts = np.unique(lengths, return_index=True, return_counts=True)
+    modes = counts == counts.max()
+    return {
+        "total_songs": len(lengths),
+        "avg_length": float(lengths.mean()),
+        "min_length": int(lengths.min()),
+        "max_length": int(lengths.max()),
+        "median_length": median_length,
+        "mode_length": values[modes][np.argsort(first[modes])].tolist(),
+        "short_songs": int((lengths < 4).sum()),
+    }
+
+
+def js_similarity(counts_a, counts_b):
+    """1 - Jensen-Shannon distance of two count vectors (chord_distribution_similarity of Models.ipynb)."""
+    return 1 - jensenshannon(counts_a / counts_a.sum(), counts_b / counts_b.sum())
+
+
+def chord_class_table(idx_to_chord, chord_classes=CHORD_CLASSES):
+    """Token -> index into chord_classes (the first suffix found in the chord, like percentage_of_chord_classes). -1 for
+    the special tokens and for chords without a class."""
+    table = np.full(len(idx_to_chord), -1, dtype=np.int64)
+    suffixes = list(chord_classes)
+    for idx, chord in idx_to_chord.items():
+        if chord in SPECIAL_TOKENS:
+            continue
+        for class_idx, suffix in enumerate(suffixes):
+            if suffix in chord:
+                table[idx] = class_idx
+                break
+    return table
+
+
+def chord_class_percentages(counts, class_table, chord_classes=CHORD_CLASSES, special_idx=(0, 1, 2)):
+    """percentage_of_chord_classes from the token counts: percent of every class of all non special tokens."""
+    total = counts.sum() - counts[list(special_idx)].sum()
+    has_class = class_table >= 0
+    class_counts = np.bincount(class_table[has_class], weights=counts[has_class], minlength=len(chord_classes))
+    return {name: float(count / total * 100) for name, count in zip(chord_classes.values(), class_counts)}
+
+
+def _merge_bar(bar):
+    """The loop of merge_chords for one bar, returns (position in the bar, duration) of every merged chord."""
+    merged = []
+    j = 0
+    while j < len(bar):
+        count = bar[j:].count(bar[j])
+        duration = max([d for d in RHYTHM_TO_DURATION.values() if d <= count])
+        merged.append((j, duration))
+        j += duration
+    return merged
+
+
+def _bar_keys(bars, bar_lengths):
+    """The key of the equality pattern of every bar (rows of 4 tokens, missing ones < 0 and all different)."""
+    t0, t1, t2, t3 = bars.T
+    bits = (t1 == t0) | (t2 == t0) << 1 | (t2 == t1) << 2 | (t3 == t0) << 3 | (t3 == t1) << 4 | (t3 == t2) << 5
+    return (bar_lengths - 1) * 64 + bits
+
+
+def _build_merge_tables():
+    """merge_chords only depends on which chords of a bar are equal, so it is run once for every pattern (all bars of
+    1-4 chords) and the results are stored by pattern key."""
+    positions = np.full((4 * 64, 4), -1, dtype=np.int64)
+    durations = np.zeros((4 * 64, 4), dtype=np.int64)
+    for length in range(1, 5):
+        for pattern in itertools.product(range(length), repeat=length):
+            bar = np.full((1, 4), -1, dtype=np.int64)
+            bar[0, :] = -np.arange(1, 5)
+            bar[0, :length] = pattern
+            key = _bar_keys(bar, np.array([length]))[0]
+            for k, (position, duration) in enumerate(_merge_bar(list(pattern))):
+                positions[key, k] = position
+                durations[key, k] = duration
+    return positions, durations
+
+
+MERGE_POSITIONS, MERGE_DURATIONS = _build_merge_tables()
+
+
+def merge_arrays(tokens, offsets):
+    """merge_chords for all songs at once. Returns (tokens, durations, offsets) of the merged songs, the chords of the
+    merged notation are tokens[i] with the duration durations[i] (in quarter notes)."""
+    lengths = np.diff(offsets)
+    n_bars = (lengths + 3) // 4
+    bar_song = np.repeat(np.arange(len(lengths)), n_bars)
+    bar_idx = np.arange(n_bars.sum()) - np.repeat(np.cumsum(n_bars) - n_bars, n_bars)
+    bar_start = offsets[:-1][bar_song] + 4 * bar_idx
+    bar_lengths = np.minimum(4, offsets[1:][bar_song] - bar_start)
+
+    index = bar_start[:, None] + np.arange(4)
+    present = np.arange(4) < bar_lengths[:, None]
+    bars = np.where(present, tokens[np.minimum(index, len(tokens) - 1)], -np.arange(1, 5))
+
+    keys = _bar_keys(bars, bar_lengths)
+    positions = MERGE_POSITIONS[keys]
+    valid = positions >= 0
+    merged_tokens = tokens[(bar_start[:, None] + positions)[valid]]
+    merged_durations = MERGE_DURATIONS[keys][valid]
+
+    merged_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(bar_song, weights=valid.sum(axis=1), minlength=len(lengths)).astype(np.int64),
+              out=merged_offsets[1:])
+    return merged_tokens, merged_durations, merged_offsets
+
+
+def ngram_codes(tokens, offsets, n, vocab_size):
+    """Every n-gram inside a song as one integer (base vocab_size), in order."""
+    if len(tokens) < n:
+        return np.zeros(0, dtype=np.int64)
+    ids = song_ids(offsets)
+    windows = len(tokens) - n + 1
+    codes = np.zeros(windows, dtype=np.int64)
+    for k in range(n):
+        codes = codes * vocab_size + tokens[k:k + windows]
+    return codes[ids[:windows] == ids[n - 1:]]
+
+
+def top_ngrams(tokens, offsets, n, vocab_size, top_k=10):
+    """The top_k most common n-grams as [(token tuple, count, relative frequency)]. Ties are ordered by their first
+    occurrence, like Counter.most_common."""
+    codes = ngram_codes(tokens, offsets, n, vocab_size)
+    if len(codes) == 0:
+        return []
+    unique, first, counts = np.unique(codes, return_index=True, return_counts=True)
+    order = np.lexsort((first, -counts))[:top_k]
+
+    result = []
+    for code, count in zip(unique[order], counts[order]):
+        ngram = []
+        for _ in range(n):
+            code, token = divmod(int(code), vocab_size)
+            ngram.append(token)
+        result.append((tuple(reversed(ngram)), int(count), count / len(codes)))
+    return result
+
+
+def transition_matrix(tokens, offsets, vocab_size, normalize=False):
+    """(vocab_size, vocab_size) counts of chord a followed by chord b. With normalize, every row sums up to 1."""
+    matrix = np.bincount(ngram_codes(tokens, offsets, 2, vocab_size), minlength=vocab_size * vocab_size)
+    matrix = matrix.reshape(vocab_size, vocab_size)
+    if normalize:
+        rows = matrix.sum(axis=1, keepdims=True)
+        matrix = np.divide(matrix, rows, out=np.zeros(matrix.shape), where=rows > 0)
+    return matrix
+
+
+def fits_in_time_signature(durations, offsets, check_last_bar=True):
+    """fits_in_time_signature for every song (merged durations): no chord may go over a bar line and, with
+    check_last_bar, the last bar has to be full. Returns a bool array."""
+    ends = np.cumsum(durations)
+    song_start = np.concatenate([[0], ends])[offsets[:-1]]
+    ids = song_ids(offsets)
+    ends -= song_start[ids]
+    starts = ends - durations
+
+    crosses = (starts // 4) != ((ends - 1) // 4)
+    fits = np.bincount(ids[crosses], minlength=len(offsets) - 1) == 0
+    if check_last_bar:
+        totals = np.zeros(len(offsets) - 1, dtype=np.int64)
+        has_chords = np.diff(offsets) > 0
+        totals[has_chords] = ends[offsets[1:][has_chords] - 1]
+        fits &= totals % 4 == 0
+    return fits
+
+
+def evaluate_set(tokens, offsets, idx_to_chord, class_table=None, ngram_lengths=(2, 4), top_k=10):
+    """All metrics of one set of songs (without <BOS>/<EOS>)."""
+    vocab_size = len(idx_to_chord)
+    if class_table is None:
+        class_table = chord_class_table(idx_to_chord)
+    counts = np.bincount(tokens, minlength=vocab_size)
+    merged_tokens, merged_durations, merged_offsets = merge_arrays(tokens, offsets)
+
+    result = length_stats(offsets)
+    result["counts"] = counts
+    result["pad_fraction"] = float(counts[0] / max(counts.sum(), 1))
+    result["chord_classes"] = chord_class_percentages(counts, class_table)
+    result["fits_time_signature"] = float(fits_in_time_signature(merged_durations, merged_offsets).mean())
+    result["fits_time_signature_open_bar"] = float(
+        fits_in_time_signature(merged_durations, merged_offsets, check_last_bar=False).mean())
+    result["transitions"] = transition_matrix(tokens, offsets, vocab_size)
+    # top_chord_progressions: the n-grams of the merged songs without the durations
+    for n in ngram_lengths:
+        result[f"top_progressions_{n}"] = [(tuple(idx_to_chord[token] for token in ngram), frequency)
+                                           for ngram, _, frequency in
+                                           top_ngrams(merged_tokens, merged_offsets, n, vocab_size, top_k)]
+    return result
+
+
+def evaluate_sets(sets, idx_to_chord, reference="original", ngram_lengths=(2, 4), top_k=10):
+    """evaluate_set for every set of sets ({name: songs}) plus the chord distribution similarity to the reference set.
+    The lookup tables are built once for all sets."""
+    chord_to_idx = {chord: idx for idx, chord in idx_to_chord.items()}
+    class_table = chord_class_table(idx_to_chord)
+
+    results = {name: evaluate_set(*to_arrays(songs, chord_to_idx), idx_to_chord, class_table, ngram_lengths, top_k)
+               for name, songs in sets.items()}
+    if reference in results:
+        for result in results.values():
+            result["similarity"] = js_similarity(result["counts"], results[reference]["counts"])
+    return results
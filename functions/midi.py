@@ -0,0 +1,447 @@
+"""
+MIDI export of chord progressions (from Models.ipynb). The progressions are in the merged notation of merge_chords, e.g.
+["2C:maj7", "2A:min7", "1D:min7"]. filename can be a path or a file object (e.g. io.BytesIO).
+
+For whole generated sets there is a bulk export. The notes of every (chord, duration) are computed once and cached, a
+song is then one array of note events which is written as a Standard MIDI file directly (the same bytes as pretty_midi
+writes, without a Note object per note). The songs are spread over a process pool:
+
+    python -m functions.midi --input outputs/sequences/lstm.json --name LSTM --workers 4
+    python -m functions.midi --input outputs/sequences/lstm.json --benchmark     # files/s, pretty_midi vs direct
+    python -m functions.midi --input outputs/sequences/lstm --name LSTM           # job directory of functions/streaming.py
+"""
+
+import io
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import functools
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pretty_midi
+
+from functions.utils import merge_chords
+
+
+def chord_to_notes(chord_name):
+    """Converts a chord to a list of the notes (integers) for defining the chord as MIDI."""
+
+    note_name_to_num = {
+        'C': 60, 'C#': 61, 'D': 62, 'D#': 63, 'E': 64, 'F': 65,
+        'F#': 66, 'G': 67, 'G#': 68, 'A': 69, 'A#': 70, 'B': 71,
+        'E-': 63, 'A-': 68, 'B-': 70, 'D-': 61, 'G-': 66, 'C-':71,   # Adding the flat notes
+    }
+
+    # Extract the root note and the type from the chord name
+    root, chord_type = chord_name.split(':')
+
+    # Calculate the MIDI numbers for the root, third, fifth, and possibly seventh notes
+    root_num = note_name_to_num[root]
+    if "min" in chord_type:
+        third_num = root_num + 3
+    else:
+        third_num = root_num + 4
+    fifth_num = root_num + 7
+
+    # Handle different types of chords
+    if "7" in chord_type and "maj7" not in chord_type and "min7" not in chord_type:
+        seventh_num = root_num + 10  # Dominant seventh
+    elif "maj7" in chord_type:
+        seventh_num = root_num + 11  # Major seventh
+    elif "min7" in chord_type:
+        seventh_num = root_num + 10  # Minor seventh
+    elif "hdim7" in chord_type:
+        fifth_num = root_num + 6  # Diminished fifth
+        seventh_num = root_num + 10  # Minor seventh
+    elif "dim7" in chord_type:
+        fifth_num = root_num + 6  # Diminished fifth
+        seventh_num = root_num + 9  # Diminished seventh
+    else:
+        seventh_num = None
+
+    notes = [root_num, third_num, fifth_num]
+    if seventh_num:
+        notes.append(seventh_num)
+
+    return notes
+
+
+def progression_to_midi(chord_progression, filename='output.mid'):
+    """Creates a midi file and saves it."""
+    # Create a new PrettyMIDI object
+    midi_data = pretty_midi.PrettyMIDI(initial_tempo=80)
+
+    # Create an instrument instance for a piano (instrument number 0)
+    piano_program = pretty_midi.instrument_name_to_program('Acoustic Grand Piano')
+    piano = pretty_midi.Instrument(program=piano_program)
+
+    # Dictionary to map rhythm prefixes to their duration
+    rhythm_to_duration = {
+        '1': 4,
+        '2.': 3,
+        '2': 2,
+        '4': 1
+    }
+
+    current_time = 0  # Keeps track of the current end time for each chord
+
+    # Iterate over the chord progression and add each chord to the MIDI file
+    for chord in chord_progression:
+        if chord not in ['<BOS>', '<EOS>', 'pad']:  # Ignore these tokens
+
+            # Extract rhythm and chord name
+            if chord[1] == '.':
+                rhythm = chord[:2]
+            else:
+                rhythm = chord[0]
+            chord_name = chord[len(rhythm):]  # The rest of the string after removing the rhythm
+
+            # Calculate start and end times based on rhythm
+            start_time = current_time
+            end_time = start_time + rhythm_to_duration[rhythm]
+
+            # Convert chord name to MIDI notes
+            notes = chord_to_notes(chord_name)
+
+            # Add each note in the chord to the MIDI file
+            for note_num in notes:
+                note = pretty_midi.Note(velocity=100, pitch=note_num, start=start_time, end=end_time)
+                piano.notes.append(note)
+
+            # Update the current time to the end time of this chord
+            current_time = end_time
+
+    # Add the piano instrument to the PrettyMIDI object
+    midi_data.instruments.append(piano)
+
+    # Write out the MIDI data to a file
+    midi_data.write(filename)
+
+
+def enhanced_progression_to_midi_jazz(chord_progression, filename='output.mid', bpm=120):
+    midi_data = pretty_midi.PrettyMIDI(initial_tempo=bpm)
+
+    # Jazz Instruments
+    piano_program = pretty_midi.instrument_name_to_program('Acoustic Grand Piano')
+    bass_program = pretty_midi.instrument_name_to_program('Acoustic Bass')
+    chord_program = pretty_midi.instrument_name_to_program('Electric Piano 1')
+
+    piano = pretty_midi.Instrument(program=piano_program)
+    bass = pretty_midi.Instrument(program=bass_program)
+    chords = pretty_midi.Instrument(program=chord_program)
+    drums = pretty_midi.Instrument(program=0, is_drum=True)
+
+    # Jazz Drum patterns
+    RIDE_CYMBAL = 51  # MIDI number for Ride Cymbal 1
+    SIDE_STICK = 37   # MIDI number for Side Stick
+
+    # Mapping of duration prefixes to their respective durations
+    rhythm_to_duration = {'1': 4, '2.': 3, '2': 2, '4': 1}
+
+    # Time tracker
+    current_time = 0
+
+    # Iterate over the chord progression
+    for chord in chord_progression:
+        if chord not in ['<BOS>', '<EOS>', 'pad']:  # Ignore these tokens
+
+            # Extract rhythm and chord name
+            if chord[1] == '.':
+                rhythm = chord[:2]
+            else:
+                rhythm = chord[0]
+            chord_name = chord[len(rhythm):]  # The rest of the string after removing the rhythm
+            duration = rhythm_to_duration[rhythm]
+
+            start_time = current_time
+            end_time = start_time + duration
+
+            # Chord notes
+            notes = chord_to_notes(chord_name)
+
+            # Bass note (root of the chord)
+            bass_note = pretty_midi.Note(velocity=127, pitch=notes[0]-12, start=start_time, end=end_time)
+            bass.notes.append(bass_note)
+
+            # Chord
+            for note_num in notes:
+                chord_note = pretty_midi.Note(velocity=70, pitch=note_num, start=start_time, end=end_time)
+                chords.notes.append(chord_note)
+
+            # Piano Arpeggio (adjusted to 1/2 note)
+            arpeggio_duration = 0.5
+            arpeggio_start = start_time
+            while arpeggio_start < end_time:
+                for j, note_num in enumerate(notes):
+                    if arpeggio_start + j*arpeggio_duration >= end_time:
+                        break  # Stop if we exceed the chord's end time
+                    arpeggio_note = pretty_midi.Note(velocity=60, pitch=note_num,
+                                                     start=arpeggio_start + j*arpeggio_duration,
+                                                     end=arpeggio_start + (j+1)*arpeggio_duration)
+                    piano.notes.append(arpeggio_note)
+                arpeggio_start += len(notes) * arpeggio_duration
+
+            # Jazz Drums pattern (only every 1/2 measure)
+            drum_ride_intervals = [0, 0.5]
+            drum_ride_start = start_time
+            while drum_ride_start < end_time:
+                for interval in drum_ride_intervals:
+                    if drum_ride_start + interval >= end_time:
+                        break  # Stop if we exceed the chord's end time
+                    drum_ride = pretty_midi.Note(velocity=80, pitch=RIDE_CYMBAL, start=drum_ride_start + interval, end=drum_ride_start + interval + 0.1)
+                    drums.notes.append(drum_ride)
+                drum_ride_start += 1  # Increment by a whole measure for the next cycle
+
+            # Update the current time
+            current_time = end_time
+
+    # Add the instruments to the PrettyMIDI object
+    midi_data.instruments.extend([piano, bass, chords, drums])
+
+    # Write out the MIDI data to a file
+    midi_data.write(filename)
+
+
+def midi_bytes(chord_progression, arranged=False):
+    """Returns the MIDI file of a progression as bytes instead of writing it to disk."""
+    buffer = io.BytesIO()
+    if arranged:
+        enhanced_progression_to_midi_jazz(chord_progression, buffer)
+    else:
+        progression_to_midi(chord_progression, buffer)
+    return buffer.getvalue()
+
+
+# bulk export
+
+RESOLUTION = 220  # ticks per quarter note of pretty_midi
+RHYTHM_TO_DURATION = {'1': 4, '2.': 3, '2': 2, '4': 1}
+SKIP_TOKENS = ['<BOS>', '<EOS>', 'pad']
+RIDE_CYMBAL = 51
+
+# (program, is_drum) of the tracks and the tempo of progression_to_midi / enhanced_progression_to_midi_jazz
+PIANO_TRACKS = [(pretty_midi.instrument_name_to_program('Acoustic Grand Piano'), False)]
+ARRANGED_TRACKS = [(pretty_midi.instrument_name_to_program('Acoustic Grand Piano'), False),
+                   (pretty_midi.instrument_name_to_program('Acoustic Bass'), False),
+                   (pretty_midi.instrument_name_to_program('Electric Piano 1'), False),
+                   (0, True)]
+
+
+@functools.lru_cache(maxsize=None)
+def parse_chord(chord):
+    """"2.C:maj7" -> ("C:maj7", 3)"""
+    rhythm = chord[:2] if chord[1] == '.' else chord[0]
+    return chord[len(rhythm):], RHYTHM_TO_DURATION[rhythm]
+
+
+@functools.lru_cache(maxsize=None)
+def chord_pattern(chord_name, duration, arranged=False):
+    """The notes of one chord as rows (track, start, end, pitch, velocity), the times relative to the start of the
+    chord. The same notes as progression_to_midi (arranged=False) or enhanced_progression_to_midi_jazz."""
+    notes = chord_to_notes(chord_name)
+    if not arranged:
+        rows = [(0, 0, duration, pitch, 100) for pitch in notes]
+    else:
+        rows = [(1, 0, duration, notes[0] - 12, 127)]
+        rows += [(2, 0, duration, pitch, 70) for pitch in notes]
+        arpeggio_start = 0
+        while arpeggio_start < duration:
+            for j, pitch in enumerate(notes):
+                if arpeggio_start + j * 0.5 >= duration:
+                    break
+                rows.append((0, arpeggio_start + j * 0.5, arpeggio_start + (j + 1) * 0.5, pitch, 60))
+            arpeggio_start += len(notes) * 0.5
+        drum_ride_start = 0
+        while drum_ride_start < duration:
+            for interval in [0, 0.5]:
+                if drum_ride_start + interval >= duration:
+                    break
+                rows.append((3, drum_ride_start + interval, drum_ride_start + interval + 0.1, RIDE_CYMBAL, 80))
+            drum_ride_start += 1
+
+    pattern = np.array(rows, dtype=np.float64).reshape(-1, 5)
+    pattern.flags.writeable = False
+    return pattern
+
+
+def progression_events(chord_progression, arranged=False):
+    """All notes of a progression as one (notes, 5) array like chord_pattern, with absolute times (in seconds, like the
+    pretty_midi functions)."""
+    patterns, starts = [], []
+    current_time = 0
+    for chord in chord_progression:
+        if chord in SKIP_TOKENS:
+            continue
+        chord_name, duration = parse_chord(chord)
+        patterns.append(chord_pattern(chord_name, duration, arranged))
+        starts.append(current_time)
+        current_time += duration
+
+    if not patterns:
+        return np.zeros((0, 5))
+    events = np.concatenate(patterns)
+    events[:, 1:3] += np.repeat(starts, [len(pattern) for pattern in patterns])[:, None]
+    return events
+
+
+def _variable_length(values, extra):
+    """Encodes the delta times of the events in the variable length format of MIDI, followed by extra[i] bytes for
+    every event. Returns (buffer, start of every event, number of delta bytes of every event)."""
+    n_bytes = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+    sizes = n_bytes + extra
+    starts = np.cumsum(sizes) - sizes
+    buffer = np.zeros(sizes.sum(), dtype=np.uint8)
+    for k in range(4):
+        has = n_bytes > k
+        last = n_bytes[has] - 1
+        buffer[starts[has] + k] = ((values[has] >> (7 * (last - k))) & 0x7F) | np.where(k < last, 0x80, 0)
+    return buffer, starts, n_bytes
+
+
+def _chunk(name, data):
+    return name + len(data).to_bytes(4, "big") + data
+
+
+def smf_bytes(events, tracks, bpm):
+    """Writes events (rows of progression_events) as a Standard MIDI file, the same bytes as pretty_midi (one track for
+    the tempo, one per instrument, notes sorted by tick, pitch and velocity, running status)."""
+    tick_scale = 60.0 / (bpm * RESOLUTION)
+    tempo = int(6e7 / (60. / (tick_scale * RESOLUTION)))
+    chunks = [_chunk(b"MTrk", b"\x00\xff\x51\x03" + tempo.to_bytes(3, "big") +
+                     b"\x00\xff\x58\x04\x04\x02\x18\x08\x01\xff\x2f\x00")]
+
+    channels = [channel for channel in range(16) if channel != 9]
+    track_ids = events[:, 0].astype(np.int64)
+    for n, (program, is_drum) in enumerate(tracks):
+        channel = 9 if is_drum else channels[n % len(channels)]
+        notes = events[track_ids == n]
+        if len(notes) == 0:
+            chunks.append(_chunk(b"MTrk", bytes([0, 0xC0 | channel, program]) + b"\x01\xff\x2f\x00"))
+            continue
+
+        # note on and note off (note on with velocity 0) events, times in ticks like PrettyMIDI.time_to_tick
+        ticks = np.rint(np.concatenate([notes[:, 1], notes[:, 2]]) / tick_scale).astype(np.int64)
+        pitches = np.concatenate([notes[:, 3], notes[:, 3]]).astype(np.uint8)
+        velocities = np.concatenate([notes[:, 4], np.zeros(len(notes))]).astype(np.uint8)
+        order = np.lexsort((velocities, pitches, ticks))
+        ticks, pitches, velocities = ticks[order], pitches[order], velocities[order]
+
+        # the status byte is only written for the first note (running status)
+        extra = np.full(len(ticks), 2)
+        extra[0] = 3
+        buffer, starts, n_bytes = _variable_length(np.diff(ticks, prepend=0), extra)
+        ends = starts + n_bytes + extra
+        buffer[starts[0] + n_bytes[0]] = 0x90 | channel
+        buffer[ends - 2] = pitches
+        buffer[ends - 1] = velocities
+        chunks.append(_chunk(b"MTrk", bytes([0, 0xC0 | channel, program]) + buffer.tobytes() + b"\x01\xff\x2f\x00"))
+
+    header = _chunk(b"MThd", (1).to_bytes(2, "big") + len(chunks).to_bytes(2, "big") + RESOLUTION.to_bytes(2, "big"))
+    return header + b"".join(chunks)
+
+
+def write_progression(chord_progression, filename, arranged=False, direct=True):
+    """progression_to_midi / enhanced_progression_to_midi_jazz with the cached chord patterns. direct=False writes
+    with pretty_midi instead."""
+    if not direct:
+        if arranged:
+            enhanced_progression_to_midi_jazz(chord_progression, filename)
+        else:
+            progression_to_midi(chord_progression, filename)
+        return
+
+    data = smf_bytes(progression_events(chord_progression, arranged), ARRANGED_TRACKS if arranged else PIANO_TRACKS,
+                     120 if arranged else 80)
+    if hasattr(filename, "write"):
+        filename.write(data)
+    else:
+        with open(filename, "wb") as fh:
+            fh.write(data)
+
+
+def _export_song(task):
+    song, piano_path, arranged_path, direct = task
+    # special tokens generated in the middle of a song are merged as well (e.g. "4<BOS>"), they are left out
+    progression = [chord for chord in merge_chords(song) if parse_chord(chord)[0] not in SKIP_TOKENS]
+    write_progression(progression, piano_path, arranged=False, direct=direct)
+    write_progression(progression, arranged_path, arranged=True, direct=direct)
+    return 2
+
+
+def export_midi(songs, output_dir=os.path.join("outputs", "midi"), name="LSTM", workers=None, chunksize=16,
+                direct=True):
+    """Writes every song (one chord per quarter note) as output_dir/piano/<name>_Piano_<i>.mid and
+    output_dir/arranged/<name>_Jazz_<i>.mid, like the loop in Models.ipynb. Returns the number of files written. With
+    workers=1 everything runs in this process. songs can be an iterator (e.g. iter_songs of functions/streaming.py), it
+    is read in blocks, so only a few thousand songs are in memory at once."""
+    for folder in ["piano", "arranged"]:
+        os.makedirs(os.path.join(output_dir, folder), exist_ok=True)
+    tasks = ((song, os.path.join(output_dir, "piano", f"{name}_Piano_{i}.mid"),
+              os.path.join(output_dir, "arranged", f"{name}_Jazz_{i}.mid"), direct) for i, song in enumerate(songs))
+
+    if workers == 1:
+        return sum(_export_song(task) for task in tasks)
+    files = 0
+    block_size = chunksize * (workers or os.cpu_count()) * 8
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # executor.map would read the whole iterator before the first song is written
+        for block in iter(lambda: list(itertools.islice(tasks, block_size)), []):
+            files += sum(executor.map(_export_song, block, chunksize=chunksize))
+    return files
+
+
+def benchmark_export(songs, workers=None, repeats=1):
+    """files/s of export_midi: pretty_midi and direct writing in this process, and direct writing with workers
+    processes. The files are written into a temporary directory."""
+    results = {}
+    for key, kwargs in [("pretty_midi", dict(workers=1, direct=False)), ("direct", dict(workers=1)),
+                        (f"direct_{workers or os.cpu_count()}_workers", dict(workers=workers))]:
+        output_dir = tempfile.mkdtemp()
+        try:
+            start = time.perf_counter()
+            for _ in range(repeats):
+                files = export_midi(songs, output_dir, **kwargs)
+            results[f"{key}_files_per_second"] = files * repeats / (time.perf_counter() - start)
+        finally:
+            shutil.rmtree(output_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes a set of generated songs as MIDI files")
+    parser.add_argument("--input", default=os.path.join("outputs", "sequences", "lstm.json"),
+                        help="JSON list of songs, one chord per quarter note, or a job directory of functions/streaming.py")
+    parser.add_argument("--output", default=os.path.join("outputs", "midi"))
+    parser.add_argument("--name", default="LSTM", help="prefix of the file names")
+    parser.add_argument("--limit", type=int, default=None, help="only the first songs")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of processes, 1 runs serially")
+    parser.add_argument("--pretty-midi", action="store_true", help="write with pretty_midi instead")
+    parser.add_argument("--benchmark", action="store_true", help="only measure files/s, nothing is kept")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.input):
+        from functions.streaming import iter_songs
+        songs = itertools.islice(iter_songs(args.input), args.limit)
+    else:
+        with open(args.input, "r") as fh:
+            songs = json.load(fh)[:args.limit]
+
+    if args.benchmark:
+        songs = list(songs)
+        for key, value in benchmark_export(songs, args.workers).items():
+            print(f"{key:40}{value:>12.1f}")
+        return
+
+    start = time.perf_counter()
+    files = export_midi(songs, args.output, args.name, workers=args.workers, direct=not args.pretty_midi)
+    seconds = time.perf_counter() - start
+    print(f"Wrote {files} files to {args.output} in {seconds:.2f}s ({files / seconds:.1f} files/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+The network architectures (LSTM and baseline RNN) used in Models.ipynb. They live here such that the generation, training and
+export code can import them without needing the notebook class definitions.
+"""
+
+import os
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+# the hyperparameters of Models.ipynb (grid search)
+HYPERPARAMETERS = {"embedding_dim": 48, "hidden_dim": 128, "n_layers": 2, "dropout": 0.3}
+
+
+class ChordLSTM(nn.Module):
+    # forward needs the lengths for sequence packing (see functions/training.py)
+    packed = True
+
+    def __init__(self, vocab_size, embedding_dim, hidden_dim, output_dim, n_layers, dropout=0.5, padding_idx=0):
+        super(ChordLSTM, self).__init__()
+
+        # Embedding layer
+        self.embedding = nn.Embedding(vocab_size, embedding_dim, padding_idx=padding_idx)
+
+        # LSTM layer
+        self.lstm = nn.LSTM(embedding_dim, hidden_dim, num_layers=n_layers, dropout=dropout, batch_first=True)
+
+        # Linear layer
+        self.fc = nn.Linear(hidden_dim, output_dim)
+
+
+    def forward(self, x, lengths, hidden=None):
+        # x: (batch_size, sequence_length)
+        embedded = self.embedding(x)  # (batch_size, sequence_length, embedding_dim)
+
+        # Pack the embedded sequences
+        packed_embedded = pack_padded_sequence(embedded, lengths, batch_first=True, enforce_sorted=False)
+
+        # LsTM output
+        packed_output, hidden = self.lstm(packed_embedded, hidden)
+
+        # Unpack the output
+        output, output_lengths = pad_packed_sequence(packed_output, batch_first=True, total_length=x.size(1))
+
+        # Linear layer
+        output = self.fc(output)  # (batch_size, sequence_length, output_dim)
+
+        return output, hidden
+
+    def step(self, x, hidden=None):
+        """Runs a single decoding step. x has the shape (batch_size, 1) and only holds the newest token, the (h, c) state of the
+        previous step is carried in hidden. No packing is needed since every row has length 1."""
+        embedded = self.embedding(x)
+        output, hidden = self.lstm(embedded, hidden)
+        return self.fc(output[:, -1]), hidden
+
+
+class baselineRNN(nn.Module):
+    packed = False
+
+    def __init__(self, vocab_size, embedding_dim, hidden_dim, output_dim, n_layers, dropout=0.5, padding_idx=0):
+        super(baselineRNN, self).__init__()
+
+        # Embedding layer
+        self.embedding = nn.Embedding(vocab_size, embedding_dim)
+
+        # RNN layer
+        self.rnn = nn.RNN(embedding_dim, hidden_dim, num_layers=n_layers, dropout=dropout, batch_first=True)
+
+        # Linear layer
+        self.fc = nn.Linear(hidden_dim, output_dim)
+
+
+    def forward(self, x, hidden=None):
+        # x: (batch_size, sequence_length)
+        embedded = self.embedding(x)  # (batch_size, sequence_length, embedding_dim)
+
+        # RNN output
+        output, hidden = self.rnn(embedded, hidden)
+
+        # Linear layer
+        output = self.fc(output)  # (batch_size, sequence_length, output_dim)
+
+        return output, hidden
+
+    def step(self, x, hidden=None):
+        """Same as ChordLSTM.step, but the state is only h."""
+        embedded = self.embedding(x)
+        output, hidden = self.rnn(embedded, hidden)
+        return self.fc(output[:, -1]), hidden
+
+
+def build_model(model_class, vocab_size, hyperparameters=HYPERPARAMETERS):
+    return model_class(vocab_size, hyperparameters["embedding_dim"], hyperparameters["hidden_dim"], vocab_size,
+                       hyperparameters["n_layers"], dropout=hyperparameters["dropout"])
+
+
+def load_models(epoch, rnn_model, lstm_model, path="models"):
+    """
+    Load saved models for a given epoch.
+
+    Parameters:
+    - epoch (int): Epoch number.
+    - rnn_model (torch.nn.Module): The RNN model architecture.
+    - lstm_model (torch.nn.Module): The LSTM model architecture.
+    - path (str): Base directory where the models are saved.
+
+    Returns:
+    - rnn_model, lstm_model: Loaded RNN and LSTM models.
+    """
+
+    rnn_path = os.path.join(path, "rnn", f"baselineRNN-epoch{epoch}.pt")
+    lstm_path = os.path.join(path, "lstm", f"ChordLSTM-epoch{epoch}.pt")
+
+    for model, model_path, name in [(rnn_model, rnn_path, "RNN"), (lstm_model, lstm_path, "LSTM")]:
+        if os.path.exists(model_path):
+            state = torch.load(model_path, map_location="cpu")
+            # train_model saves the whole checkpoint dict, not only the state dict
+            if "model_state_dict" in state:
+                state = state["model_state_dict"]
+            model.load_state_dict(state)
+            model.eval()
+        else:
+            print(f"No saved {name} model found for epoch {epoch} at path {model_path}.")
+
+    return rnn_model, lstm_model
@@ -0,0 +1,210 @@
+"""
+Suffix array index over the integer encoded corpus, for chord progression queries.
+
+The index is built once (all songs in one array, separated by a token that is not in the vocab, such that no match goes
+over the end of a song) and then answers:
+
+    top_ngrams(n, top_k)     the most common progressions of any length (one pass over the suffix array)
+    count(progression)       how often a progression occurs (binary search, O(m log N))
+    longest_matches(song)    for every position of a song, the longest progression starting there that occurs in the
+                             corpus (novelty / plagiarism check of generated songs)
+
+Both representations of the notebooks are supported:
+
+    index = NgramIndex.from_songs(all_chords_notoken, idx_to_chord)              # one chord per quarter note
+    index = NgramIndex.from_songs(all_chords_notoken, idx_to_chord, merged=True) # merge_chords, e.g. "2C:maj7"
+    index = NgramIndex.from_songs(..., merged=True, durations=False)             # merge_chords without the durations,
+                                                                                 # like top_chord_progressions
+
+Progressions are given and returned as chord strings if idx_to_chord is given, otherwise as token ids (merged with
+durations: (token, duration) tuples).
+"""
+
+import bisect
+
+import numpy as np
+
+from functions.metrics import to_arrays, merge_arrays, RHYTHM_TO_DURATION, DURATION_TO_RHYTHM
+
+
+def suffix_array(text):
+    """Suffix array of an integer array by prefix doubling: the suffixes are sorted by their first 1, 2, 4, ... tokens
+    until all ranks are different."""
+    n = len(text)
+    _, rank = np.unique(text, return_inverse=True)
+    rank = rank.astype(np.int64)
+    k = 1
+    while True:
+        second = np.full(n, -1, dtype=np.int64)
+        second[:n - k] = rank[k:]
+        sa = np.lexsort((second, rank))
+        changed = (rank[sa][1:] != rank[sa][:-1]) | (second[sa][1:] != second[sa][:-1])
+        rank = np.empty(n, dtype=np.int64)
+        rank[sa] = np.concatenate([[0], np.cumsum(changed)])
+        if rank[sa[-1]] == n - 1 or k >= n:
+            return sa
+        k *= 2
+
+
+def lcp_array(text, sa):
+    """lcp[i] is the length of the common prefix of the suffixes sa[i - 1] and sa[i] (Kasai), lcp[0] = 0."""
+    text = text.tolist()
+    n = len(text)
+    rank = np.empty(n, dtype=np.int64)
+    rank[sa] = np.arange(n)
+    rank = rank.tolist()
+    sa = sa.tolist()
+    lcp = [0] * n
+    h = 0
+    for i in range(n):
+        if rank[i] > 0:
+            j = sa[rank[i] - 1]
+            while i + h < n and j + h < n and text[i + h] == text[j + h]:
+                h += 1
+            lcp[rank[i]] = h
+            if h > 0:
+                h -= 1
+        else:
+            h = 0
+    return np.array(lcp, dtype=np.int64)
+
+
+class NgramIndex:
+    def __init__(self, tokens, offsets, alphabet_size, idx_to_chord=None, durations=False):
+        """tokens/offsets as in functions/metrics.py, all tokens < alphabet_size. With durations, every token is
+        token * 4 + duration - 1 (see from_songs)."""
+        self.idx_to_chord = idx_to_chord
+        self.chord_to_idx = {chord: idx for idx, chord in idx_to_chord.items()} if idx_to_chord is not None else None
+        self.durations = durations
+        self.separator = alphabet_size
+
+        # every song is followed by the separator
+        lengths = np.diff(offsets)
+        text = np.full(len(tokens) + len(lengths), self.separator, dtype=np.int64)
+        text[np.arange(len(tokens)) + np.repeat(np.arange(len(lengths)), lengths)] = tokens
+        self.text = text
+        self.sa = suffix_array(text)
+
+        # tokens until the end of the song of every position, the lcp is cut there
+        ends = np.flatnonzero(text == self.separator)
+        self.remaining = ends[np.searchsorted(ends, np.arange(len(text)))] - np.arange(len(text))
+        remaining = self.remaining[self.sa]
+        lcp = lcp_array(text, self.sa)
+        lcp[1:] = np.minimum(lcp[1:], np.minimum(remaining[1:], remaining[:-1]))
+        self.lcp = lcp
+
+        # lists for the binary searches, indexing them is faster than numpy arrays
+        self._text = text.tolist()
+        self._sa = self.sa.tolist()
+
+    @classmethod
+    def from_songs(cls, songs, idx_to_chord=None, merged=False, durations=True, vocab_size=None):
+        """Builds the index over songs (chord strings, token ids or a (tokens, offsets) tuple, one chord per quarter
+        note, without <BOS>/<EOS>). With merged, the songs are merged like merge_chords first, with or without the
+        durations."""
+        chord_to_idx = {chord: idx for idx, chord in idx_to_chord.items()} if idx_to_chord is not None else None
+        tokens, offsets = to_arrays(songs, chord_to_idx)
+        if vocab_size is None:
+            vocab_size = len(idx_to_chord) if idx_to_chord is not None else int(tokens.max()) + 1
+        if not merged:
+            return cls(tokens, offsets, vocab_size, idx_to_chord)
+
+        merged_tokens, merged_durations, merged_offsets = merge_arrays(tokens, offsets)
+        if not durations:
+            return cls(merged_tokens, merged_offsets, vocab_size, idx_to_chord)
+        return cls(merged_tokens * 4 + merged_durations - 1, merged_offsets, vocab_size * 4, idx_to_chord, durations=True)
+
+    def encode(self, progression):
+        """Progression (chord strings, merged strings like "2C:maj7", token ids or (token, duration) tuples) -> symbols
+        of the index."""
+        symbols = []
+        for item in progression:
+            if self.durations:
+                if isinstance(item, str):
+                    rhythm = item[:2] if item[1] == '.' else item[0]
+                    item = (item[len(rhythm):], RHYTHM_TO_DURATION[rhythm])
+                token, duration = item
+                token = self.chord_to_idx[token] if isinstance(token, str) else int(token)
+                symbols.append(token * 4 + duration - 1)
+            else:
+                symbols.append(self.chord_to_idx[item] if isinstance(item, str) else int(item))
+        return symbols
+
+    def decode(self, symbols):
+        """Symbols of the index -> tuple of chords (strings if idx_to_chord is given)."""
+        progression = []
+        for symbol in symbols:
+            symbol = int(symbol)
+            token, duration = divmod(symbol, 4) if self.durations else (symbol, None)
+            if self.idx_to_chord is None:
+                progression.append((token, duration + 1) if self.durations else token)
+            else:
+                chord = self.idx_to_chord[token]
+                progression.append(DURATION_TO_RHYTHM[duration + 1] + chord if self.durations else chord)
+        return tuple(progression)
+
+    def _extend(self, lo, hi, depth, symbol):
+        """Narrows the suffix array range [lo, hi) of a progression of length depth to the suffixes continuing with
+        symbol. Within the range, the token at depth is sorted."""
+        key = lambda i: self._text[self._sa[i] + depth]
+        return bisect.bisect_left(range(lo, hi), symbol, key=key) + lo, \
+            bisect.bisect_right(range(lo, hi), symbol, key=key) + lo
+
+    def find(self, progression):
+        """The suffix array range [lo, hi) of all occurrences of progression."""
+        lo, hi = 0, len(self._sa)
+        for depth, symbol in enumerate(self.encode(progression)):
+            lo, hi = self._extend(lo, hi, depth, symbol)
+            if lo == hi:
+                break
+        return lo, hi
+
+    def count(self, progression):
+        """How often progression occurs in the corpus."""
+        lo, hi = self.find(progression)
+        return hi - lo
+
+    def top_ngrams(self, n, top_k=10):
+        """The top_k most common progressions of length n as [(progression, count)], like Counter.most_common (ties
+        are ordered by their first occurrence)."""
+        valid = self.remaining[self.sa] >= n
+        positions = self.sa[valid]
+        # suffixes with the same first n tokens are next to each other in the suffix array
+        same = np.zeros(len(valid), dtype=bool)
+        same[1:] = valid[:-1] & (self.lcp[1:] >= n)
+        starts = np.flatnonzero(~same[valid])
+        if len(starts) == 0:
+            return []
+        counts = np.diff(np.append(starts, len(positions)))
+        first = np.minimum.reduceat(positions, starts)
+        order = np.lexsort((first, -counts))[:top_k]
+        return [(self.decode(self.text[first[i]:first[i] + n]), int(counts[i])) for i in order]
+
+    def longest_matches(self, song):
+        """For every position of song, the length of the longest progression starting there that occurs in the
+        corpus. A song copied from the corpus has len(song) - i at position i."""
+        symbols = self.encode(song)
+        matches = np.zeros(len(symbols), dtype=np.int64)
+        for start in range(len(symbols)):
+            lo, hi = 0, len(self._sa)
+            depth = 0
+            while start + depth < len(symbols):
+                symbol = symbols[start + depth]
+                if hi - lo == 1:
+                    # only one suffix left, compare directly
+                    if self._text[self._sa[lo] + depth] != symbol:
+                        break
+                else:
+                    lo, hi = self._extend(lo, hi, depth, symbol)
+                    if lo == hi:
+                        break
+                depth += 1
+            matches[start] = depth
+        return matches
+
+    def novelty(self, song, n):
+        """Share of the progressions of length n of song that do not occur in the corpus (0: everything is copied, 1:
+        nothing is). None for songs shorter than n."""
+        if len(song) < n:
+            return None
+        return float((self.longest_matches(song)[:len(song) - n + 1] < n).mean())
@@ -0,0 +1,156 @@
+"""
+The preprocessing pipeline of PreProcessing.ipynb as a script:
+
+    extract_chords -> flatten_chords -> ChordSimplifier.batch_simplify_chord -> filter_songs -> remove_invalid_tokens
+
+The files are distributed over a process pool. executor.map keeps the order of the (sorted) file list, so the output is
+the same for any number of workers, byte for byte.
+
+Usage:
+    python -m functions.preprocess --workers 8 --output data/processed/chords.json
+"""
+
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from functions.utils import flatten_chords
+from functions.corpus import get_jazz_files, parse_kern
+from functions.ChordSimplifier import ChordSimplifier
+
+INVALID = "Invalid/No Chord"
+
+# one simplifier per process, created lazily in the worker
+_simplifier = None
+
+
+def _get_simplifier():
+    global _simplifier
+    if _simplifier is None:
+        _simplifier = ChordSimplifier()
+    return _simplifier
+
+
+def filter_songs(songs, repetition_threshold=0.7, invalid_threshold=0.00001):
+    """
+    Filters out songs based on repetition and invalid chord thresholds.
+
+    Parameters:
+    - songs: List of songs, where each song is a list of chords.
+    - repetition_threshold: Fraction of most repeated chord to total chords in a song. Default is 0.5.
+    - invalid_threshold: Fraction of "Invalid/No Chord" to total chords in a song. Default is 0.1.
+
+    Returns:
+    - A list of filtered songs.
+    """
+    filtered_songs = []
+    invalid_songs = []
+
+    for song in songs:
+        chord_counts = {}
+        total_chords = len(song)
+
+        for chord in song:
+            if chord not in chord_counts:
+                chord_counts[chord] = 0
+            chord_counts[chord] += 1
+
+        # Identify the most repeated chord
+        most_repeated_chord = max(chord_counts, key=chord_counts.get)
+
+        # Check the repetition threshold
+        if chord_counts[most_repeated_chord] / total_chords > repetition_threshold:
+            invalid_songs.append(song)
+            continue
+
+        # Check the invalid chord threshold
+        if INVALID in chord_counts and chord_counts[INVALID] / total_chords > invalid_threshold:
+            invalid_songs.append(song)
+            continue
+
+        filtered_songs.append(song)
+
+    return filtered_songs, invalid_songs
+
+
+def remove_invalid_tokens(filtered_songs):
+    """
+    Removes the "Invalid/No Chord" tokens from each song in the filtered songs list.
+
+    Parameters:
+    - filtered_songs: List of songs, where each song is a list of chords.
+
+    Returns:
+    - A list of songs with the "Invalid/No Chord" tokens removed.
+    """
+
+    cleaned_songs = []
+
+    for song in filtered_songs:
+        cleaned_song = [chord for chord in song if chord != INVALID]
+        cleaned_songs.append(cleaned_song)
+
+    return cleaned_songs
+
+
+def has_eighth_notes(chords):
+    """True if a song has eighth notes (8 or 4.), these songs are filtered out since one step is a quarter note."""
+    for chord in chords:
+        if len(chord) == 1:
+            continue
+        if chord[0] == "8" or chord[:2] == "4.":
+            return True
+    return False
+
+
+def process_file(path):
+    """Runs the whole pipeline for one file. Returns the final song (list of simplified chords) or None if the song is
+    filtered out (not 4/4, eighth notes, too repetitive or invalid chords)."""
+    with open(path, "r") as fh:
+        entry = parse_kern(fh)
+
+    if entry["signature"] != "4/4" or has_eighth_notes(entry["chords"]):
+        return None
+
+    song = _get_simplifier().batch_simplify_chord(flatten_chords(entry["chords"]))
+
+    filtered, _ = filter_songs([song])
+    if not filtered:
+        return None
+    return remove_invalid_tokens(filtered)[0]
+
+
+def preprocess(directory="data", workers=None, chunksize=16):
+    """Processes all files in directory and returns the final songs. With workers=1 everything runs in this process."""
+    files = get_jazz_files(directory)
+
+    if workers == 1:
+        results = [process_file(path) for path in files]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(process_file, files, chunksize=chunksize))
+
+    return [song for song in results if song is not None]
+
+
+def save_to_json(data, filename):
+    with open(filename, 'w') as file:
+        json.dump(data, file, indent=4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preprocess the .jazz files into data/processed/chords.json")
+    parser.add_argument("--data", default="data", help="directory with the .jazz files")
+    parser.add_argument("--output", default=os.path.join("data", "processed", "chords.json"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of processes, 1 runs serially")
+    parser.add_argument("--chunksize", type=int, default=16, help="files per task sent to a worker")
+    args = parser.parse_args()
+
+    songs = preprocess(args.data, workers=args.workers, chunksize=args.chunksize)
+    save_to_json(songs, args.output)
+    print(f"Saved {len(songs)} songs to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Timers and counters for training and generation.
+
+A Profiler sums the time of named stages (data loading, forward, backward, optimizer step, evaluation, checkpoint I/O,
+decoding) and counts tokens, songs and batches. With trace_path every timed call is written as one JSON line, plus a
+summary line per epoch or generation call. If no profiler is passed, the functions use NULL_PROFILER, which does
+nothing (no clock is read, nothing is allocated):
+
+    profiler = Profiler("outputs/trace.jsonl")
+    train_model(model, train_loader, optimizer, criterion, epochs, val_loader, profiler=profiler)
+    print(profiler.report())
+
+"data" is the time spent waiting for the next batch of the DataLoader. If it is a big part of the epoch, the model waits
+for the data (e.g. num_workers=0). With torch_trace, the timers also show up as named ranges in a torch.profiler trace,
+which can be opened in chrome://tracing or Perfetto:
+
+    with torch_trace("outputs/trace.json"):
+        train_model(..., profiler=Profiler(record_functions=True))
+
+    python -m functions.training --model rnn --epochs 2 --profile outputs/trace.jsonl --torch-trace outputs/trace.json
+"""
+
+import os
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+class _Timer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.range = torch.profiler.record_function(name) if profiler.record_functions else None
+
+    def __enter__(self):
+        if self.range is not None:
+            self.range.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler.synchronize:
+            torch.cuda.synchronize()
+        self.profiler.add(self.name, time.perf_counter() - self.start, self.start)
+        if self.range is not None:
+            self.range.__exit__(*exc)
+        return False
+
+
+class Profiler:
+    """Named timers (total seconds and calls) and counters.
+
+    - trace_path: JSON lines file, one line per timed call ({"name", "start", "seconds"}) and per summary.
+    - synchronize: wait for CUDA at the end of every timer, otherwise GPU work is counted where it is waited for.
+    - record_functions: also mark the timers as torch.profiler.record_function ranges (for torch_trace).
+    """
+
+    enabled = True
+
+    def __init__(self, trace_path=None, synchronize=False, record_functions=False):
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.record_functions = record_functions
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+        self.created = time.perf_counter()
+        self.trace = None
+        if trace_path is not None:
+            os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+            self.trace = open(trace_path, "a")
+
+    def timer(self, name):
+        """with profiler.timer("forward"): ..."""
+        return _Timer(self, name)
+
+    def add(self, name, seconds, start=None):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.trace is not None:
+            self.write({"name": name, "start": (start or time.perf_counter()) - self.created, "seconds": seconds})
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def iterate(self, name, iterable):
+        """Yields from iterable and times every next() (e.g. the waiting for the DataLoader)."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                with torch.profiler.record_function(name) if self.record_functions else nullcontext():
+                    item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - start, start)
+            yield item
+
+    def write(self, record):
+        if self.trace is not None:
+            self.trace.write(json.dumps(record) + "\n")
+
+    def rate(self, counter, timer):
+        """counter per second of timer, e.g. rate("tokens", "generate")."""
+        seconds = self.seconds.get(timer, 0.0)
+        return self.counters.get(counter, 0) / seconds if seconds > 0 else None
+
+    def summary(self):
+        return {"timers": {name: {"seconds": seconds, "calls": self.calls[name]} for name, seconds in self.seconds.items()},
+                "counters": dict(self.counters)}
+
+    def snapshot(self, **fields):
+        """Writes the current totals as a summary line, fields (e.g. epoch=3) are added to it."""
+        self.write({"summary": True, **fields, **self.summary()})
+
+    def report(self):
+        """The timers as a table, sorted by time, with the share of the total time since the profiler was created."""
+        total = time.perf_counter() - self.created
+        lines = [f"{'timer':24}{'seconds':>12}{'calls':>10}{'share':>8}"]
+        for name, seconds in sorted(self.seconds.items(), key=lambda item: -item[1]):
+            lines.append(f"{name:24}{seconds:>12.3f}{self.calls[name]:>10}{seconds / total:>8.1%}")
+        for name, value in self.counters.items():
+            lines.append(f"{name:24}{value:>12}")
+        return "\n".join(lines)
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+
+class NullProfiler:
+    """The disabled profiler: same methods, no work."""
+
+    enabled = False
+
+    def timer(self, name):
+        return _NULL_CONTEXT
+
+    def add(self, name, seconds, start=None):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def iterate(self, name, iterable):
+        return iterable
+
+    def write(self, record):
+        pass
+
+    def rate(self, counter, timer):
+        return None
+
+    def summary(self):
+        return {"timers": {}, "counters": {}}
+
+    def snapshot(self, **fields):
+        pass
+
+    def report(self):
+        return ""
+
+    def close(self):
+        pass
+
+
+_NULL_CONTEXT = nullcontext()
+NULL_PROFILER = NullProfiler()
+
+
+@contextmanager
+def torch_trace(path, cuda=None):
+    """Runs the block under torch.profiler and writes a Chrome trace (chrome://tracing, Perfetto) to path."""
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if cuda or (cuda is None and torch.cuda.is_available()):
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities) as profile:
+        yield profile
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    profile.export_chrome_trace(path)
@@ -0,0 +1,252 @@
+"""
+Local hyperparameter search with successive halving, without Ray.
+
+The Ray Tune search in Models.ipynb trained every config of the grid for the full 10 epochs. Here, all configs are
+trained for a few epochs first, only the best 1/eta of them are trained further, and so on (successive halving):
+
+    min_epochs=1, max_epochs=10, eta=3:  108 configs x 1 epoch -> 36 x 3 epochs -> 12 x 9 epochs -> 4 x 10 epochs
+
+The trials run in a process pool. The encoded songs are put into shared memory once and every worker reads them from
+there. A trial continues from its own last.pt (see functions/training.py) when it is promoted. Every result is appended
+to trials.jsonl, such that an interrupted search continues where it stopped when it is started again.
+
+The config has the same shape as the Ray Tune one, grid_search(...) here returns the same as tune.grid_search(...):
+
+    config = {"hidden_dim": grid_search([48, 64, 128]), "lr": grid_search([0.01, 0.02]), "dropout": 0.3}
+
+Usage:
+    python -m functions.search --workers 8 --max-epochs 10 --eta 3
+"""
+
+import os
+import json
+import math
+import time
+import argparse
+import itertools
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from functions.utils import encode_chords, add_start_end_tokens
+from functions.data import ChordDataset, bucket_loader
+from functions.models import ChordLSTM, baselineRNN, build_model, HYPERPARAMETERS
+from functions.training import train_model, split_dataset
+
+MODELS = {"lstm": ChordLSTM, "rnn": baselineRNN}
+
+
+def grid_search(values):
+    """Same as ray.tune.grid_search."""
+    return {"grid_search": list(values)}
+
+
+# the grid of Models.ipynb
+SEARCH_SPACE = {
+    "hidden_dim": grid_search([48, 64, 128]),
+    "n_layers": grid_search([2, 3]),
+    "embedding_dim": grid_search([48, 64, 92]),
+    "dropout": grid_search([0.1, 0.2, 0.3]),
+    "lr": grid_search([0.01, 0.02]),
+}
+
+
+def expand_config(config, num_samples=1):
+    """Returns the list of all configs of the grid (like Ray Tune, every grid is repeated num_samples times)."""
+    keys = list(config)
+    values = [config[key]["grid_search"] if isinstance(config[key], dict) and "grid_search" in config[key]
+              else [config[key]] for key in keys]
+    grid = [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+    return [dict(trial_config) for _ in range(num_samples) for trial_config in grid]
+
+
+def rung_epochs(min_epochs, max_epochs, eta):
+    """The epochs after which the trials are compared, e.g. [1, 3, 9, 10] for 1, 10 and 3."""
+    rungs = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= eta
+    return rungs + [max_epochs]
+
+
+class SharedSequences:
+    """The songs as views on a flat token array and the song offsets, like functions.tokens.TokenSequences."""
+
+    def __init__(self, offsets, tokens):
+        self.offsets = offsets
+        self.tokens = tokens
+        self.lengths = np.diff(offsets).tolist()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(self.tokens[self.offsets[idx]:self.offsets[idx + 1]])
+
+
+def share_sequences(sequences):
+    """Copies the encoded songs into one shared memory block: the int64 offsets followed by the tokens. Returns the
+    SharedMemory (close and unlink it when done) and the info a worker needs to attach to it."""
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum([len(sequence) for sequence in sequences], out=offsets[1:])
+    dtype = np.uint8 if max(int(sequence.max()) for sequence in sequences) < 256 else np.uint16
+
+    shm = shared_memory.SharedMemory(create=True, size=offsets.nbytes + int(offsets[-1]) * np.dtype(dtype).itemsize)
+    np.ndarray(offsets.shape, np.int64, shm.buf)[:] = offsets
+    tokens = np.ndarray((int(offsets[-1]),), dtype, shm.buf, offset=offsets.nbytes)
+    tokens[:] = np.concatenate([sequence.numpy() for sequence in sequences])
+    return shm, {"name": shm.name, "n_songs": len(sequences), "n_tokens": int(offsets[-1]),
+                 "dtype": np.dtype(dtype).name}
+
+
+def attach_sequences(info):
+    """Attaches to the block of share_sequences. Returns the SharedMemory (keep a reference to it) and the songs."""
+    shm = shared_memory.SharedMemory(name=info["name"])
+    offsets = np.ndarray((info["n_songs"] + 1,), np.int64, shm.buf)
+    tokens = np.ndarray((info["n_tokens"],), info["dtype"], shm.buf, offset=offsets.nbytes)
+    return shm, SharedSequences(offsets, tokens)
+
+
+# the data of a worker process, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(info, vocab_size, batch_size, split_seed, threads):
+    torch.set_num_threads(threads)
+    shm, sequences = attach_sequences(info)
+    train_dataset, val_dataset, _ = split_dataset(ChordDataset(sequences), seed=split_seed)
+    _worker.update(shm=shm, vocab_size=vocab_size,
+                   train_loader=bucket_loader(train_dataset, batch_size, shuffle=True),
+                   val_loader=bucket_loader(val_dataset, batch_size, shuffle=False))
+
+
+def _run_trial(trial_id, config, model_name, epochs, trial_dir, seed):
+    """Trains one trial up to epochs (continuing from its last.pt) and returns its validation loss."""
+    start = time.perf_counter()
+    torch.manual_seed(seed)
+    model = build_model(MODELS[model_name], _worker["vocab_size"], dict(HYPERPARAMETERS, **config))
+    optimizer = torch.optim.Adam(model.parameters(), lr=config.get("lr", 0.01))
+    criterion = nn.CrossEntropyLoss(ignore_index=0)
+
+    # only the last epoch of the rung is evaluated
+    history = train_model(model, _worker["train_loader"], optimizer, criterion, epochs, _worker["val_loader"],
+                          eval_every=epochs, eval_train=False, checkpoint_dir=trial_dir, resume=True, verbose=False)
+
+    return {"trial": trial_id, "config": config, "epochs": epochs, "val_loss": history["val_loss"][-1],
+            "val_acc": history["val_acc"][-1], "train_loss": history["train_loss"][-1],
+            "seconds": time.perf_counter() - start}
+
+
+def read_log(log_path):
+    """Returns the results of trials.jsonl as {(trial, epochs): result}."""
+    results = {}
+    if os.path.exists(log_path):
+        with open(log_path, "r") as fh:
+            for line in fh:
+                if line.strip():
+                    result = json.loads(line)
+                    results[(result["trial"], result["epochs"])] = result
+    return results
+
+
+def search(config=SEARCH_SPACE, songs=None, model="lstm", min_epochs=1, max_epochs=10, eta=3, num_samples=1,
+           workers=None, threads_per_trial=1, batch_size=64, search_dir=os.path.join("outputs", "search"), seed=1,
+           verbose=True):
+    """
+    Runs the successive halving search and returns the results of the last rung, sorted by validation loss.
+
+    Parameters:
+    - config: dict like the Ray Tune config, values are grid_search(...) or fixed.
+    - songs: the preprocessed songs (without <BOS>/<EOS>), default data/processed/chords.json.
+    - min_epochs, max_epochs, eta: every trial gets min_epochs, then only the best 1/eta of a rung go on, up to
+      max_epochs.
+    - workers: number of trial processes, threads_per_trial: torch threads per process.
+    - search_dir: holds trials.jsonl and one checkpoint directory per trial. Start the search again with the same
+      arguments to continue it.
+    """
+    if songs is None:
+        with open(os.path.join("data", "processed", "chords.json"), "r") as fh:
+            songs = json.load(fh)
+    _, _, _, sequences, vocab_size = encode_chords(add_start_end_tokens(songs), pad=False)
+
+    trials = expand_config(config, num_samples)
+    log_path = os.path.join(search_dir, "trials.jsonl")
+    os.makedirs(search_dir, exist_ok=True)
+    results = read_log(log_path)
+    for (trial_id, _), result in results.items():
+        if trial_id >= len(trials) or result["config"] != trials[trial_id]:
+            raise ValueError(f"{log_path} belongs to another search, use another search_dir")
+
+    shm, info = share_sequences(sequences)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(info, vocab_size, batch_size, seed, threads_per_trial)) as executor, \
+                open(log_path, "a") as log:
+            candidates = list(range(len(trials)))
+            for rung, epochs in enumerate(rung_epochs(min_epochs, max_epochs, eta)):
+                todo = [trial_id for trial_id in candidates if (trial_id, epochs) not in results]
+                futures = [executor.submit(_run_trial, trial_id, trials[trial_id], model, epochs,
+                                           os.path.join(search_dir, f"trial-{trial_id:04d}"), seed + trial_id)
+                           for trial_id in todo]
+                for future in as_completed(futures):
+                    result = future.result()
+                    results[(result["trial"], epochs)] = result
+                    log.write(json.dumps(result) + "\n")
+                    log.flush()
+
+                # nan (diverged) counts as the worst loss
+                ranked = sorted(candidates, key=lambda trial_id: _loss_key(results[(trial_id, epochs)]))
+                if verbose:
+                    best = results[(ranked[0], epochs)]
+                    print(f"Rung {rung} ({epochs} epochs): {len(candidates)} trials, {len(todo)} trained, "
+                          f"best val loss {best['val_loss']:.4f} {best['config']}")
+                if epochs < max_epochs:
+                    candidates = ranked[:max(1, math.ceil(len(candidates) / eta))]
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return [results[(trial_id, max_epochs)] for trial_id in ranked]
+
+
+def _loss_key(result):
+    loss = result["val_loss"]
+    return math.inf if math.isnan(loss) else loss
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Successive halving search over the grid of Models.ipynb")
+    parser.add_argument("--config", default=None, help="JSON file with the config, default: the grid of Models.ipynb")
+    parser.add_argument("--model", choices=list(MODELS), default="lstm")
+    parser.add_argument("--min-epochs", type=int, default=1)
+    parser.add_argument("--max-epochs", type=int, default=10)
+    parser.add_argument("--eta", type=int, default=3, help="keep the best 1/eta trials of every rung")
+    parser.add_argument("--num-samples", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--threads-per-trial", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--search-dir", default=os.path.join("outputs", "search"))
+    parser.add_argument("--top", type=int, default=5, help="number of configs to print")
+    args = parser.parse_args()
+
+    config = SEARCH_SPACE
+    if args.config:
+        with open(args.config, "r") as fh:
+            config = json.load(fh)
+
+    results = search(config, model=args.model, min_epochs=args.min_epochs, max_epochs=args.max_epochs, eta=args.eta,
+                     num_samples=args.num_samples, workers=args.workers, threads_per_trial=args.threads_per_trial,
+                     batch_size=args.batch_size, search_dir=args.search_dir)
+
+    for idx, result in enumerate(results[:args.top], 1):
+        print(f"Configuration {idx}: val loss {result['val_loss']:.4f}")
+        print(result["config"])
+        print("------")
+
+
+if __name__ == "__main__":
+    main()
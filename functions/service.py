@@ -0,0 +1,309 @@
+"""
+Generation service: loads a trained model once and serves new chord progressions over HTTP (standard library only).
+
+    python -m functions.service --model models/lstm/ChordLSTM-int8.pt --port 8000
+    python -m functions.service --checkpoint models/lstm/best.pt --model-type lstm
+
+    POST /generate  {"num_songs": 4, "temperature": 1.0, "max_length": 200, "prefix": ["C:maj7", "A:min7"],
+                     "format": "chords"}
+    GET  /metrics
+
+format is "chords" (one chord per quarter note), "merged" (merge_chords notation like "2C:maj7") or "midi" (base64
+MIDI files). Concurrent requests are not decoded one after the other: all requests that arrive within window_ms (or
+until max_batch songs are together) are decoded as one batch with generate_batch. While a batch is decoded, the next one
+is collected. /metrics reports the p50/p99 latency, songs/s and the batch sizes.
+"""
+
+import os
+import json
+import math
+import time
+import base64
+import asyncio
+import argparse
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from functions.utils import merge_chords
+from functions.midi import midi_bytes, SKIP_TOKENS
+from functions.generation import generate_batch
+
+FORMATS = ["chords", "merged", "midi"]
+MAX_SONGS = 1000
+MAX_LENGTH = 5000
+
+Job = namedtuple("Job", ["prefix", "num_songs", "max_length", "temperature", "future"])
+
+
+class Metrics:
+    """Latency of the last window requests and the songs finished in the last rate_seconds seconds."""
+
+    def __init__(self, window=10000, rate_seconds=10.0):
+        self.latencies = deque(maxlen=window)
+        self.finished = deque()
+        self.rate_seconds = rate_seconds
+        self.requests = 0
+        self.errors = 0
+        self.songs = 0
+        self.batches = 0
+        self.batch_songs = 0
+        self.started = time.monotonic()
+
+    def add_request(self, seconds, num_songs):
+        now = time.monotonic()
+        self.requests += 1
+        self.songs += num_songs
+        self.latencies.append(seconds)
+        self.finished.append((now, num_songs))
+
+    def add_batch(self, num_songs):
+        self.batches += 1
+        self.batch_songs += num_songs
+
+    def snapshot(self):
+        now = time.monotonic()
+        while self.finished and self.finished[0][0] < now - self.rate_seconds:
+            self.finished.popleft()
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "songs": self.songs,
+            "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "latency_p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "songs_per_second": sum(n for _, n in self.finished) / min(self.rate_seconds, max(now - self.started, 1e-9)),
+            "batches": self.batches,
+            "mean_songs_per_batch": self.batch_songs / self.batches if self.batches else None,
+            "uptime_seconds": now - self.started,
+        }
+
+
+class MicroBatcher:
+    """Collects the songs of concurrent requests and decodes them together. The model runs in one worker thread, such
+    that the event loop keeps accepting requests in the meantime."""
+
+    def __init__(self, model, device="cpu", max_batch=256, window_ms=5.0, metrics=None):
+        self.model = model
+        self.device = device
+        self.max_batch = max_batch
+        self.window = window_ms / 1000
+        self.metrics = metrics
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def generate(self, prefix, num_songs, max_length, temperature):
+        """Returns num_songs songs (token ids, starting with <BOS>) for one request."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(Job(prefix, num_songs, max_length, temperature, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        jobs = [await self.queue.get()]
+        num_songs = jobs[0].num_songs
+        deadline = loop.time() + self.window
+        while num_songs < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0 and self.queue.empty():
+                break
+            try:
+                job = self.queue.get_nowait() if not self.queue.empty() else \
+                    await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            jobs.append(job)
+            num_songs += job.num_songs
+        return jobs
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = await self._collect()
+            prefixes, max_lengths, temperatures = [], [], []
+            for job in jobs:
+                prefixes += [job.prefix] * job.num_songs
+                max_lengths += [job.max_length] * job.num_songs
+                temperatures += [job.temperature] * job.num_songs
+            if self.metrics is not None:
+                self.metrics.add_batch(len(prefixes))
+
+            try:
+                songs = await loop.run_in_executor(self.executor, generate_batch, self.model, prefixes, max_lengths,
+                                                   temperatures, self.device)
+            except Exception as error:
+                for job in jobs:
+                    if not job.future.done():
+                        job.future.set_exception(error)
+                continue
+
+            start = 0
+            for job in jobs:
+                if not job.future.done():
+                    job.future.set_result(songs[start:start + job.num_songs])
+                start += job.num_songs
+
+
+def parse_request(payload, chord_to_idx):
+    """Checks a /generate request and returns (prefix token ids, num_songs, max_length, temperature, format). Raises
+    ValueError with a message for the client if something is wrong."""
+    if not isinstance(payload, dict):
+        raise ValueError("the request must be a JSON object")
+    num_songs = int(payload.get("num_songs", 1))
+    max_length = int(payload.get("max_length", 2000))
+    temperature = float(payload.get("temperature", 1.0))
+    output_format = payload.get("format", "chords")
+    prefix = payload.get("prefix", [])
+
+    if not 1 <= num_songs <= MAX_SONGS:
+        raise ValueError(f"num_songs must be between 1 and {MAX_SONGS}")
+    if not 1 <= max_length <= MAX_LENGTH:
+        raise ValueError(f"max_length must be between 1 and {MAX_LENGTH}")
+    if not (math.isfinite(temperature) and temperature > 0):
+        raise ValueError("temperature must be a finite number > 0")
+    if output_format not in FORMATS:
+        raise ValueError(f"format must be one of {FORMATS}")
+    if not isinstance(prefix, list) or not all(isinstance(chord, str) for chord in prefix):
+        raise ValueError("prefix must be a list of chords, e.g. [\"C:maj7\"]")
+    unknown = [chord for chord in prefix if chord not in chord_to_idx or chord in SKIP_TOKENS]
+    if unknown:
+        raise ValueError(f"unknown chords in prefix: {unknown}")
+
+    return [chord_to_idx["<BOS>"]] + [chord_to_idx[chord] for chord in prefix], num_songs, max_length, temperature, \
+        output_format
+
+
+def format_songs(songs, idx_to_chord, output_format):
+    # generate_batch never samples pad and <BOS>, this also covers prefixes and songs of older files
+    chords = [[idx_to_chord[token] for token in song[1:] if idx_to_chord[token] not in SKIP_TOKENS] for song in songs]
+    if output_format == "merged":
+        return [merge_chords(song) for song in chords]
+    if output_format == "midi":
+        return [base64.b64encode(midi_bytes(merge_chords(song))).decode("ascii") for song in chords]
+    return chords
+
+
+class GenerationService:
+    def __init__(self, model, idx_to_chord, device="cpu", max_batch=256, window_ms=5.0):
+        self.idx_to_chord = idx_to_chord
+        self.chord_to_idx = {chord: idx for idx, chord in idx_to_chord.items()}
+        self.metrics = Metrics()
+        self.batcher = MicroBatcher(model, device, max_batch, window_ms, self.metrics)
+
+    async def generate(self, payload):
+        start = time.monotonic()
+        prefix, num_songs, max_length, temperature, output_format = parse_request(payload, self.chord_to_idx)
+        songs = await self.batcher.generate(prefix, num_songs, max_length, temperature)
+        result = {"songs": format_songs(songs, self.idx_to_chord, output_format), "format": output_format}
+        self.metrics.add_request(time.monotonic() - start, num_songs)
+        return result
+
+    async def route(self, method, path, body):
+        if method == "POST" and path == "/generate":
+            try:
+                payload = json.loads(body or b"{}")
+                return 200, await self.generate(payload)
+            except (ValueError, TypeError) as error:
+                self.metrics.errors += 1
+                return 400, {"error": str(error)}
+        if method == "GET" and path == "/metrics":
+            return 200, self.metrics.snapshot()
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        return 404, {"error": f"{method} {path} not found"}
+
+    async def handle(self, reader, writer):
+        """A minimal HTTP/1.1 handler, one request per connection."""
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            status, payload = await self.route(method, path.split("?")[0], body)
+        except (ValueError, asyncio.IncompleteReadError) as error:
+            status, payload = 400, {"error": str(error)}
+        except Exception as error:
+            self.metrics.errors += 1
+            status, payload = 500, {"error": str(error)}
+
+        data = json.dumps(payload).encode("utf-8")
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                     f"Connection: close\r\n\r\n".encode("latin-1") + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        server = await asyncio.start_server(self.handle, host, port)
+        batcher = asyncio.create_task(self.batcher.run())
+        print(f"Serving on http://{host}:{port} (POST /generate, GET /metrics)")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+def load_service_model(model_path=None, checkpoint=None, model_type="lstm",
+                       chords_path=os.path.join("data", "processed", "chords.json")):
+    """Returns (model, idx_to_chord). model_path is a file of functions/export.py, checkpoint a checkpoint of
+    functions/training.py or the notebook. The vocab is taken from the exported file or built from chords.json."""
+    idx_to_chord = None
+    if checkpoint is None:
+        from functions.export import load_inference_model
+        model = load_inference_model(model_path)
+        if model.vocab is not None:
+            idx_to_chord = dict(enumerate(model.vocab))
+
+    if idx_to_chord is None:
+        from functions.utils import encode_chords, add_start_end_tokens
+        with open(chords_path, "r") as fh:
+            _, _, idx_to_chord, _, vocab_size = encode_chords(add_start_end_tokens(json.load(fh)), pad=False)
+
+    if checkpoint is not None:
+        from functions.models import ChordLSTM, baselineRNN, build_model
+        model = build_model(ChordLSTM if model_type == "lstm" else baselineRNN, vocab_size)
+        state = torch.load(checkpoint, map_location="cpu", weights_only=False)
+        model.load_state_dict(state.get("model_state_dict", state))
+        model.eval()
+
+    return model, idx_to_chord
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP service for generating chord progressions")
+    parser.add_argument("--model", default=os.path.join("models", "lstm", "ChordLSTM-int8.pt"),
+                        help="a file of functions/export.py")
+    parser.add_argument("--checkpoint", default=None, help="a training checkpoint instead of --model")
+    parser.add_argument("--model-type", choices=["lstm", "rnn"], default="lstm", help="the model of --checkpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch", type=int, default=256, help="songs decoded together at most")
+    parser.add_argument("--window-ms", type=float, default=5.0, help="how long to wait for more requests")
+    parser.add_argument("--threads", type=int, default=None, help="torch threads")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model, idx_to_chord = load_service_model(args.model, args.checkpoint, args.model_type)
+    service = GenerationService(model, idx_to_chord, max_batch=args.max_batch, window_ms=args.window_ms)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""
+Generation to disk in shards, for large sets of songs.
+
+save_sequences_to_json of Models.ipynb keeps all songs in memory and writes them at the end, so a run that dies at song
+900 of 933 is lost. Here every song is appended to a shard file as soon as its chunk is decoded:
+
+    outputs/sequences/lstm/
+        manifest.json            seed, number of songs, shard size, sampling settings, vocab and format of the job
+        shard-00000.jsonl        finished shard (songs 0 - 9999)
+        shard-00001.jsonl.part   shard that is being written (append only)
+
+A shard is decoded in chunks of batch_size songs and every chunk samples with its own torch.Generator, seeded from
+(seed, shard, chunk). A song therefore only depends on the seed and its index, not on the number of workers or on
+restarts. Started again with the same arguments, a job skips the finished shards, cuts a .part file back to its last
+complete song and decodes the chunk it stopped in again (the songs of it that were already written come out the same
+and are skipped).
+
+Two shard formats:
+
+    jsonl   one line per song: {"index": 12, "chords": ["C:maj7", ...]} (readable, like the old JSON files)
+    tokens  binary records: index (uint32) | length (uint32) | token ids (uint16), the vocab is in the manifest
+
+Workers write disjoint shards (shard % num_workers == worker), either as processes started here (--workers) or as
+separate runs of the same command with --worker i --num-workers n. The songs are read back lazily, one at a time:
+
+    python -m functions.streaming --output outputs/sequences/lstm --num-songs 100000 --workers 4
+    python -m functions.midi --input outputs/sequences/lstm --name LSTM
+
+    songs = iter_songs("outputs/sequences/lstm")           # chords (one per quarter note), without <BOS>
+    metrics = evaluate_sets({"lstm": songs}, idx_to_chord)  # to_arrays reads the iterator once
+"""
+
+import os
+import json
+import time
+import struct
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import numpy as np
+import torch
+
+from functions.generation import generate_sequences, BarConstraint
+from functions.profiling import Profiler, NULL_PROFILER
+from functions.utils import expand_runlength
+
+FORMATS = {"jsonl": ".jsonl", "tokens": ".tokens"}
+MANIFEST = "manifest.json"
+RECORD = struct.Struct("<II")
+# the settings that have to be the same when a job is continued
+JOB_KEYS = ["num_songs", "max_length", "seed", "shard_size", "batch_size", "temperature", "top_k", "top_p", "min_bars",
+            "max_bars", "format", "vocab"]
+
+
+def create_job(directory, idx_to_chord, num_songs, max_length=2000, seed=1, shard_size=10000, batch_size=256,
+               temperature=1.0, top_k=None, top_p=None, min_bars=None, max_bars=None, output_format="jsonl"):
+    """Writes the manifest of a new job into directory, or checks that an existing one has the same settings (raises a
+    ValueError otherwise, a job can only be continued with the settings it was started with). Returns the manifest."""
+    if output_format not in FORMATS:
+        raise ValueError(f"unknown format {output_format}, expected one of {list(FORMATS)}")
+
+    vocab = [idx_to_chord[idx] for idx in range(len(idx_to_chord))]
+    manifest = {
+        "num_songs": num_songs, "max_length": max_length, "seed": seed, "shard_size": shard_size,
+        "batch_size": batch_size, "temperature": temperature, "top_k": top_k, "top_p": top_p, "min_bars": min_bars,
+        "max_bars": max_bars, "format": output_format, "vocab": vocab,
+        "num_shards": (num_songs + shard_size - 1) // shard_size,
+        "runlength": any(token[0].isdigit() for token in vocab),
+    }
+
+    path = os.path.join(directory, MANIFEST)
+    if os.path.exists(path):
+        existing = load_manifest(directory)
+        changed = [key for key in JOB_KEYS if existing.get(key) != manifest[key]]
+        if changed:
+            raise ValueError(f"{directory} was started with other settings ({', '.join(changed)}), use another directory")
+        return existing
+
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as fh:
+        json.dump(manifest, fh, indent=4)
+    os.replace(tmp_path, path)
+    return manifest
+
+
+def load_manifest(directory):
+    with open(os.path.join(directory, MANIFEST), "r") as fh:
+        return json.load(fh)
+
+
+def shard_path(directory, manifest, shard, part=False):
+    return os.path.join(directory, f"shard-{shard:05d}{FORMATS[manifest['format']]}" + (".part" if part else ""))
+
+
+def shard_range(manifest, shard):
+    """Index of the first song of shard and the number of songs in it."""
+    start = shard * manifest["shard_size"]
+    return start, min(manifest["shard_size"], manifest["num_songs"] - start)
+
+
+def chunk_generator(seed, shard, chunk, device="cpu"):
+    """The random number generator of one chunk of songs."""
+    generator = torch.Generator(device=device)
+    generator.manual_seed(int(np.random.SeedSequence([seed, shard, chunk]).generate_state(1)[0]))
+    return generator
+
+
+def _complete_bytes(data, output_format):
+    """Returns (number of complete songs, their length in bytes) of the content of a shard file. A song that was only
+    partly written (the process died during the write) is not counted."""
+    if output_format == "jsonl":
+        end = data.rfind(b"\n") + 1
+        return data.count(b"\n", 0, end), end
+
+    count, position = 0, 0
+    while position + RECORD.size <= len(data):
+        _, length = RECORD.unpack_from(data, position)
+        if position + RECORD.size + 2 * length > len(data):
+            break
+        position += RECORD.size + 2 * length
+        count += 1
+    return count, position
+
+
+def recover_shard(path, output_format):
+    """Cuts a .part file back to its last complete song. Returns the number of songs in it."""
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb") as fh:
+        data = fh.read()
+    count, end = _complete_bytes(data, output_format)
+    if end < len(data):
+        with open(path, "r+b") as fh:
+            fh.truncate(end)
+    return count
+
+
+def _lock(fh):
+    """Locks a shard file for this process, False if another process has it. Without fcntl (Windows) nothing is locked,
+    the workers of one job must not overlap then."""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def _encode_songs(indices, songs, vocab, output_format):
+    """The bytes of some songs (token ids without <BOS>) in the format of the shard."""
+    if output_format == "jsonl":
+        return "".join(json.dumps({"index": index, "chords": [vocab[token] for token in song]}) + "\n"
+                       for index, song in zip(indices, songs)).encode("utf-8")
+    return b"".join(RECORD.pack(index, len(song)) + np.asarray(song, dtype=np.uint16).tobytes()
+                    for index, song in zip(indices, songs))
+
+
+def generate_shard(model, directory, manifest, shard, device="cpu", rnn=False, profiler=NULL_PROFILER):
+    """Generates the missing songs of one shard and renames it to its final name once it is complete. Returns the
+    number of songs that were generated."""
+    final_path = shard_path(directory, manifest, shard)
+    if os.path.exists(final_path):
+        return 0
+    part_path = shard_path(directory, manifest, shard, part=True)
+    output_format = manifest["format"]
+
+    start, size = shard_range(manifest, shard)
+    batch_size = manifest["batch_size"]
+    constraint = None
+    if manifest["min_bars"] is not None or manifest["max_bars"] is not None:
+        constraint = BarConstraint.from_vocab(dict(enumerate(manifest["vocab"])), min_bars=manifest["min_bars"] or 1,
+                                              max_bars=manifest["max_bars"])
+
+    generated = 0
+    with open(part_path, "ab") as fh:
+        if not _lock(fh):
+            # another worker writes this shard (e.g. one of a killed run that is still going)
+            return 0
+        if os.path.exists(final_path):
+            # it was finished after the check above, this opened a new empty .part file
+            os.remove(part_path)
+            return 0
+        done = recover_shard(part_path, output_format)
+        # the chunk with the first missing song is decoded from its start, its written songs are skipped
+        for chunk in range(done // batch_size, (size + batch_size - 1) // batch_size):
+            chunk_start = chunk * batch_size
+            n = min(batch_size, size - chunk_start)
+            songs = generate_sequences(model, n, manifest["max_length"], device, batch_size=n,
+                                       temperature=manifest["temperature"], top_k=manifest["top_k"],
+                                       top_p=manifest["top_p"], rnn=rnn, constraint=constraint,
+                                       generator=chunk_generator(manifest["seed"], shard, chunk, device),
+                                       profiler=profiler)
+            skip = max(0, done - chunk_start)
+            songs = [song[1:] for song in songs[skip:]]
+            indices = range(start + chunk_start + skip, start + chunk_start + n)
+
+            with profiler.timer("write"):
+                fh.write(_encode_songs(indices, songs, manifest["vocab"], output_format))
+                fh.flush()
+                os.fsync(fh.fileno())
+            generated += len(songs)
+
+        # renamed while it is still locked
+        os.replace(part_path, final_path)
+    return generated
+
+
+def generate_shards(model, directory, worker=0, num_workers=1, device="cpu", rnn=False, profiler=NULL_PROFILER,
+                    verbose=False):
+    """Generates the shards of one worker (shard % num_workers == worker) of the job in directory. Returns the number
+    of songs that were generated."""
+    manifest = load_manifest(directory)
+    generated = 0
+    for shard in range(worker, manifest["num_shards"], num_workers):
+        start = time.perf_counter()
+        songs = generate_shard(model, directory, manifest, shard, device, rnn, profiler)
+        generated += songs
+        if verbose and songs:
+            print(f"worker {worker}: shard {shard} ({songs} songs in {time.perf_counter() - start:.1f}s)")
+    return generated
+
+
+def generate_to_disk(model, directory, idx_to_chord, num_songs, device="cpu", rnn=False, profiler=NULL_PROFILER,
+                     **job):
+    """create_job and generate_shards in this process (e.g. from the notebook). Calling it again with the same
+    arguments continues an interrupted job, for a finished one it does nothing."""
+    create_job(directory, idx_to_chord, num_songs, **job)
+    return generate_shards(model, directory, device=device, rnn=rnn, profiler=profiler)
+
+
+def _read_shard(path, output_format, complete=True):
+    """Yields (index, chords or token ids) of the songs of a shard file. With complete=False (a .part file that may be
+    written at the moment), a song at the end that is not complete yet is left out."""
+    if output_format == "jsonl":
+        with open(path, "r", encoding="utf-8") as fh:
+            for line in fh:
+                if not line.endswith("\n") and not complete:
+                    return
+                record = json.loads(line)
+                yield record["index"], record["chords"]
+        return
+
+    with open(path, "rb") as fh:
+        while True:
+            head = fh.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            index, length = RECORD.unpack(head)
+            data = fh.read(2 * length)
+            if len(data) < 2 * length:
+                return
+            yield index, np.frombuffer(data, dtype=np.uint16)
+
+
+def iter_songs(directory, ids=False, quarter_notes=True, partial=True, with_index=False):
+    """Yields the songs of a job in the order of their index, one at a time (only one song is in memory). The songs are
+    lists of chords without <BOS>, like load_sequences_from_json. With ids, the token ids of the vocab of the job are
+    returned instead. Run length tokens are expanded to one chord per quarter note, unless quarter_notes=False (ids are
+    never expanded). With partial, the complete songs of unfinished shards are returned as well (also while a job is
+    running). with_index yields (index, song)."""
+    manifest = load_manifest(directory)
+    vocab = manifest["vocab"]
+    chord_to_idx = {chord: idx for idx, chord in enumerate(vocab)}
+    expand = manifest["runlength"] and quarter_notes and not ids
+
+    for shard in range(manifest["num_shards"]):
+        path = shard_path(directory, manifest, shard)
+        complete = os.path.exists(path)
+        if not complete:
+            path = shard_path(directory, manifest, shard, part=True)
+            if not partial or not os.path.exists(path):
+                continue
+
+        for index, song in _read_shard(path, manifest["format"], complete):
+            if ids:
+                song = [chord_to_idx[chord] for chord in song] if manifest["format"] == "jsonl" else song.tolist()
+            else:
+                song = [vocab[token] for token in song.tolist()] if manifest["format"] == "tokens" else song
+                if expand:
+                    song = expand_runlength(song)
+            yield (index, song) if with_index else song
+
+
+def job_status(directory):
+    """Number of finished shards and written songs of a job."""
+    manifest = load_manifest(directory)
+    finished, songs = 0, 0
+    for shard in range(manifest["num_shards"]):
+        if os.path.exists(shard_path(directory, manifest, shard)):
+            finished += 1
+            songs += shard_range(manifest, shard)[1]
+        else:
+            part_path = shard_path(directory, manifest, shard, part=True)
+            if os.path.exists(part_path):
+                with open(part_path, "rb") as fh:
+                    songs += _complete_bytes(fh.read(), manifest["format"])[0]
+    return {"songs": songs, "num_songs": manifest["num_songs"], "finished_shards": finished,
+            "num_shards": manifest["num_shards"]}
+
+
+def _run_worker(task):
+    """One worker process: loads the model itself and generates its shards."""
+    directory, model_path, checkpoint, model_type, worker, num_workers, threads = task
+    from functions.service import load_service_model
+    torch.set_num_threads(threads)
+    model, _ = load_service_model(model_path, checkpoint, model_type)
+    profiler = Profiler()
+    songs = generate_shards(model, directory, worker, num_workers, rnn=model_type == "rnn", profiler=profiler,
+                            verbose=True)
+    return songs, profiler.seconds.get("generate", 0.0), profiler.seconds.get("write", 0.0)
+
+
+def main():
+    from functions.service import load_service_model
+
+    parser = argparse.ArgumentParser(description="Generates songs into shard files, an interrupted job is continued")
+    parser.add_argument("--output", default=os.path.join("outputs", "sequences", "lstm"), help="job directory")
+    parser.add_argument("--model", default=os.path.join("models", "lstm", "ChordLSTM-int8.pt"),
+                        help="a file of functions/export.py")
+    parser.add_argument("--checkpoint", default=None, help="a training checkpoint instead of --model")
+    parser.add_argument("--model-type", choices=["lstm", "rnn"], default="lstm", help="the model of --checkpoint")
+    parser.add_argument("--num-songs", type=int, default=933)
+    parser.add_argument("--max-length", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--shard-size", type=int, default=10000, help="songs per shard")
+    parser.add_argument("--batch-size", type=int, default=256, help="songs per chunk (decoded together)")
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top-k", type=int, default=None)
+    parser.add_argument("--top-p", type=float, default=None)
+    parser.add_argument("--min-bars", type=int, default=None, help="sample with a BarConstraint")
+    parser.add_argument("--max-bars", type=int, default=None, help="sample with a BarConstraint")
+    parser.add_argument("--format", choices=list(FORMATS), default="jsonl")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes started here")
+    parser.add_argument("--worker", type=int, default=None, help="only run this worker (of --num-workers)")
+    parser.add_argument("--num-workers", type=int, default=1, help="number of workers with --worker")
+    args = parser.parse_args()
+
+    # the vocab of the model, in the same order as the token ids
+    _, idx_to_chord = load_service_model(args.model, args.checkpoint, args.model_type)
+    create_job(args.output, idx_to_chord, args.num_songs, args.max_length, args.seed, args.shard_size, args.batch_size,
+               args.temperature, args.top_k, args.top_p, args.min_bars, args.max_bars, args.format)
+    status = job_status(args.output)
+    print(f"{args.output}: {status['songs']}/{status['num_songs']} songs, "
+          f"{status['finished_shards']}/{status['num_shards']} shards finished")
+
+    if args.worker is not None:
+        workers = [args.worker]
+        num_workers = args.num_workers
+    else:
+        workers = list(range(args.workers))
+        num_workers = args.workers
+    threads = max(1, torch.get_num_threads() // len(workers))
+    tasks = [(args.output, args.model, args.checkpoint, args.model_type, worker, num_workers, threads)
+             for worker in workers]
+
+    start = time.perf_counter()
+    if len(tasks) == 1:
+        results = [_run_worker(tasks[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=len(tasks)) as executor:
+            results = list(executor.map(_run_worker, tasks))
+    seconds = time.perf_counter() - start
+
+    songs = sum(result[0] for result in results)
+    write_seconds = sum(result[2] for result in results)
+    print(f"Generated {songs} songs in {seconds:.1f}s ({songs / seconds:.1f} songs/s, "
+          f"{write_seconds:.2f}s writing)")
+    status = job_status(args.output)
+    print(f"{args.output}: {status['songs']}/{status['num_songs']} songs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Binary token file for the encoded chords.
+
+Instead of parsing data/processed/chords.json, adding <BOS>/<EOS> and encoding it on every start, the encoded corpus is
+written once into a single binary file:
+
+    magic (8 bytes) | header length (uint64) | JSON header (vocab, dtype, ...) | offsets (int64) | tokens (uint8/uint16)
+
+The loader memory maps the offsets and tokens, so nothing is parsed and the corpus does not have to fit into RAM. Every
+song is handed out as a tensor view on the mapped file.
+
+Usage:
+    python -m functions.tokens --input data/processed/chords.json --output data/processed/chords.tokens
+"""
+
+import os
+import json
+import struct
+import argparse
+
+import numpy as np
+import torch
+
+from functions.utils import encode_chords, add_start_end_tokens
+
+MAGIC = b"JAZZTOK1"
+ALIGNMENT = 8
+
+
+def build_token_file(songs, path, runlength=False):
+    """Encodes the songs (2d list of chords, without <BOS>/<EOS>) like encode_chords and writes them to path. The token
+    ids are the same as the ones of encode_chords."""
+    _, _, idx_to_chord, sequences, vocab_size = encode_chords(add_start_end_tokens(songs), pad=False, runlength=runlength)
+
+    dtype = np.uint8 if vocab_size <= 256 else np.uint16
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum([len(sequence) for sequence in sequences], out=offsets[1:])
+    tokens = np.concatenate([sequence.numpy() for sequence in sequences]).astype(dtype)
+
+    header = json.dumps({
+        "dtype": np.dtype(dtype).name,
+        "n_songs": len(sequences),
+        "n_tokens": int(offsets[-1]),
+        "runlength": runlength,
+        "vocab": [idx_to_chord[i] for i in range(vocab_size)],
+    }).encode("utf-8")
+    # pad the header, such that the arrays behind it are aligned
+    header += b" " * (-(len(MAGIC) + 8 + len(header)) % ALIGNMENT)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack("<Q", len(header)))
+        fh.write(header)
+        fh.write(offsets.tobytes())
+        fh.write(tokens.tobytes())
+    os.replace(tmp_path, path)
+
+
+class TokenSequences:
+    """The songs of a token file. Behaves like the list of 1d tensors from encode_chords(..., pad=False) and can be passed
+    to ChordDataset directly. The lengths are read from the offsets, without touching the tokens."""
+
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    def _open(self):
+        with open(self.path, "rb") as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{self.path} is not a token file")
+            header_length = struct.unpack("<Q", fh.read(8))[0]
+            header = json.loads(fh.read(header_length).decode("utf-8"))
+
+        start = len(MAGIC) + 8 + header_length
+        self.header = header
+        self.offsets = np.memmap(self.path, dtype=np.int64, mode="r", offset=start, shape=(header["n_songs"] + 1,))
+        # copy on write mode: the tensors can be created without a copy and without warnings about read only memory
+        self.tokens = np.memmap(self.path, dtype=header["dtype"], mode="c", offset=start + self.offsets.nbytes,
+                                shape=(header["n_tokens"],))
+        self.lengths = np.diff(self.offsets).tolist()
+
+    def __len__(self):
+        return self.header["n_songs"]
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(self.tokens[self.offsets[idx]:self.offsets[idx + 1]])
+
+    # only the path is pickled (e.g. for DataLoader workers), the workers map the file again
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._open()
+
+
+def load_token_file(path):
+    """Loads a token file. Returns the same as encode_chords(..., pad=False): chord_vocab, chord_to_idx, idx_to_chord,
+    sequences (TokenSequences) and vocab_size."""
+    sequences = TokenSequences(path)
+    vocab = sequences.header["vocab"]
+
+    idx_to_chord = {idx: chord for idx, chord in enumerate(vocab)}
+    chord_to_idx = {chord: idx for idx, chord in enumerate(vocab)}
+    chord_vocab = vocab[1:]  # without pad
+
+    return chord_vocab, chord_to_idx, idx_to_chord, sequences, len(vocab)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes the encoded chords into a binary token file")
+    parser.add_argument("--input", default=os.path.join("data", "processed", "chords.json"))
+    parser.add_argument("--output", default=os.path.join("data", "processed", "chords.tokens"))
+    parser.add_argument("--runlength", action="store_true", help="use (duration, chord) tokens")
+    args = parser.parse_args()
+
+    with open(args.input, "r") as fh:
+        songs = json.load(fh)
+    build_token_file(songs, args.output, runlength=args.runlength)
+    print(f"Saved {len(songs)} songs to {args.output} ({os.path.getsize(args.output)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
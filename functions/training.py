@@ -0,0 +1,375 @@
+"""
+Training loop for ChordLSTM and baselineRNN.
+
+The loop in Models.ipynb evaluated train, val and test after every epoch (a second full pass over the training data) and
+called .item() on every batch. Here the loss and accuracy are summed up on the device and only copied to the host once per
+evaluation, and how often (and on which sets) we evaluate can be chosen:
+
+    history = train_model(model, train_loader, optimizer, criterion, epochs=50, val_loader=val_loader,
+                          eval_every=5, eval_train=False)
+
+history["train_loss"] always holds the running loss of the training pass itself (free, no extra pass). The other
+metrics are only added for the epochs in history["eval_epoch"].
+
+With a checkpoint_dir, last.pt is written every checkpoint_every epochs and/or checkpoint_minutes minutes (model,
+optimizer, RNG states, split indices and history), and best.pt whenever the validation loss improves. resume=True
+continues from last.pt with the same results as an uninterrupted run. The same from the command line:
+
+    python -m functions.training --model lstm --epochs 50 --checkpoint-every 5 --patience 5
+    python -m functions.training --model lstm --epochs 50 --checkpoint-every 5 --patience 5 --resume
+"""
+
+import os
+import json
+import time
+import random
+import argparse
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import Subset, random_split
+
+from functions.profiling import Profiler, NULL_PROFILER, torch_trace
+
+
+def model_output(model, input_seq, lengths):
+    """Runs the model on a batch. Models with packed = True (ChordLSTM) get the lengths, the others (baselineRNN) don't."""
+    if getattr(model, "packed", False):
+        output, _ = model(input_seq, lengths)
+    else:
+        output, _ = model(input_seq)
+    return output.reshape(-1, output.shape[-1])
+
+
+class MetricSum:
+    """Sums the loss and correct predictions over all non padding tokens on the device. Nothing is copied to the host
+    until result() is called."""
+
+    def __init__(self, device, ignore_index=0):
+        self.ignore_index = ignore_index
+        self.loss = torch.zeros((), device=device)
+        self.correct = torch.zeros((), device=device, dtype=torch.long)
+        self.tokens = torch.zeros((), device=device, dtype=torch.long)
+
+    def update(self, loss, output, target):
+        # loss is the mean over the non padding tokens of the batch, weight it with their number
+        mask = target != self.ignore_index
+        tokens = mask.sum()
+        self.loss += loss.detach() * tokens
+        self.correct += ((output.detach().argmax(dim=1) == target) & mask).sum()
+        self.tokens += tokens
+
+    def result(self):
+        """Returns (loss, accuracy) per token, this is the only sync with the host."""
+        loss, correct, tokens = torch.stack([self.loss, self.correct.to(self.loss.dtype),
+                                             self.tokens.to(self.loss.dtype)]).tolist()
+        tokens = max(tokens, 1)
+        return loss / tokens, correct / tokens
+
+
+def train_epoch(model, loader, optimizer, criterion, device, profiler=NULL_PROFILER):
+    """One pass over loader with gradient updates. Returns the MetricSum of the batches (loss while training, with
+    dropout), without syncing. profiler (functions/profiling.py) times data, forward, backward and optimizer."""
+    model.train()
+    metrics = MetricSum(device, criterion.ignore_index)
+
+    for input_seq, target_seq, lengths in profiler.iterate("data", loader):
+        input_seq, target_seq = input_seq.to(device, non_blocking=True), target_seq.to(device, non_blocking=True)
+        target = target_seq.view(-1)
+
+        with profiler.timer("forward"):
+            optimizer.zero_grad(set_to_none=True)
+            output = model_output(model, input_seq, lengths)
+            loss = criterion(output, target)
+        with profiler.timer("backward"):
+            loss.backward()
+        with profiler.timer("optimizer"):
+            optimizer.step()
+
+        metrics.update(loss, output, target)
+        if profiler.enabled:
+            profiler.count("batches")
+            profiler.count("train_tokens", int(lengths.sum()))
+
+    return metrics
+
+
+@torch.no_grad()
+def evaluate(model, loader, criterion, device):
+    """Returns (loss, accuracy) per non padding token on loader."""
+    model.eval()
+    metrics = MetricSum(device, criterion.ignore_index)
+
+    for input_seq, target_seq, lengths in loader:
+        input_seq, target_seq = input_seq.to(device, non_blocking=True), target_seq.to(device, non_blocking=True)
+        target = target_seq.view(-1)
+        output = model_output(model, input_seq, lengths)
+        metrics.update(criterion(output, target), output, target)
+
+    return metrics.result()
+
+
+def get_rng_state():
+    state = {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "python": random.getstate()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def split_indices(loader):
+    """The indices of the songs of a loader, if its dataset is a Subset (e.g. from random_split), otherwise None."""
+    if loader is None or not isinstance(loader.dataset, Subset):
+        return None
+    return list(loader.dataset.indices)
+
+
+def save_checkpoint(path, checkpoint):
+    """Writes checkpoint to a temporary file first and then renames it, such that a crash never leaves a broken
+    checkpoint behind."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, model=None, optimizer=None, map_location="cpu"):
+    """Loads a checkpoint of train_model (last.pt or best.pt) and restores the model and optimizer state if given.
+    Returns the checkpoint dict."""
+    # the checkpoint holds numpy/python RNG states, which are not plain tensors
+    checkpoint = torch.load(path, map_location=map_location, weights_only=False)
+    if model is not None:
+        model.load_state_dict(checkpoint["model_state_dict"])
+    if optimizer is not None and "optimizer_state_dict" in checkpoint:
+        optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
+    return checkpoint
+
+
+def train_model(model, train_loader, optimizer, criterion, epochs, val_loader=None, test_loader=None, device="cpu",
+                eval_every=1, eval_train=True, checkpoint_dir=None, checkpoint_every=None, checkpoint_minutes=None,
+                patience=None, resume=False, verbose=True, profiler=NULL_PROFILER, config=None):
+    """
+    Trains model for the given number of epochs.
+
+    Parameters:
+    - eval_every: evaluate on val/test (and train) every eval_every epochs, the last epoch is always evaluated.
+    - eval_train: if False, the extra no grad pass over the training set is skipped, history["train_loss"] (the running
+      loss of the training pass) is still there.
+    - checkpoint_dir: directory for last.pt and best.pt, nothing is saved if None.
+    - checkpoint_every, checkpoint_minutes: write last.pt every n epochs and/or if the last one is older than n minutes
+      (always at the end of an epoch). last.pt is also written when training ends.
+    - patience: stop if the validation loss did not improve for this many evaluations (not epochs, see eval_every).
+    - resume: continue from checkpoint_dir/last.pt if it exists. The loaders must hold the same split.
+    - config: settings that are not in the model or the loaders but change the training (e.g. {"transpose": "keep"}).
+      They are saved in the checkpoint and have to be the same on resume.
+    - profiler: a functions.profiling.Profiler, times the stages of every batch, the evaluation and the checkpoints and
+      writes a summary line after every epoch.
+
+    Returns:
+    - history: dict of lists. train_loss, train_running_acc and epoch_seconds have one entry per epoch, the evaluated
+      metrics (train_eval_*, val_*, test_*) one entry per epoch in eval_epoch.
+    """
+    history = {"epoch_seconds": [], "train_loss": [], "train_running_acc": [], "eval_epoch": []}
+    loaders = {"train_eval": train_loader if eval_train else None, "val": val_loader, "test": test_loader}
+    for name, loader in loaders.items():
+        if loader is not None:
+            history[f"{name}_loss"] = []
+            history[f"{name}_acc"] = []
+
+    splits = {"train": split_indices(train_loader), "val": split_indices(val_loader), "test": split_indices(test_loader)}
+    config = config or {}
+    last_path = os.path.join(checkpoint_dir, "last.pt") if checkpoint_dir else None
+    best_path = os.path.join(checkpoint_dir, "best.pt") if checkpoint_dir else None
+    start_epoch = 0
+    best_val_loss = float("inf")
+    bad_evaluations = 0
+
+    if resume and last_path and os.path.exists(last_path):
+        checkpoint = load_checkpoint(last_path, model, optimizer, map_location=device)
+        if checkpoint["splits"] != splits:
+            raise ValueError(f"The loaders do not hold the same split as {last_path}")
+        saved_config = checkpoint.get("config", {})
+        changed = sorted(key for key in set(saved_config) | set(config) if saved_config.get(key) != config.get(key))
+        if changed:
+            raise ValueError(f"{last_path} was trained with other settings: " +
+                             ", ".join(f"{key}={saved_config.get(key)!r} (now {config.get(key)!r})" for key in changed))
+        start_epoch = checkpoint["epoch"]
+        history = checkpoint["history"]
+        best_val_loss = checkpoint["best_val_loss"]
+        bad_evaluations = checkpoint["bad_evaluations"]
+        set_rng_state(checkpoint["rng_state"])
+        if verbose:
+            print(f"Resumed from {last_path} at epoch {start_epoch}")
+
+    def checkpoint_dict(epoch):
+        return {
+            "epoch": epoch,
+            "model_state_dict": model.state_dict(),
+            "optimizer_state_dict": optimizer.state_dict(),
+            "rng_state": get_rng_state(),
+            "splits": splits,
+            "config": config,
+            "history": history,
+            "best_val_loss": best_val_loss,
+            "bad_evaluations": bad_evaluations,
+        }
+
+    last_saved = time.monotonic()
+    for epoch in range(start_epoch, epochs):
+        start = time.perf_counter()
+        running = train_epoch(model, train_loader, optimizer, criterion, device, profiler)
+        train_loss, train_acc = running.result()
+        history["train_loss"].append(train_loss)
+        history["train_running_acc"].append(train_acc)
+
+        message = f"Epoch {epoch+1}/{epochs}: Train Loss: {train_loss:.4f}"
+        improved = False
+        if (epoch + 1) % eval_every == 0 or epoch + 1 == epochs:
+            history["eval_epoch"].append(epoch + 1)
+            for name, loader in loaders.items():
+                if loader is None:
+                    continue
+                with profiler.timer(f"evaluate_{name}"):
+                    loss, acc = evaluate(model, loader, criterion, device)
+                history[f"{name}_loss"].append(loss)
+                history[f"{name}_acc"].append(acc)
+                label = name.replace("_", " ").title()
+                message += f" | {label} Loss: {loss:.4f} | {label} Acc: {acc:.4f}"
+
+            if val_loader is not None:
+                if history["val_loss"][-1] < best_val_loss:
+                    best_val_loss = history["val_loss"][-1]
+                    bad_evaluations = 0
+                    improved = True
+                else:
+                    bad_evaluations += 1
+
+        history["epoch_seconds"].append(time.perf_counter() - start)
+        if verbose:
+            print(message + f" | {history['epoch_seconds'][-1]:.1f}s")
+
+        stop = patience is not None and bad_evaluations >= patience
+        if checkpoint_dir:
+            if improved:
+                with profiler.timer("checkpoint"):
+                    save_checkpoint(best_path, checkpoint_dict(epoch + 1))
+            due = (checkpoint_every and (epoch + 1) % checkpoint_every == 0) or \
+                  (checkpoint_minutes and time.monotonic() - last_saved >= checkpoint_minutes * 60)
+            if due or stop or epoch + 1 == epochs:
+                with profiler.timer("checkpoint"):
+                    save_checkpoint(last_path, checkpoint_dict(epoch + 1))
+                last_saved = time.monotonic()
+        # after the checkpoints, so the summary of an epoch has its checkpoint time
+        profiler.snapshot(epoch=epoch + 1, epoch_seconds=history["epoch_seconds"][-1])
+
+        if stop:
+            if verbose:
+                print(f"Early stopping: the validation loss did not improve for {patience} evaluations "
+                      f"(best {best_val_loss:.4f})")
+            break
+
+    return history
+
+
+def split_dataset(dataset, seed=1, train=0.7, val=0.2):
+    """The 70/20/10 split of Models.ipynb."""
+    train_size = int(train * len(dataset))
+    val_size = int(val * len(dataset))
+    test_size = len(dataset) - train_size - val_size
+    return random_split(dataset, [train_size, val_size, test_size], generator=torch.Generator().manual_seed(seed))
+
+
+def main():
+    from functions.utils import encode_chords, add_start_end_tokens
+    from functions.data import ChordDataset, bucket_loader, transposition_table, TransposeCollate, TRANSPOSE_POLICIES
+    from functions.models import ChordLSTM, baselineRNN, build_model
+    from functions.tokens import load_token_file
+
+    parser = argparse.ArgumentParser(description="Trains ChordLSTM or baselineRNN with checkpoints")
+    parser.add_argument("--model", choices=["lstm", "rnn"], default="lstm")
+    parser.add_argument("--data", default=os.path.join("data", "processed", "chords.json"),
+                        help="chords.json or a token file of functions/tokens.py")
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--lr", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--eval-every", type=int, default=1)
+    parser.add_argument("--no-eval-train", action="store_true", help="skip the evaluation pass over the training set")
+    parser.add_argument("--checkpoint-dir", default=None, help="default: models/<model>")
+    parser.add_argument("--checkpoint-every", type=int, default=5, help="write last.pt every n epochs")
+    parser.add_argument("--checkpoint-minutes", type=float, default=None, help="write last.pt every n minutes")
+    parser.add_argument("--patience", type=int, default=None, help="early stopping after n evaluations")
+    parser.add_argument("--resume", action="store_true", help="continue from last.pt")
+    parser.add_argument("--num-workers", type=int, default=0, help="DataLoader workers of the training loader")
+    parser.add_argument("--profile", default=None, help="JSON lines trace of the timers, a summary is printed at the end")
+    parser.add_argument("--torch-trace", default=None, help="torch.profiler Chrome trace of the whole run (large)")
+    parser.add_argument("--transpose", choices=TRANSPOSE_POLICIES, default=None,
+                        help="transpose every training song into a random key, the value is the policy for chords "
+                             "whose transposition is not in the vocab")
+    args = parser.parse_args()
+
+    checkpoint_dir = args.checkpoint_dir or os.path.join("models", args.model)
+    last_path = os.path.join(checkpoint_dir, "last.pt")
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    if args.data.endswith(".json"):
+        with open(args.data, "r") as fh:
+            songs = add_start_end_tokens(json.load(fh))
+        _, _, idx_to_chord, sequences, vocab_size = encode_chords(songs, pad=False)
+    else:
+        _, _, idx_to_chord, sequences, vocab_size = load_token_file(args.data)
+    dataset = ChordDataset(sequences)
+
+    if args.resume and os.path.exists(last_path):
+        # use the split of the checkpoint, not a new one
+        splits = load_checkpoint(last_path)["splits"]
+        subsets = [Subset(dataset, splits[name]) for name in ["train", "val", "test"]]
+    else:
+        subsets = split_dataset(dataset, seed=args.seed)
+    transpose = None
+    if args.transpose:
+        # the spelling of a transposed chord follows the training songs only, val and test are not looked at
+        counts = torch.bincount(torch.cat([torch.as_tensor(sequences[i]).long() for i in subsets[0].indices]),
+                                minlength=vocab_size)
+        transpose = TransposeCollate(*transposition_table(idx_to_chord, counts), policy=args.transpose)
+    train_loader, val_loader, test_loader = [bucket_loader(subset, args.batch_size, shuffle=shuffle,
+                                                           transpose=transpose if shuffle else None,
+                                                           num_workers=args.num_workers if shuffle else 0)
+                                             for subset, shuffle in zip(subsets, [True, False, False])]
+
+    model_class = ChordLSTM if args.model == "lstm" else baselineRNN
+    model = build_model(model_class, vocab_size).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    criterion = nn.CrossEntropyLoss(ignore_index=0)
+
+    profiler = NULL_PROFILER
+    if args.profile or args.torch_trace:
+        profiler = Profiler(args.profile, synchronize=device.type == "cuda", record_functions=bool(args.torch_trace))
+
+    with torch_trace(args.torch_trace) if args.torch_trace else nullcontext():
+        train_model(model, train_loader, optimizer, criterion, args.epochs, val_loader, test_loader, device,
+                    eval_every=args.eval_every, eval_train=not args.no_eval_train, checkpoint_dir=checkpoint_dir,
+                    checkpoint_every=args.checkpoint_every, checkpoint_minutes=args.checkpoint_minutes,
+                    patience=args.patience, resume=args.resume, profiler=profiler,
+                    config={"transpose": args.transpose})
+
+    if profiler.enabled:
+        print(profiler.report())
+        profiler.close()
+
+
+if __name__ == "__main__":
+    main()
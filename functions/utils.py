@@ -11,6 +11,105 @@ import torch.nn as nn
 from torch.nn.utils.rnn import pad_sequence, pack_padded_sequence, pad_packed_sequence
 import numpy as np
 import json
+from collections import namedtuple
+
+
+SIGNATURE = re.compile(r'\*M(\d+/\d+)')
+
+# One chord line of a kern file. token is what extract_chords returns (duration + chord, without substitute chord),
+# e.g. for the line 2C:maj7(F#7): section="A", duration="2", chord="C:maj7", substitute="F#7", token="2C:maj7"
+ChordEvent = namedtuple("ChordEvent", ["section", "duration", "chord", "substitute", "token"])
+
+
+def iter_kern(lines):
+    """Streaming parser for kern files. lines can be any iterator of lines, e.g. an open file, text.split("\n") or a
+    member of a tar/zip archive (wrapped in io.TextIOWrapper). Yields (kind, value) tuples in file order:
+    - ("title", str), ("year", str), ("signature", "4/4")
+    - ("sequence", ["A", "A2", "B", "A3"]): the sequnce element *>[...] that orders the sections
+    - ("section", "A"): a section header *>A, the following chords belong to it
+    - ("chord", ChordEvent)
+    Nothing is kept in memory, so every file is parsed in one linear pass.
+    """
+    current_section = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+
+        first = line[0]
+        if first == "!":
+            if line.startswith("!!!OTL:"):
+                yield "title", line[len("!!!OTL:"):].strip()
+            elif line.startswith("!!!ODT:"):
+                yield "year", line.partition("!!!ODT: ")[2]
+
+        # first check for the sequnce element (eg [A, A1, ...]
+        elif first == "*":
+            if line.startswith("*>["):
+                sequnce_element = line[3:-1].split(",")
+                yield "sequence", sequnce_element
+                # sometimes, the files do have one single sequunce inforamtion but no header (the thing checkt in the elif down below). This avoids this problem
+                if len(sequnce_element) == 1:
+                    current_section = sequnce_element[0]
+                    yield "section", current_section
+
+            elif line.startswith("*>"):
+                current_section = line[2:]
+                yield "section", current_section
+
+        # the substring check is much cheaper than the regex, which is only needed for the few signature lines
+        if "*M" in line:
+            match = SIGNATURE.search(line)
+            if match:
+                yield "signature", match.group(1)
+
+        # check if we have digit (aka duration in front)
+        if first.isdigit():
+            token, _, substitute = line.partition("(")
+            # check if we have a dotted note
+            duration = token[:2] if token[1:2] == "." else token[0]
+            yield "chord", ChordEvent(current_section, duration, token[len(duration):], substitute.rstrip(")") or None, token)
+
+
+def read_kern(lines):
+    """Reads a whole kern file in one pass over iter_kern. Returns a dict with title, year, signature (the first one of
+    each, or None), sequence (the sequnce element, [] if there is none) and chords (see extract_chords)."""
+    info = {"title": None, "year": None, "signature": None, "sequence": []}
+    chords_sections = {}
+    sequnce_element = None
+    chords_no_element = []
+
+    for kind, value in iter_kern(lines):
+        if kind == "chord":
+            if sequnce_element is not None:
+                chords_sections.setdefault(value.section, []).append(value.token)
+            # no sequnce element
+            else:
+                chords_no_element.append(value.token)
+        elif kind == "section":
+            # a header starts the section from scratch, also if it occurred before
+            chords_sections[value] = []
+        elif kind == "sequence":
+            sequnce_element = value
+            info["sequence"] = value
+        elif info[kind] is None:
+            info[kind] = value
+
+    if sequnce_element is None:
+        info["chords"] = chords_no_element
+        return info
+
+    # order the chords accordingly
+    final_sequnce = []
+    for n in sequnce_element:
+        final_sequnce += chords_sections[n]
+
+    # prune that ONE outlier
+    if len(final_sequnce) > 300:
+        final_sequnce = final_sequnce[:200]
+
+    info["chords"] = final_sequnce
+    return info
 
 
 def extract_chords(text):
@@ -26,62 +125,7 @@ def extract_chords(text):
     2.Amin7
     This means a half note dotted (half dutation of the note longer). So it would be a third in duration.
     """
-    lines = text.strip().split("\n")
-    chords_sections = {}
-    sequnce_element = ""
-    chords_no_element = []
-    
-    for line in lines:
-        # first check for the sequnce element (eg [A, A1, ...]
-        if line.startswith("*>["):
-            sequnce_element = line[3:-1].split(",")
-            # sometimes, the files do have one single sequunce inforamtion but no header (the thing checkt in the elif down below). This avoids this problem
-            if len(sequnce_element) == 1:
-                
-                current_section = sequnce_element[0]
-                chords_sections[current_section] = []
-
-        elif line.startswith("*>"):
-            current_section = line[2:]
-            chords_sections[current_section] = []
-            
-            
-            
-        # check if we have digit (aka duration in front) 
-        if line[0].isdigit():
-            
-            if sequnce_element != "":
-                chords_sections[current_section] = chords_sections[current_section] + [line.split("(")[0]]
-            #     duration = line[0]
-            #     # check if we have a dotted note
-            #     if line[1] == ".":
-            #         # split("(") removes subsitute chord        #we add the time plus the dot if so to the chord information
-            #         chords_sections[current_section] = chords_sections[current_section] + [duration + "." + line[2:].split("(")[0]]
-            #     else:
-            #         # duration added, no dot
-            #         chords_sections[current_section] = chords_sections[current_section] + [duration + line[1:].split("(")[0]]
-            
-            # no sequnce element
-            else:
-                chords_no_element.append(line.split("(")[0])
-                # if line[1] == ".":
-                #     # split("(") removes subsitute chord
-                #     chords_no_element.append(line[2:].split("(")[0])
-                # else:
-                #     chords_no_element.append(line[1:].split("(")[0])
-            
-
-    # order the chords accordingly
-    final_sequnce = []
-    for n in sequnce_element:
-        final_sequnce += chords_sections[n]
-
-    # prune that ONE outlier 
-    if len(final_sequnce) > 300:
-        return final_sequnce[:200]
-    
-    if sequnce_element != "": return final_sequnce
-    else: return chords_no_element
+    return read_kern(text.strip().split("\n"))["chords"]
 
 
 def flatten_chords(chords:list):
@@ -103,6 +147,50 @@ def flatten_chords(chords:list):
     return arranged_chords
 
 
+SPECIAL_TOKENS = ["<BOS>", "<EOS>", "pad"]
+RUNLENGTH_DURATIONS = {4: '1', 3: '2.', 2: '2', 1: '4'}
+
+
+def runlength_chords(chords:list):
+    """The inverse of flatten_chords: inputs a sequence with one chord per quarter note and merges repeated chords into
+    one token with the duration in front, e.g. [B:min, B:min, B:min, B:min] -> [1B:min]. Runs are split at the bar lines
+    (4/4), so the tokens use the same notation as merge_chords and flatten_chords(runlength_chords(x)) == x.
+    The songs get ~3-4 times shorter this way. Special tokens (<BOS>, <EOS>, pad) are kept as they are and do not count
+    as a beat.
+    """
+    tokens = []
+    position = 0  # quarter notes since the start of the song
+    i = 0
+    while i < len(chords):
+        chord = chords[i]
+        if chord in SPECIAL_TOKENS:
+            tokens.append(chord)
+            i += 1
+            continue
+
+        # count the repetitions, but never over the end of the current bar
+        run = 1
+        while run < 4 - position % 4 and i + run < len(chords) and chords[i + run] == chord:
+            run += 1
+
+        tokens.append(RUNLENGTH_DURATIONS[run] + chord)
+        position += run
+        i += run
+
+    return tokens
+
+
+def expand_runlength(tokens:list):
+    """Turns run length tokens back into one chord per quarter note, special tokens are kept."""
+    expanded = []
+    for token in tokens:
+        if token in SPECIAL_TOKENS:
+            expanded.append(token)
+        else:
+            expanded.extend(flatten_chords([token]))
+    return expanded
+
+
 def flatten_chords_half(chords:list):
     """Inputs a list of chords with time infraomtion in front. Takes this time infomation and converts
     it to a seqcune format , eg. 1B:min -> [B:min, B:min].
@@ -126,18 +214,17 @@ def flatten_chords_half(chords:list):
 
 
 def extract_signature(text):
-    # Using regular expression to find the pattern *M followed by a time signature
-    match = re.search(r'\*M(\d+/\d+)', text)
-    if match:
-        return match.group(1)
-    else:
-        return None
+    # finds the pattern *M followed by a time signature, stops at the first one
+    for kind, value in iter_kern(text.split("\n")):
+        if kind == "signature":
+            return value
+    return None
 
 def extract_year(text):
     # extracts the year of a kern file
-    for line in text.split("\n"):
-        if line.startswith("!!!ODT:"):
-            return line.split("!!!ODT: ")[1]
+    for kind, value in iter_kern(text.split("\n")):
+        if kind == "year":
+            return value
 
     return False 
 
@@ -199,7 +286,7 @@ def visualize_chord_simplification(chords, ChordSimplifier):
 #-----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 
 # CHORD ENCODING
-def encode_chords(all_chords:list):
+def encode_chords(all_chords:list, pad:bool=True, runlength:bool=False):
     """takes all chords as 2d list (where every list is a list of string chords like "A:min", "B:min, ...)and returns the following: 
     - chord vocab
     - chord_to_idx: given a chord, a index is returned
@@ -207,9 +294,18 @@ def encode_chords(all_chords:list):
     this is usefull for encoding and decoding later
     - padded_sequnces: padded sequnces using pytorchs padded seqnces functin
     - vocab size
+    If pad is False, the encoded sequences are returned as a list of 1d tensors instead (no padding at all). This is used
+    together with the bucketing in functions/data.py, which pads per batch only.
+    If runlength is True, the (quarter note) songs are first merged to (duration, chord) tokens with runlength_chords,
+    e.g. "2C:maj7" is one token instead of two "C:maj7" tokens. Use expand_runlength to go back after generation.
     """
-    # Create a vocabulary of unique chords:
-    chord_vocab = sorted(set(chord for chord_sequence in all_chords for chord in chord_sequence))
+    if runlength:
+        all_chords = [runlength_chords(chord_sequence) for chord_sequence in all_chords]
+
+    # Create a vocabulary of unique chords. Special tokens come first, so <BOS> = 1 and <EOS> = 2 also for run length tokens
+    # (which start with a digit and would be sorted before them)
+    chord_vocab = sorted(set(chord for chord_sequence in all_chords for chord in chord_sequence),
+                         key=lambda chord: (chord not in SPECIAL_TOKENS, chord))
 
     # Create a mapping from chords to indices:
     chord_to_idx = {chord: idx+1 for idx, chord in enumerate(chord_vocab)}
@@ -226,19 +322,19 @@ def encode_chords(all_chords:list):
         encoded_sequence = [chord_to_idx[chord] for chord in chord_sequence[:max_length]]
         encoded_sequences.append(torch.tensor(encoded_sequence))
     
-    # Pad the sequences to the same length
-    padded_sequences = pad_sequence(encoded_sequences, batch_first=True)
-    
-    # Compute the lengths of each sequence
-    lengths = [len(sequence) for sequence in encoded_sequences]
-    
-    # Vocab Size 
-    vocab_size = padded_sequences.max().item() + 1
+    # Vocab Size (all chords + the pad token)
+    vocab_size = len(chord_vocab) + 1
     
     # add the pad tokens to both with high number to not learn embedding
     chord_to_idx['pad'] = 0
     idx_to_chord[0] = 'pad'
 
+    if not pad:
+        return chord_vocab, chord_to_idx, idx_to_chord, encoded_sequences, vocab_size
+
+    # Pad the sequences to the same length
+    padded_sequences = pad_sequence(encoded_sequences, batch_first=True)
+
     return chord_vocab, chord_to_idx, idx_to_chord, padded_sequences, vocab_size
 
 
@@ -0,0 +1,57 @@
+"""
+The BucketBatchSampler of functions/data.py: every song once per epoch, and with shuffle=True the batches change between
+epochs (not only their order), also on a split the size of the training set.
+
+    python -m pytest tests
+"""
+
+import torch
+
+from functions.data import BucketBatchSampler
+
+# about the size of the training split (933 songs, 70%), all lengths different, such that sorting by length alone
+# does not shuffle the batches (equal lengths stay in their random order)
+LENGTHS = (torch.randperm(650, generator=torch.Generator().manual_seed(0)) + 20).tolist()
+
+
+def epochs(sampler, n=3):
+    return [[frozenset(batch) for batch in sampler] for _ in range(n)]
+
+
+def test_every_song_once():
+    for shuffle in [True, False]:
+        sampler = BucketBatchSampler(LENGTHS, 64, shuffle=shuffle, generator=torch.Generator().manual_seed(1))
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        assert sorted(i for batch in batches for i in batch) == list(range(len(LENGTHS)))
+
+
+def test_drop_last():
+    sampler = BucketBatchSampler(LENGTHS, 64, drop_last=True, generator=torch.Generator().manual_seed(1))
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    assert all(len(batch) == 64 for batch in batches)
+
+
+def test_batches_change_between_epochs():
+    sampler = BucketBatchSampler(LENGTHS, 64, shuffle=True, generator=torch.Generator().manual_seed(2))
+    first, *later = epochs(sampler)
+    for batches in later:
+        # most batches hold other songs than in the first epoch
+        assert len(set(first) & set(batches)) < len(first) // 2
+
+
+def test_batches_fixed_without_shuffle():
+    first, *later = epochs(BucketBatchSampler(LENGTHS, 64, shuffle=False))
+    assert all(batches == first for batches in later)
+
+
+def test_similar_lengths_in_a_batch():
+    # the point of the buckets: less padding than random batches
+    def padding(batches):
+        return sum(len(batch) * max(LENGTHS[i] for i in batch) - sum(LENGTHS[i] for i in batch) for batch in batches)
+
+    generator = torch.Generator().manual_seed(3)
+    bucketed = padding(BucketBatchSampler(LENGTHS, 64, generator=generator))
+    random_batches = padding(BucketBatchSampler(LENGTHS, 64, bucket_multiplier=1, generator=generator))
+    assert bucketed < random_batches
@@ -0,0 +1,38 @@
+"""
+length_stats of functions/metrics.py against analyze_chord_progressions, the loop it replaced in the notebooks (same
+values, same types, modes in the same order).
+
+    python -m pytest tests
+"""
+
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from functions.metrics import length_stats
+
+
+def analyze_chord_progressions(lengths):
+    total_songs = len(lengths)
+    sorted_lengths = sorted(lengths)
+    if total_songs % 2 == 0:
+        median_length = (sorted_lengths[total_songs // 2 - 1] + sorted_lengths[total_songs // 2]) / 2
+    else:
+        median_length = sorted_lengths[total_songs // 2]
+    counts = Counter(lengths)
+    max_count = max(counts.values())
+    mode_length = [length for length, count in counts.items() if count == max_count]
+    return total_songs, sum(lengths) / total_songs, min(lengths), max(lengths), median_length, mode_length
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_length_stats(seed):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 12, rng.integers(1, 40)).tolist()
+    stats = length_stats(np.concatenate([[0], np.cumsum(lengths)]))
+    expected = analyze_chord_progressions(lengths)
+    keys = ["total_songs", "avg_length", "min_length", "max_length", "median_length", "mode_length"]
+    assert [stats[key] for key in keys] == list(expected)
+    assert [type(stats[key]) for key in keys] == [type(value) for value in expected]
+    assert stats["short_songs"] == sum(length < 4 for length in lengths)
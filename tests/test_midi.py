@@ -0,0 +1,58 @@
+"""
+The direct MIDI writer of functions/midi.py (smf_bytes) against pretty_midi: the files have to be byte identical.
+
+    python -m pytest tests
+"""
+
+import io
+import os
+
+import numpy as np
+import pytest
+
+from functions.midi import midi_bytes, write_progression, export_midi, _variable_length
+
+PROGRESSIONS = [
+    ["1C:maj7"],
+    ["2D:min7", "2G:7", "1C:maj7"],
+    ["2.E:min", "4A:7", "4D:min7", "4G:7", "2C:maj7", "1F:maj7"],
+    ["1B:hdim7", "1E:7", "2A:min", "2A:min", "2.D:min7", "4G:7", "1C:maj", "1C:maj", "1C:dim7", "4C:min"] * 4,
+    [],
+]
+
+
+@pytest.mark.parametrize("arranged", [False, True])
+@pytest.mark.parametrize("progression", PROGRESSIONS)
+def test_same_bytes_as_pretty_midi(progression, arranged):
+    buffer = io.BytesIO()
+    write_progression(progression, buffer, arranged=arranged)
+    assert buffer.getvalue() == midi_bytes(progression, arranged=arranged)
+
+
+def test_variable_length():
+    def reference(value):
+        data = [value & 0x7F]
+        value >>= 7
+        while value:
+            data.append((value & 0x7F) | 0x80)
+            value >>= 7
+        return bytes(reversed(data))
+
+    values = np.array([0, 1, 127, 128, 255, 16383, 16384, 2097151, 2097152, 268435455])
+    buffer, starts, n_bytes = _variable_length(values, np.zeros(len(values), dtype=np.int64))
+    assert buffer.tobytes() == b"".join(reference(int(value)) for value in values)
+    assert n_bytes.tolist() == [len(reference(int(value))) for value in values]
+
+
+def test_export_midi(tmp_path):
+    # one chord per quarter note, a special token in the middle is left out like in Models.ipynb
+    songs = [["C:maj7"] * 4 + ["D:min7", "D:min7", "G:7", "G:7"], ["E:min", "<EOS>", "A:7", "A:7"]]
+    direct = tmp_path / "direct"
+    reference = tmp_path / "pretty_midi"
+    assert export_midi(songs, str(direct), workers=1) == 4
+    export_midi(songs, str(reference), workers=1, direct=False)
+    for folder in ["piano", "arranged"]:
+        names = sorted(os.listdir(direct / folder))
+        assert names == sorted(os.listdir(reference / folder))
+        for name in names:
+            assert (direct / folder / name).read_bytes() == (reference / folder / name).read_bytes()
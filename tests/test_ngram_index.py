@@ -0,0 +1,100 @@
+"""
+The suffix array index of functions/ngram_index.py against brute force (sorted suffixes, Counter over all windows).
+
+    python -m pytest tests
+"""
+
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from functions.ngram_index import suffix_array, lcp_array, NgramIndex
+from functions.utils import merge_chords
+
+SONGS = [
+    ["C:maj7"] * 4 + ["A:min7"] * 2 + ["D:min7", "G:7"] + ["C:maj7"] * 4,
+    ["D:min7", "D:min7", "G:7", "G:7", "C:maj7", "C:maj7", "C:maj7", "A:7"],
+    ["E:min"] * 8,
+    ["E:min", "A:min", "C:min", "F:min"],
+    ["D:min7", "G:7", "C:maj7"],
+    ["B:hdim7", "E:7", "A:min", "A:min", "D:min7", "G:7", "C:maj7", "C:maj7", "F:maj7", "B:hdim7", "E:7", "A:min"],
+]
+
+
+def random_songs(seed, n_songs=30, alphabet=("C:maj7", "A:min7", "D:min7", "G:7", "E:7")):
+    rng = np.random.default_rng(seed)
+    return [[alphabet[i] for i in rng.integers(0, len(alphabet), rng.integers(1, 25))] for _ in range(n_songs)]
+
+
+def vocab(songs):
+    return dict(enumerate(sorted({chord for song in songs for chord in song})))
+
+
+def windows(songs, n):
+    """Counter of all progressions of length n inside the songs, in the order of their first occurrence."""
+    return Counter(tuple(song[i:i + n]) for song in songs for i in range(len(song) - n + 1))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_suffix_array_and_lcp(seed):
+    text = np.random.default_rng(seed).integers(0, 4, 200)
+    sa = suffix_array(text)
+    assert sa.tolist() == sorted(range(len(text)), key=lambda i: text[i:].tolist())
+
+    lcp = lcp_array(text, sa)
+    for i in range(1, len(sa)):
+        a, b = text[sa[i - 1]:], text[sa[i]:]
+        common = 0
+        while common < min(len(a), len(b)) and a[common] == b[common]:
+            common += 1
+        assert lcp[i] == common
+
+
+@pytest.mark.parametrize("songs", [SONGS, random_songs(0), random_songs(1)])
+@pytest.mark.parametrize("n", [1, 2, 3, 4])
+def test_top_ngrams(songs, n):
+    index = NgramIndex.from_songs(songs, vocab(songs))
+    expected = windows(songs, n).most_common()
+    assert index.top_ngrams(n, top_k=len(expected)) == expected
+
+
+@pytest.mark.parametrize("songs", [SONGS, random_songs(2)])
+@pytest.mark.parametrize("n", [2, 3])
+def test_top_ngrams_merged(songs, n):
+    merged = [merge_chords(song) for song in songs]
+    with_durations = NgramIndex.from_songs(songs, vocab(songs), merged=True)
+    expected = windows(merged, n).most_common()
+    assert with_durations.top_ngrams(n, top_k=len(expected)) == expected
+
+    # without the durations, like top_chord_progressions of Statistics.ipynb
+    without_durations = NgramIndex.from_songs(songs, vocab(songs), merged=True, durations=False)
+    stripped = [[chord[2:] if chord[1] == '.' else chord[1:] for chord in song] for song in merged]
+    expected = windows(stripped, n).most_common()
+    assert without_durations.top_ngrams(n, top_k=len(expected)) == expected
+
+
+def test_count():
+    songs = SONGS + random_songs(3)
+    index = NgramIndex.from_songs(songs, vocab(songs))
+    for n in [1, 2, 3, 5]:
+        for progression, count in windows(songs, n).items():
+            assert index.count(progression) == count
+    # a progression over the end of a song (the end of the first one and the start of the second) is not counted
+    index = NgramIndex.from_songs(SONGS, vocab(SONGS))
+    assert index.count(("C:maj7", "D:min7", "D:min7", "G:7")) == 0
+
+
+def test_longest_matches():
+    corpus = SONGS[:4]
+    index = NgramIndex.from_songs(corpus, vocab(SONGS))
+    for song in SONGS[4:] + corpus:
+        expected = []
+        for start in range(len(song)):
+            length = 0
+            while start + length < len(song) and windows(corpus, length + 1)[tuple(song[start:start + length + 1])]:
+                length += 1
+            expected.append(length)
+        assert index.longest_matches(song).tolist() == expected
+    # a song of the corpus is found completely
+    assert index.novelty(SONGS[0], 4) == 0.0
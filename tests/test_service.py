@@ -0,0 +1,69 @@
+"""
+The generation service of functions/service.py with a fixed fake model: pad and <BOS> are never sampled and never
+reach the client, also not as MIDI.
+
+    python -m pytest tests
+"""
+
+import io
+import json
+import base64
+import asyncio
+
+import pretty_midi
+import torch
+
+from functions.generation import generate_batch
+from functions.service import GenerationService, format_songs
+
+IDX_TO_CHORD = {0: "pad", 1: "<BOS>", 2: "<EOS>", 3: "C:maj7", 4: "G:7"}
+
+
+class FakeModel(torch.nn.Module):
+    """Puts almost all the probability on pad and <BOS>, the rest on C:maj7 and G:7 (never <EOS>)."""
+
+    def step(self, x, hidden):
+        logits = torch.tensor([[10.0, 10.0, -100.0, 0.0, 0.0]]).repeat(x.size(0), 1)
+        # a hidden state with the batch on dim 1 like an RNN, generate_batch drops the finished rows from it
+        return logits, torch.zeros(1, x.size(0), 1)
+
+
+def test_generate_batch_never_samples_pad_and_bos():
+    torch.manual_seed(0)
+    songs = generate_batch(FakeModel(), [[1], [1, 3, 4]], [50, 60], [1.0, 2.0], "cpu")
+    assert [len(song) for song in songs] == [51, 61]
+    for song in songs:
+        assert song[0] == 1
+        assert set(song[1:]) <= {3, 4}
+
+
+def test_format_songs_skips_special_tokens():
+    songs = [[1, 3, 0, 3, 1, 4, 4], [1, 0, 1]]
+    assert format_songs(songs, IDX_TO_CHORD, "chords") == [["C:maj7", "C:maj7", "G:7", "G:7"], []]
+    assert format_songs(songs, IDX_TO_CHORD, "merged") == [["2C:maj7", "2G:7"], []]
+    midi = pretty_midi.PrettyMIDI(io.BytesIO(base64.b64decode(format_songs([[1, 3, 0]], IDX_TO_CHORD, "midi")[0])))
+    assert len(midi.instruments[0].notes) > 0
+
+
+def test_service_returns_no_special_tokens():
+    torch.manual_seed(0)
+    service = GenerationService(FakeModel(), IDX_TO_CHORD)
+
+    async def requests():
+        batcher = asyncio.create_task(service.batcher.run())
+        try:
+            responses = {}
+            for output_format in ["chords", "merged", "midi"]:
+                body = json.dumps({"num_songs": 3, "max_length": 20, "prefix": ["C:maj7"], "format": output_format})
+                responses[output_format] = await service.route("POST", "/generate", body.encode())
+            responses["pad"] = await service.route("POST", "/generate", json.dumps({"prefix": ["pad"]}).encode())
+            return responses
+        finally:
+            batcher.cancel()
+
+    responses = asyncio.run(requests())
+    assert [status for status, _ in responses.values()] == [200, 200, 200, 400]
+    for song in responses["chords"][1]["songs"]:
+        assert len(song) == 20 and set(song) <= {"C:maj7", "G:7"}
+    for song in responses["merged"][1]["songs"]:
+        assert all(chord.endswith(("C:maj7", "G:7")) for chord in song)